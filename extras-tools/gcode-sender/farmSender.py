@@ -0,0 +1,71 @@
+#!/usr/bin/python
+#
+# A tool to send GCODE files to many printers at once from a single process.
+#
+# Printers printing the same file share a single framed copy of it.
+#
+
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+from __future__ import print_function
+from pyMarlin   import *
+
+import argparse
+import serial
+import sys
+import time
+
+parser = argparse.ArgumentParser(description='''sends gcode files to many printers concurrently.''')
+parser.add_argument('-j', '--job',   help='Print FILE on serial PORT; may be repeated. Use FAKE as the port for a simulated Marlin.', nargs=2, metavar=('PORT', 'FILE'), action='append', required=True)
+parser.add_argument('-b', '--baud',  help='Sets the baud rate for the serial ports.', default='115000', type=int)
+parser.add_argument('-v', '--verbose', help='Print resend and debug messages from each printer.', action='store_true')
+parser.add_argument('--cachedir',    help='Directory of the cache of framed jobs, instead of ~/.cache/pyMarlin/framed.')
+parser.add_argument('--cachesize',   help='Maximum size of the cache in megabytes.', default=1024, type=int)
+args = parser.parse_args()
+
+def onResendCallback(name, line):
+  print("%s: Resending from: %d" % (name, line))
+def onNotificationCallback(name, status):
+  print("%s: %s" % (name, status))
+
+cache = FramedGCodeCache(args.cachedir, args.cachesize * 1024 * 1024)
+if args.verbose:
+  farm = PrinterFarm(onResendCallback, onNotificationCallback, cache)
+else:
+  farm = PrinterFarm(cache = cache)
+
+for i, (port, filename) in enumerate(args.job):
+  if port == "FAKE":
+    name = "fake%d" % i
+    sio  = FakeMarlinSerialDevice()
+  else:
+    name = port
+    sio  = serial.Serial(port, args.baud, timeout = 3, writeTimeout = 10000)
+  job = farm.loadJob(filename)
+  print("%s: %s (%d lines)" % (name, job.name, len(job)))
+  farm.addPrinter(name, sio, job)
+
+print("%d printers, %d distinct jobs" % (len(farm.printers), len(farm.jobs)))
+print()
+
+farm.start()
+while farm.isRunning():
+  time.sleep(1)
+  print("  ".join("%s: %3d%%" % (name, pct) for name, pct in sorted(farm.progress().items())), end='\r')
+  sys.stdout.flush()
+farm.join()
+print()
+
+for printer in farm.printers:
+  if printer.error:
+    print("%s: failed: %s" % (printer.name, printer.error))
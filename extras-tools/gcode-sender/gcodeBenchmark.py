@@ -0,0 +1,213 @@
+#!/usr/bin/python
+#
+# Micro-benchmarks for the pyMarlin host-side protocol stack.
+#
+
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+from __future__ import print_function
+from pyMarlin   import *
+from pyMarlin   import gcodeFramer
+from pyMarlin   import protocolBenchmark
+
+import argparse
+import functools
+import json
+import sys
+import time
+
+def report(name, count, elapsed, baseline = None):
+  rate = count / elapsed
+  if baseline:
+    print("%-32s %12.0f lines/s  (%.2fx)" % (name, rate, rate / baseline))
+  else:
+    print("%-32s %12.0f lines/s" % (name, rate))
+  return rate
+
+def benchmark_framing(args):
+  """Compares the framing engine against the original reduce/lambda implementation"""
+  cmds = protocolBenchmark.syntheticMoves(args.lines)
+
+  def legacyFrame(position, cmd):
+    data = b"N%d%s"    % (position, cmd)
+    return b"N%d%s*%d" % (position, cmd, functools.reduce(lambda x,y: x^y, list(data)))
+
+  start = time.perf_counter()
+  legacy = [legacyFrame(pos, cmd) for pos, cmd in enumerate(cmds, 1)]
+  baseline = report("reduce/lambda (original)", len(cmds), time.perf_counter() - start)
+
+  start = time.perf_counter()
+  framed = [gcodeFramer.frameCmd(pos, cmd) for pos, cmd in enumerate(cmds, 1)]
+  report("frameCmd", len(cmds), time.perf_counter() - start, baseline)
+
+  start = time.perf_counter()
+  batched = []
+  for i in range(0, len(cmds), 256):
+    batched.extend(gcodeFramer.frameCmds(i + 1, cmds[i:i+256]))
+  report("frameCmds, batches of 256", len(cmds), time.perf_counter() - start, baseline)
+
+  start = time.perf_counter()
+  pipelined = [frame for pos, frame in GCodeFramingPipeline(cmds)]
+  report("GCodeFramingPipeline", len(cmds), time.perf_counter() - start, baseline)
+
+  assert legacy == framed == batched == pipelined
+
+def benchmark_pacing(args):
+  """Compares burst pacing strategies on a FakeMarlinSerialDevice at several error rates"""
+  cmds = protocolBenchmark.syntheticMoves(args.lines)
+  for errors in args.errors:
+    print("Corrupting %s lines written:" % ("1 out of %d" % errors if errors else "no"))
+    fixed    = protocolBenchmark.runBenchmark(cmds, errors, args.bufsize, seed = args.seed, linkBaud = args.baud, pacingStrategy = FixedPacing())
+    adaptive = protocolBenchmark.runBenchmark(cmds, errors, args.bufsize, seed = args.seed, linkBaud = args.baud, pacingStrategy = AdaptivePacing())
+    baseline = report("  FixedPacing", len(cmds), fixed["seconds"])
+    report("  AdaptivePacing", len(cmds), adaptive["seconds"], baseline)
+
+def send_through_decoding_fake(gcode, compactor):
+  sio   = FakeMarlinSerialDevice(decode = True)
+  proto = MarlinSerialProtocol(sio)
+  for position, frame in GCodeFramingPipeline(gcode, proto.history.getAppendPosition(), compactor = compactor):
+    proto.sendCmdFramed(position, frame)
+    while(not proto.clearToSend()):
+      proto.readline()
+  return sio
+
+def benchmark_encoding(args):
+  """Measures the bytes per move sent to a decoding FakeMarlinSerialDevice, with and without compaction"""
+  gcode   = protocolBenchmark.syntheticArcs(args.lines)
+  plain   = send_through_decoding_fake(gcode, None)
+  compact = send_through_decoding_fake(gcode, GCodeCompactor())
+  for name, sio in (("Plain", plain), ("GCodeCompactor", compact)):
+    bytesPerMove = float(sio.cumulativeBytes) / sio.moves
+    print("%-32s %8.1f bytes/move  %8.0f moves/s at %d baud" % (name, bytesPerMove, args.baud / 10 / bytesPerMove, args.baud))
+  print("Reduction:                       %8.1f%%" % (100 - 100.0 * compact.cumulativeBytes / plain.cumulativeBytes))
+  for axis in GCodeModalState.AXES:
+    print("Final %s: %12.4f plain, %12.4f compacted" % (axis, plain.state.position[axis], compact.state.position[axis]))
+
+def benchmark_throughput(args):
+  """Runs the protocol benchmark over a matrix of corpora, error rates and buffer sizes"""
+  print("%-10s %6s %4s %10s %10s %8s %8s %10s" % ("corpus", "errors", "buf", "lines/s", "cpu us/ln", "resends", "depth", "starved s"), end='')
+  print(" %10s %10s" % ("sim s", "underrun s") if args.baud else "")
+  def onResult(r):
+    print("%-10s %6s %4d %10.0f %10.1f %8d %8.2f %10.3f" % (r["corpus"][-10:], r["errors"] or "-", r["bufSize"],
+      r["linesPerSecond"], r["cpuUsPerLine"], r["resends"], r["averageQueueDepth"], r["starvedSeconds"]), end='')
+    print(" %10.2f %10.2f" % (r["simulatedSeconds"], r["plannerUnderrunSeconds"]) if args.baud else "")
+    sys.stdout.flush()
+  noise = NoiseModel(dropRate = args.drop, duplicateRate = args.duplicate, truncateRate = args.truncate)
+  if args.burst:
+    noise.setBurst(*args.burst)
+  results = protocolBenchmark.runMatrix(args.corpus, args.lines, args.errors, args.bufsize, args.seed, onResult, args.baud, noise)
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+    print("Results written to %s" % args.output)
+
+def benchmark_replay(args):
+  """Replays recorded sessions against the current protocol implementation"""
+  print("%-20s %8s %12s %12s %10s %8s" % ("log", "lines", "recorded s", "replayed s", "lines/s", "resends"))
+  for log in args.log:
+    r = protocolBenchmark.runReplay(log)
+    print("%-20s %8d %12.2f %12.2f %10.0f %8d" % (log[-20:], r["lines"], r["recordedSeconds"], r["replayedSeconds"], r["linesPerSecond"], r["resends"]))
+
+def send_over_pty(gcode, bufSize, baud, coalesceWrites):
+  import serial
+  simulator = PtyMarlinSimulator(FakeMarlinSerialDevice(True, bufSize))
+  simulator.start()
+  sio   = serial.Serial(simulator.path, baud, timeout = 3)
+  proto = MarlinSerialProtocol(sio, coalesceWrites = coalesceWrites)
+  start = time.perf_counter()
+  for line in gcode:
+    proto.sendCmdReliable(line)
+    while(not proto.clearToSend()):
+      proto.readline()
+  while proto.marlinPendingCommands > 0:
+    proto.readline()
+  elapsed = time.perf_counter() - start
+  sio.close()
+  simulator.stop()
+  return elapsed
+
+def benchmark_writes(args):
+  """Compares writing and flushing every command against coalesced writes, through a pty"""
+  gcode = protocolBenchmark.syntheticMoves(args.lines)
+  for bufSize in args.bufsize:
+    print("BUFSIZE %d:" % bufSize)
+    baseline = report("  Write per command", len(gcode), send_over_pty(gcode, bufSize, args.baud, False))
+    report("  Coalesced writes", len(gcode), send_over_pty(gcode, bufSize, args.baud, True), baseline)
+
+def benchmark_watchdog(args):
+  """Counts false re-syncs forced by the stall watchdog when moves accelerate"""
+  gcode = protocolBenchmark.loadCorpus(args.corpus, args.lines)
+  # The previous model: every move at its nominal speed, with no minimum segment time
+  unlimited = dict((axis, float("inf")) for axis in GCodeModalState.AXES)
+  print("%-8s %-24s %10s %10s" % ("accel", "watchdog", "sim s", "resyncs"))
+  for acceleration in args.acceleration:
+    for name, watchdog in (("Nominal move times", AdaptiveWatchdog(acceleration = float("inf"), maxAccelerations = unlimited, minSegmentTime = 0, segmentMargin = 0)),
+                           ("AdaptiveWatchdog",   AdaptiveWatchdog(acceleration = acceleration))):
+      r = protocolBenchmark.runWatchdogBenchmark(gcode, watchdog, acceleration, bufSize = args.bufsize)
+      print("%-8d %-24s %10.2f %10d" % (acceleration, name, r["simulatedSeconds"], r["watchdogResyncs"]))
+      sys.stdout.flush()
+
+parser = argparse.ArgumentParser(description='''benchmarks components of the pyMarlin protocol stack.''')
+subparsers = parser.add_subparsers(dest='benchmark')
+subparsers.required = True
+
+framing = subparsers.add_parser('framing', help='Line number and checksum framing.')
+framing.add_argument('-n', '--lines', help='Number of lines to frame.', default=500000, type=int)
+framing.set_defaults(func=benchmark_framing)
+
+pacing = subparsers.add_parser('pacing', help='Burst pacing strategies on a fake Marlin.')
+pacing.add_argument('-n', '--lines',  help='Number of lines to send.', default=5000, type=int)
+pacing.add_argument('-e', '--errors', help='Corrupt 1 out N lines written; may be repeated.', default=[0, 1000, 100, 20], type=int, nargs='+')
+pacing.add_argument('-s', '--seed',   help='Random seed.', default=1, type=int)
+pacing.add_argument('-b', '--baud',   help='Transmit the bytes written at this baud rate, 0 for instantly.', default=250000, type=int)
+pacing.add_argument('-B', '--bufsize', help='Marlin BUFSIZE, reported through ADVANCED_OK.', default=16, type=int)
+pacing.set_defaults(func=benchmark_pacing)
+
+encoding = subparsers.add_parser('encoding', help='Bytes per move with and without GCodeCompactor.')
+encoding.add_argument('-n', '--lines', help='Number of moves to send.', default=20000, type=int)
+encoding.add_argument('-b', '--baud',  help='Baud rate used to compute moves per second.', default=250000, type=int)
+encoding.set_defaults(func=benchmark_encoding)
+
+throughput = subparsers.add_parser('throughput', help='Protocol throughput over a matrix of conditions, with JSON output.')
+throughput.add_argument('-c', '--corpus',  help='Synthetic corpus (%s) or gcode file; may be repeated.' % ", ".join(sorted(protocolBenchmark.CORPORA)), default=['moves', 'arcs'], nargs='+')
+throughput.add_argument('-n', '--lines',   help='Number of lines in synthetic corpora.', default=5000, type=int)
+throughput.add_argument('-e', '--errors',  help='Corrupt 1 out N lines written, 0 for none; may be repeated.', default=[0, 1000, 100], type=int, nargs='+')
+throughput.add_argument('-B', '--bufsize', help='Marlin BUFSIZE, reported through ADVANCED_OK; may be repeated.', default=[4, 8, 16], type=int, nargs='+')
+throughput.add_argument('-s', '--seed',    help='Random seed.', default=1, type=int)
+throughput.add_argument('-b', '--baud',    help='Simulate serial and planner timing at this baud rate.', type=int)
+throughput.add_argument('--burst',        help='Gilbert-Elliott bursts of corrupted lines written.', nargs=3, type=float, metavar=('ENTER', 'LEAVE', 'RATE'))
+throughput.add_argument('--drop',         help='Probability of dropping bytes from a line written.', default=0, type=float)
+throughput.add_argument('--duplicate',    help='Probability of writing a line twice.', default=0, type=float)
+throughput.add_argument('--truncate',     help='Probability of truncating a line written.', default=0, type=float)
+throughput.add_argument('-o', '--output',  help='Write results to this JSON file.')
+throughput.set_defaults(func=benchmark_throughput)
+
+writes = subparsers.add_parser('writes', help='Coalesced writes through a pty-backed fake Marlin (Linux only).')
+writes.add_argument('-n', '--lines',   help='Number of lines to send.', default=5000, type=int)
+writes.add_argument('-B', '--bufsize', help='Marlin BUFSIZE, reported through ADVANCED_OK; may be repeated.', default=[4, 16], type=int, nargs='+')
+writes.add_argument('-b', '--baud',    help='Baud rate for the serial port.', default=250000, type=int)
+writes.set_defaults(func=benchmark_writes)
+
+watchdog = subparsers.add_parser('watchdog', help='False re-syncs by the stall watchdog on a simulated Marlin with acceleration.')
+watchdog.add_argument('-c', '--corpus',       help='Synthetic corpus (%s) or gcode file.' % ", ".join(sorted(protocolBenchmark.CORPORA)), default='arcs')
+watchdog.add_argument('-n', '--lines',        help='Number of lines in synthetic corpora.', default=3000, type=int)
+watchdog.add_argument('-a', '--acceleration', help='Simulated acceleration in mm/s^2; may be repeated.', default=[3000, 500, 100], type=int, nargs='+')
+watchdog.add_argument('-B', '--bufsize',      help='Marlin BUFSIZE.', default=4, type=int)
+watchdog.set_defaults(func=benchmark_watchdog)
+
+replay = subparsers.add_parser('replay', help='Replays sessions recorded with "gcodeSender.py -l LOG --binlog".')
+replay.add_argument('log', help='Binary log of a session; may be repeated.', nargs='+')
+replay.set_defaults(func=benchmark_replay)
+
+args = parser.parse_args()
+args.func(args)
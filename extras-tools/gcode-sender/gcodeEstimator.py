@@ -0,0 +1,52 @@
+#!/usr/bin/python
+#
+# A tool to estimate how long GCODE files will take to print, using the
+# acceleration, junction deviation and feedrate limits of a printer's
+# build-config.py.
+#
+
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+from __future__ import print_function
+from pyMarlin   import *
+
+import argparse
+import os
+
+defaultConfig = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "config", "examples", "CocoaPress", "build-config.py")
+
+parser = argparse.ArgumentParser(description='''estimates the time taken to print gcode files.''')
+parser.add_argument('-c', '--config',   help='Read the printer limits from a build-config.py (defaults to that of the Cocoa Press).', default=defaultConfig)
+parser.add_argument('-p', '--printer',  help='Printer type in the build-config.py.')
+parser.add_argument('-t', '--toolhead', help='Toolhead type in the build-config.py.')
+parser.add_argument('-l', '--layers',   help='Print the time taken by each layer.', action='store_true')
+parser.add_argument('filename',         help='file containing gcode', nargs='+')
+args = parser.parse_args()
+
+def formatTime(seconds):
+  minutes, seconds = divmod(int(round(seconds)), 60)
+  hours,   minutes = divmod(minutes, 60)
+  return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+for filename in args.filename:
+  if os.path.exists(args.config):
+    estimator = PrintTimeEstimator.fromBuildConfig(args.config, args.printer, args.toolhead)
+  else:
+    estimator = PrintTimeEstimator()
+  total = estimator.estimateFile(filename)
+  print("%s: %s (%d moves, %.0f mm, %d layers)" % (filename, formatTime(total), estimator.blocks, estimator.distance, len(estimator.layers) - 1))
+  if estimator.untimed:
+    print("  Not including: %s" % ", ".join("%s x%d" % item for item in sorted(estimator.untimed.items())))
+  if args.layers:
+    for z, seconds in estimator.layerTimes():
+      print("  %-10s %10.1fs" % ("start" if z is None else "Z%g" % z, seconds))
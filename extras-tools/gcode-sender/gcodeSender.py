@@ -22,14 +22,14 @@ from __future__ import print_function
 from pyMarlin   import *
 
 import argparse
+import os
 import serial
 import random
 import sys
 
-def load_gcode(filename):
-  with open(filename, "r") as f:
-    gcode = f.readlines()
-  print("Read %d lines" % len(gcode))
+def load_gcode(filename, useMmap):
+  gcode = GCodeFileSource(filename, useMmap)
+  print("Streaming %d bytes" % gcode.size)
   return gcode
 
 def generate_synthetic_gcode():
@@ -40,33 +40,99 @@ def generate_synthetic_gcode():
     gcode.append(non_acting_gcodes[which])
   return gcode
 
-def send_gcode_test(filename, serial):
+def send_gcode_test(filename, serial, useMmap = False, compactor = None, framed = False, checkpoint = None, resumeFrom = None):
   if filename == "TEST":
     gcode = generate_synthetic_gcode()
+    progress = lambda i: i*100/len(gcode)
+  elif framed:
+    gcode = FramedFileSource(filename, useMmap)
+    progress = lambda i: gcode.progress()
   else:
-    gcode = load_gcode(filename)
+    gcode = load_gcode(filename, useMmap)
+    progress = lambda i: gcode.progress()
+
+  if resumeFrom:
+    # Skip straight to where the print left off, and restore the modal
+    # state, with the commands which do so just before the next line
+    print("Resuming after line %d, at byte %d" % (resumeFrom.position, resumeFrom.offset))
+    gcode.offset = resumeFrom.offset
+    resumeCmds   = resumeFrom.resumeCommands()
+    serial.restart(resumeFrom.position + 1 - len(resumeCmds))
+    for cmd in resumeCmds:
+      serial.sendCmdReliable(cmd)
+      while(not serial.clearToSend()):
+        serial.readline()
+
+  if framed:
+    # Frames were prepared ahead of time with --preframe
+    frames = gcode
+  else:
+    # Strip and frame commands ahead of time in a background thread
+    frames = GCodeFramingPipeline(gcode, serial.history.getAppendPosition(), compactor = compactor)
 
-  for i, line in enumerate(gcode):
-    serial.sendCmdReliable(line)
+  for i, (position, frame) in enumerate(frames):
+    serial.sendCmdFramed(position, frame)
+    if checkpoint:
+      checkpoint.onQueued(position, frame, frames.offset)
     while(not serial.clearToSend()):
       serial.readline()
+    if checkpoint:
+      checkpoint.onAcknowledged(serial.lastLineAcknowledged())
 
     if(i % 1000 == 0):
-      print("Progress: %d" % (i*100/len(gcode)), end='\r')
+      print("Progress: %d" % progress(i), end='\r')
       sys.stdout.flush()
 
+  if checkpoint:
+    # The print is complete once Marlin acknowledges every line
+    while(serial.marlinPendingCommands > 0):
+      serial.readline()
+    checkpoint.onAcknowledged(serial.lastLineAcknowledged())
+    checkpoint.close()
+
 parser = argparse.ArgumentParser(description='''sends gcode to a printer while injecting errors to test error recovery.''')
 parser.add_argument('-p', '--port',       help='Serial port.', default='/dev/ttyACM1')
 parser.add_argument('-f', '--fake',       help='Use a fake Marlin simulation instead of serial port, for self-testing.', action='store_false', dest='port')
 parser.add_argument('-e', '--errors',     help='Corrupt 1 out N lines written to exercise error recovery.', default='0', type=int)
 parser.add_argument('-r', '--readerrors', help='Corrupt 1 out N lines read to exercise error recovery.', default='0', type=int)
+parser.add_argument('-s', '--seed',       help='Random seed for the injected errors, to make them reproducible.', type=int)
+parser.add_argument('--burst',            help='Inject Gilbert-Elliott bursts of errors into lines written.', nargs=3, type=float, metavar=('ENTER', 'LEAVE', 'RATE'))
 parser.add_argument('-l', '--log',        help='Write log file.')
+parser.add_argument('--binlog',           help='Write the log file in the compact binary format.', action='store_true')
+parser.add_argument('--logsize',          help='Rotate the log file once it grows beyond this many megabytes.', default=0, type=int)
+parser.add_argument('-m', '--mmap',       help='Memory-map the gcode file rather than reading it.', action='store_true')
+parser.add_argument('-x', '--rxbuffer',   help='Size of Marlin\'s RX_BUFFER_SIZE, to enable byte counting flow control.', type=int)
+parser.add_argument('-c', '--compact',    help='Compact moves by dropping redundant parameters and excess precision.', action='store_true')
+parser.add_argument('--preframe',         help='Strip and frame the gcode into this file, to be sent later with --framed, rather than sending it.', metavar='OUTPUT')
+parser.add_argument('--framed',           help='The gcode file was written by --preframe.', action='store_true')
+parser.add_argument('--cache',            help='Keep framed copies of gcode files in a cache, to start repeat jobs instantly.', action='store_true')
+parser.add_argument('--cachedir',         help='Directory of the cache, instead of ~/.cache/pyMarlin/framed.')
+parser.add_argument('--cachesize',        help='Maximum size of the cache in megabytes.', default=1024, type=int)
+parser.add_argument('--coalesce',         help='Gather the commands of each burst into a single write.', action='store_true')
+parser.add_argument('--autoreport',       help='Ask Marlin to report temperatures every this many seconds, and show them.', type=int)
+parser.add_argument('--stats',            help='Write link statistics to this file, in the Prometheus text format if it ends in .prom, else as JSON.')
+parser.add_argument('--checkpoint',       help='Save the progress of the print to this file, so that it can be resumed.', metavar='FILE')
+parser.add_argument('--resume',           help='Resume the print from the file given with --checkpoint.', action='store_true')
 parser.add_argument('-b', '--baud',       help='Sets the baud rate for the serial port.', default='115000', type=int)
 parser.add_argument('filename',           help='file containing gcode, or TEST for synthetic non-printing GCODE')
 args = parser.parse_args()
 
+if (args.checkpoint or args.resume) and args.filename == "TEST":
+  parser.error("--checkpoint and --resume require a gcode file")
+if args.resume and not args.checkpoint:
+  parser.error("--resume requires --checkpoint")
+
 print()
 
+if args.preframe:
+  gcode = generate_synthetic_gcode() if args.filename == "TEST" else load_gcode(args.filename, args.mmap)
+  count = writeFramedFile(gcode, args.preframe, compactor = GCodeCompactor() if args.compact else None)
+  print("Wrote %d frames to %s" % (count, args.preframe))
+  sys.exit()
+
+if args.seed is not None:
+  random.seed(args.seed)
+
 if args.port:
   print("Serial port: ", args.port)
   print("Baud rate:   ", args.baud)
@@ -77,17 +143,22 @@ else:
 
 if args.readerrors:
   print("1 out of %d lines read will be corrupted." % args.readerrors)
-  sio = NoisySerialConnection(sio)
+  sio = NoisySerialConnection(sio, args.seed)
   sio.setReadErrorRate(1, args.readerrors)
 
 if args.log:
   print("Writing log file: ", args.log)
-  sio = LoggingSerialConnection(sio, args.log)
+  sio = LoggingSerialConnection(sio, args.log, binary = args.binlog, maxBytes = args.logsize * 1024 * 1024)
 
+if args.errors or args.burst:
+  # Use a different seed from the reads, so write faults are not correlated with them
+  sio = NoisySerialConnection(sio, None if args.seed is None else args.seed + 1)
 if args.errors:
   print("1 out of %d lines written will be corrupted." % args.errors)
-  sio = NoisySerialConnection(sio)
   sio.setWriteErrorRate(1, args.errors)
+if args.burst:
+  print("Bursts of errors will be injected into lines written.")
+  sio.writeModel.setBurst(*args.burst)
 
 print()
 
@@ -95,7 +166,56 @@ def onResendCallback(line):
   print("Resending from: %d" % (line))
 def onNotificationCallback(status):
   print(status)
-
-proto = MarlinSerialProtocol(sio, onResendCallback, onNotificationCallback)
-send_gcode_test(args.filename, proto)
+lastTemperatureReport = [0]
+def onTemperatureReport(report):
+  # Replies to M105 are reported too, so show at most one per interval
+  if report.time - lastTemperatureReport[0] < args.autoreport:
+    return
+  lastTemperatureReport[0] = report.time
+  print("Temperatures: %s" % " ".join("%s:%.1f/%s" % (sensor, actual, "%.1f" % target if target is not None else "-")
+    for sensor, (actual, target) in sorted(report.temperatures.items())))
+
+compactor = GCodeCompactor() if args.compact else None
+if args.cache and args.filename != "TEST" and not args.framed:
+  cache = FramedGCodeCache(args.cachedir, args.cachesize * 1024 * 1024)
+  args.filename, hit = cache.get(args.filename, compactor)
+  args.framed = args.mmap = True
+  print("%s framed copy: %s" % ("Using cached" if hit else "Cached new", args.filename))
+
+stats = ProtocolStats() if args.stats else None
+telemetry = MarlinTelemetry()
+telemetry.subscribe(TemperatureReport, onTemperatureReport)
+proto = MarlinSerialProtocol(sio, onResendCallback, onNotificationCallback, rxBufferSize = args.rxbuffer, stats = stats, coalesceWrites = args.coalesce,
+                             telemetry = telemetry if args.autoreport else None)
+proto.queryCapabilities()
+if args.autoreport:
+  proto.setAutoReport(args.autoreport)
+
+resumeFrom = None
+if args.resume:
+  try:
+    resumeFrom = PrintCheckpoint.load(args.checkpoint)
+  except (OSError, ValueError) as e:
+    # Missing or corrupt, or the file being printed has changed
+    sys.exit("Cannot resume from %s: %s" % (args.checkpoint, e))
+  if resumeFrom.filename != os.path.realpath(args.filename):
+    sys.exit("The checkpoint is for %s, not %s" % (resumeFrom.filename, args.filename))
+  if resumeFrom.position < len(resumeFrom.resumeCommands()):
+    print("The print had barely started, restarting it")
+    resumeFrom = None
+  elif compactor:
+    resumeFrom.restoreState(compactor.state)
+checkpoint = CheckpointWriter(args.filename, args.checkpoint, resumeFrom = resumeFrom) if args.checkpoint else None
+
+send_gcode_test(args.filename, proto, args.mmap, compactor, args.framed, checkpoint, resumeFrom)
+if checkpoint:
+  os.remove(args.checkpoint)
+  print("Print complete, removed %s" % args.checkpoint)
+print("Marlin command buffer size:       %d"   % proto.marlinBufSize)
+print("Average commands in flight:       %.2f" % proto.averageQueueDepth())
+if stats:
+  print("Median/99th percentile ok latency: %g/%g s" % (stats.latency.percentile(50), stats.latency.percentile(99)))
+  print("Writing statistics: ", args.stats)
+  with open(args.stats, "w") as f:
+    f.write(stats.toPrometheus(labels = {"port": args.port or "fake"}) if args.stats.endswith(".prom") else stats.toJSON())
 proto.close()
\ No newline at end of file
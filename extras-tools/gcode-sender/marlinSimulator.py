@@ -0,0 +1,61 @@
+#!/usr/bin/python
+#
+# A tool to simulate one or more Marlin printers on Linux pseudo-terminals,
+# so that host software can be tested end-to-end without any hardware.
+#
+# The path of each printer's pty is printed on startup; connect to it as
+# to any serial port, e.g. "gcodeSender.py -p /dev/pts/5 TEST".
+#
+
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+from __future__ import print_function
+from pyMarlin   import *
+
+import argparse
+import sys
+import time
+
+parser = argparse.ArgumentParser(description='''simulates Marlin printers on pseudo-terminals.''')
+parser.add_argument('-n', '--printers',   help='Number of printers to simulate.', default=1, type=int)
+parser.add_argument('-a', '--advancedok', help='Acknowledge commands as Marlin does with ADVANCED_OK enabled.', action='store_true')
+parser.add_argument('-B', '--bufsize',    help='Size of the simulated Marlin command buffer.', default=4, type=int)
+parser.add_argument('-b', '--baud',       help='Simulate serial and planner timing at this baud rate, rather than replying instantly.', type=int)
+args = parser.parse_args()
+
+def makeDevice():
+  if args.baud:
+    return SimulatedMarlinSerialDevice(args.baud, args.bufsize, advancedOk = args.advancedok)
+  else:
+    return FakeMarlinSerialDevice(args.advancedok, args.bufsize)
+
+simulators = [PtyMarlinSimulator(makeDevice()) for i in range(args.printers)]
+for simulator in simulators:
+  simulator.start()
+  print(simulator.path)
+sys.stdout.flush()
+
+try:
+  while all(simulator.thread.is_alive() for simulator in simulators):
+    time.sleep(1)
+except KeyboardInterrupt:
+  pass
+
+print()
+for simulator in simulators:
+  simulator.stop()
+  if simulator.error:
+    print("%s: failed: %s" % (simulator.path, simulator.error))
+  elif simulator.device.cumulativeWrites:
+    print("%s:" % simulator.path)
+    simulator.device.close()
@@ -1,7 +1,23 @@
+from pyMarlin.loggingSerialConnection import LoggingSerialConnection, readSerialLog
+from pyMarlin.noisySerialConnection   import NoisySerialConnection, NoiseModel
 from pyMarlin.loggingSerialConnection import LoggingSerialConnection
-from pyMarlin.noisySerialConnection   import NoisySerialConnection
-from pyMarlin.loggingSerialConnection import LoggingSerialConnection
-from pyMarlin.marlinSerialProtocol    import MarlinSerialProtocol
-from pyMarlin.fakeMarlinSerialDevice  import FakeMarlinSerialDevice
+from pyMarlin.marlinSerialProtocol    import MarlinSerialProtocol, GCodeHistory, GCodeHistoryError
+from pyMarlin.fakeMarlinSerialDevice  import FakeMarlinSerialDevice, SimulatedMarlinSerialDevice, ReplayMarlinSerialDevice
+from pyMarlin.gcodeFileSource         import GCodeFileSource, FramedFileSource
+from pyMarlin.gcodeFramer             import GCodeFramingPipeline, writeFramedFile
+from pyMarlin.pacingStrategy          import FixedPacing, AdaptivePacing
+from pyMarlin.stallWatchdog           import FixedWatchdog, AdaptiveWatchdog
+from pyMarlin.protocolStats           import ProtocolStats, LatencyHistogram
+from pyMarlin.commandScheduler        import CommandScheduler
+from pyMarlin.marlinTelemetry         import MarlinTelemetry, TemperatureReport, PositionReport, EchoMessage
+from pyMarlin.printCheckpoint         import PrintCheckpoint, CheckpointWriter
+from pyMarlin.printTimeEstimator      import PrintTimeEstimator, loadBuildConfig
+from pyMarlin.asyncMarlinSerialProtocol import AsyncMarlinSerialProtocol
+from pyMarlin.printerFarm             import PrinterFarm, PreframedJob
+from pyMarlin.marlinReplyParser       import MarlinReply, parseReply
+from pyMarlin.gcodeCompactor          import GCodeCompactor, GCodeModalState
+from pyMarlin.protocolBenchmark       import runBenchmark, runMatrix, runReplay, runWatchdogBenchmark
+from pyMarlin.ptyMarlinSimulator      import PtyMarlinSimulator
+from pyMarlin.framedGCodeCache        import FramedGCodeCache
 
-__all__ = ['LoggingSerialConnection','NoisySerialConnection','MarlinSerialProtocol','FakeMarlinSerialDevice']
+__all__ = ['LoggingSerialConnection','readSerialLog','NoisySerialConnection','NoiseModel','MarlinSerialProtocol','GCodeHistory','GCodeHistoryError','FakeMarlinSerialDevice','SimulatedMarlinSerialDevice','ReplayMarlinSerialDevice','GCodeFileSource','FramedFileSource','GCodeFramingPipeline','writeFramedFile','FixedPacing','AdaptivePacing','FixedWatchdog','AdaptiveWatchdog','ProtocolStats','LatencyHistogram','CommandScheduler','MarlinTelemetry','TemperatureReport','PositionReport','EchoMessage','PrintCheckpoint','CheckpointWriter','PrintTimeEstimator','loadBuildConfig','AsyncMarlinSerialProtocol','PrinterFarm','PreframedJob','MarlinReply','parseReply','GCodeCompactor','GCodeModalState','runBenchmark','runMatrix','runReplay','runWatchdogBenchmark','PtyMarlinSimulator','FramedGCodeCache']
@@ -0,0 +1,197 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# MarlinSerialProtocol only sends commands from within readline() and
+# clearToSend(), so an "ok" which arrives while the caller is busy
+# elsewhere leaves the Marlin buffer unfilled until the next call.
+#
+# The class AsyncMarlinSerialProtocol runs the same protocol on an
+# asyncio event loop, with a reader task which parses replies as soon as
+# they arrive and a writer task which refills the Marlin buffer as soon
+# as capacity frees up. Since pyserial is synchronous, the blocking
+# serial reads, including those which purge the input after a resend
+# request, and all writes are done in the loop's default executor; all
+# protocol state is only ever touched from the event loop thread.
+#
+# Commands are gathered as they are sent, as for coalesced writes, and
+# then written out by _flushWrites(). A lock is held while writing and
+# while purging and rewinding after a resend request, so that no new
+# commands are written while the reader is rewinding.
+#
+# The prototypical use case for this class is as follows:
+#
+#   proto = AsyncMarlinSerialProtocol(serial)
+#   proto.start()
+#   for line in gcode:
+#     await proto.sendCmdReliable(line)
+#   await proto.close()
+#
+
+import asyncio
+
+from pyMarlin.marlinSerialProtocol import MarlinSerialProtocol
+from pyMarlin.commandScheduler     import CommandScheduler
+
+class AsyncMarlinSerialProtocol(MarlinSerialProtocol):
+  """This class implements the Marlin serial protocol with independent
+  reader and writer tasks. The send methods are awaitables; replies from
+  Marlin can be retrieved with readline(). At most maxReplies replies are
+  retained for readline(), older ones are discarded."""
+  def __init__(self, serial, onResendCallback=None, onDebugMsgCallback=None, pacingStrategy=None, rxBufferSize=None, maxReplies=100, watchdog=None, stats=None, scheduler=None, coalesceWrites=False, telemetry=None):
+    MarlinSerialProtocol.__init__(self, serial, onResendCallback, onDebugMsgCallback, pacingStrategy, rxBufferSize, watchdog, stats, scheduler, coalesceWrites, telemetry)
+    self.maxReplies = maxReplies
+    self.tasks      = []
+
+  def start(self):
+    """Starts the reader and writer tasks. Must be called from within the event loop."""
+    self.loop        = asyncio.get_running_loop()
+    self.changed     = asyncio.Condition()
+    self.serialLock  = asyncio.Lock()
+    self.replies     = asyncio.Queue(self.maxReplies)
+    self.writeBuffer = []
+    self.tasks      = [
+      self.loop.create_task(self._reader()),
+      self.loop.create_task(self._writer())
+    ]
+
+  async def _notify(self):
+    async with self.changed:
+      self.changed.notify_all()
+
+  async def _waitFor(self, predicate):
+    async with self.changed:
+      await self.changed.wait_for(predicate)
+
+  def _hasCommandsToSend(self):
+    return self.scheduler.pending() or not self.history.atEnd()
+
+  async def _reader(self):
+    """Parses replies from Marlin as soon as they arrive"""
+    while True:
+      if self.readTimeout:
+        self._limitReadTimeout()
+      line  = await self.loop.run_in_executor(None, self.serial.readline)
+      reply = self._parseReply(line)
+      async with self.serialLock:
+        line = await self._handleReplyAsync(reply)
+        await self._flushWrites()
+      if line:
+        if self.replies.full():
+          self.replies.get_nowait()
+        self.replies.put_nowait(line)
+      await self._notify()
+
+  def _readWaiting(self):
+    """Reads a line if one is waiting, otherwise returns b''. Runs in the executor."""
+    return self.serial.readline() if self.serial.in_waiting else b""
+
+  async def _handleReplyAsync(self, reply):
+    """Does what MarlinSerialProtocol._handleReply() does, reading in the executor"""
+    line = reply.line
+    self._stallWatchdog(line)
+    resendPos = reply.resendPosition
+    if resendPos:
+      # Purge lines until the input buffer is empty, acting only on the last resend request
+      while line != b"":
+        reply = self._parseReply(await self.loop.run_in_executor(None, self._readWaiting))
+        line  = reply.line
+        resendPos = reply.resendPosition or resendPos
+      self._handleResend(resendPos)
+      line = b""
+    return line
+
+  def _startCoalescing(self):
+    pass # Commands are always gathered, and written by _flushWrites()
+
+  def _writeCoalesced(self):
+    pass
+
+  def _write(self, data):
+    """Writes and flushes data. Runs in the executor."""
+    self.serial.write(data)
+    self.serial.flush()
+
+  async def _flushWrites(self):
+    """Writes out the commands gathered since the last call. The caller must hold serialLock."""
+    if self.writeBuffer:
+      data = b'\n'.join(self.writeBuffer) + b'\n'
+      self.writeBuffer = []
+      await self.loop.run_in_executor(None, self._write, data)
+
+  async def _writer(self):
+    """Refills the Marlin buffer as soon as capacity frees up"""
+    while True:
+      await self._waitFor(self._canSendNext)
+      async with self.serialLock:
+        while True:
+          cls = self._sendNext()
+          if cls is None:
+            break
+          if not self.coalesceWrites:
+            await self._flushWrites()
+            if cls == CommandScheduler.PRINT and self.marlinBufferCapacity() > 0:
+              await self.loop.run_in_executor(None, self.pacingStrategy.pace, self.serial)
+        await self._flushWrites()
+      await self._notify()
+
+  async def sendCmdReliable(self, line):
+    """Adds command line (can contain comments or blanks) to the queue for reliable
+       transmission and waits until it has been sent to Marlin."""
+    MarlinSerialProtocol.sendCmdReliable(self, line)
+    await self._notify()
+    await self._waitFor(self.history.atEnd)
+
+  async def sendCmdFramed(self, position, frame):
+    """Adds an already framed command to the queue for reliable transmission and
+       waits until it has been sent to Marlin."""
+    MarlinSerialProtocol.sendCmdFramed(self, position, frame)
+    await self._notify()
+    await self._waitFor(self.history.atEnd)
+
+  async def sendCmdUnreliable(self, line, priority=CommandScheduler.INTERACTIVE, key=None, force=False):
+    """Sends a command without a checksum, interleaved with the history commands
+       according to its priority, and waits until no such commands remain queued.
+       Returns False if the command was dropped because too many were queued."""
+    if not MarlinSerialProtocol.sendCmdUnreliable(self, line, priority, key, force):
+      return False
+    await self._notify()
+    await self._waitFor(lambda: not self.scheduler.pending())
+    return True
+
+  async def queryCapabilities(self):
+    """Sends a M115 to ask Marlin to report its capabilities"""
+    await self.sendCmdUnreliable(b"M115", force=True)
+
+  async def setAutoReport(self, interval):
+    """Asks Marlin to report temperatures every interval seconds, or to stop if interval is 0"""
+    await self.sendCmdUnreliable(b"M155 S%d" % interval, force=True)
+
+  async def sendCmdEmergency(self, line):
+    """Sends a command immediately, without regards for Marlin buffer."""
+    async with self.serialLock:
+      MarlinSerialProtocol.sendCmdEmergency(self, line)
+      await self._flushWrites()
+
+  async def readline(self):
+    """Waits for and returns the next reply from Marlin."""
+    return await self.replies.get()
+
+  async def drain(self):
+    """Waits until all queued commands have been sent to Marlin."""
+    await self._waitFor(lambda: not self._hasCommandsToSend())
+
+  async def close(self):
+    for task in self.tasks:
+      task.cancel()
+    await asyncio.gather(*self.tasks, return_exceptions=True)
+    self.tasks = []
+    self.serial.close()
@@ -0,0 +1,158 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# MarlinSerialProtocol interleaves three classes of traffic: interactive
+# commands from a UI (jogs, setpoints), telemetry queries (M105, M114)
+# and the print itself. The command scheduler decides which class is
+# sent next, so that neither a UI flooding commands can starve the print
+# nor a print can hold up interactive commands for long.
+#
+# Each class gets a turn in order, and may send up to its quota of
+# commands before yielding to the next class which has something to
+# send. Classes with nothing to send are skipped, so the link is never
+# left idle. Interactive commands go first, so they wait for at most the
+# quotas of the other classes.
+#
+# Interactive and telemetry commands are queued here; the print stream
+# stays in the GCodeHistory, since it must be replayed on resends. Each
+# queue holds at most limit commands, except for commands pushed with
+# force, such as configuration commands which must not be lost. A
+# command may carry a key, and
+# replaces any queued command of its class with the same key, keeping
+# its place in the queue, so that only the latest jog target or setpoint
+# reaches Marlin. Temperature and fan setpoints and status queries are
+# keyed automatically. Commands which have waited longer than the
+# deadline of their class are discarded rather than sent late; a command
+# which replaced another is counted as having waited since that one was
+# queued.
+
+import collections
+import time
+
+from pyMarlin.gcodeCompactor import parseCmd
+
+class CommandScheduler:
+  """Schedules interactive, telemetry and print commands by weighted round
+     robin. The quotas, limits and deadlines (in seconds, or None) of each
+     class can be overridden by passing dictionaries keyed by class."""
+  INTERACTIVE = "interactive"
+  TELEMETRY   = "telemetry"
+  PRINT       = "print"
+
+  # Commands which supersede earlier ones with the same group and values of the given parameters
+  COALESCE = {
+    b"M104": (b"hotend",   "T"),
+    b"M140": (b"bed",      ""),
+    b"M141": (b"chamber",  ""),
+    b"M106": (b"fan",      "P"),
+    b"M107": (b"fan",      "P"),
+    b"M220": (b"feedrate", ""),
+    b"M221": (b"flow",     "T"),
+    b"M105": (b"M105",     ""),
+    b"M114": (b"M114",     ""),
+    b"M119": (b"M119",     ""),
+    b"M27":  (b"M27",      "")
+  }
+
+  def __init__(self, quotas = None, limits = None, deadlines = None):
+    self.order     = (self.INTERACTIVE, self.TELEMETRY, self.PRINT)
+    self.quotas    = {self.INTERACTIVE: 4, self.TELEMETRY: 1, self.PRINT: 4}
+    self.limits    = {self.INTERACTIVE: 32, self.TELEMETRY: 8}
+    self.deadlines = {self.INTERACTIVE: None, self.TELEMETRY: 5}
+    self.quotas.update(quotas or {})
+    self.limits.update(limits or {})
+    self.deadlines.update(deadlines or {})
+    self.queues    = dict((cls, collections.deque()) for cls in self.limits)
+    self.keyed     = dict((cls, {}) for cls in self.limits) # key -> queued entry
+    self.turn      = 0
+    self.used      = 0
+    self.dropped   = collections.Counter()
+    self.coalesced = collections.Counter()
+    self.expired   = collections.Counter()
+
+  def _key(self, cmd):
+    code, params = parseCmd(cmd)
+    if code in self.COALESCE:
+      group, letters = self.COALESCE[code]
+      return (group,) + tuple(params.get(letter) for letter in letters)
+    return None
+
+  def push(self, cmd, cls = INTERACTIVE, key = None, force = False):
+    """Queues a command, replacing any queued command of the same class with the
+       same key. If no key is given, one is derived for setpoints and queries.
+       Returns False if the command was dropped because the queue was full,
+       which never happens if force is set."""
+    key   = key or self._key(cmd)
+    entry = self.keyed[cls].get(key) if key else None
+    if entry:
+      # Keep the time it was queued, so that the queue stays in order for _expire()
+      entry[0] = cmd
+      self.coalesced[cls] += 1
+      return True
+    if len(self.queues[cls]) >= self.limits[cls] and not force:
+      self.dropped[cls] += 1
+      return False
+    entry = [cmd, time.time(), key]
+    self.queues[cls].append(entry)
+    if key:
+      self.keyed[cls][key] = entry
+    return True
+
+  def _popEntry(self, cls):
+    entry = self.queues[cls].popleft()
+    if entry[2] and self.keyed[cls].get(entry[2]) is entry:
+      del self.keyed[cls][entry[2]]
+    return entry
+
+  def _expire(self, cls):
+    deadline = self.deadlines.get(cls)
+    if deadline is not None:
+      queue = self.queues[cls]
+      while queue and time.time() - queue[0][1] > deadline:
+        self._popEntry(cls)
+        self.expired[cls] += 1
+
+  def _hasWork(self, cls, printReady):
+    if cls == self.PRINT:
+      return printReady
+    self._expire(cls)
+    return len(self.queues[cls]) > 0
+
+  def nextClass(self, printReady):
+    """Returns the class which should send next, or None if there is nothing
+       to send. printReady tells whether the print has commands waiting."""
+    for i in range(len(self.order) + 1):
+      cls = self.order[self.turn]
+      if self.used < self.quotas[cls] and self._hasWork(cls, printReady):
+        return cls
+      self.turn = (self.turn + 1) % len(self.order)
+      self.used = 0
+    return None
+
+  def peek(self, cls):
+    return self.queues[cls][0][0]
+
+  def pop(self, cls):
+    return self._popEntry(cls)[0]
+
+  def charge(self, cls):
+    """Counts a command sent by cls against its quota"""
+    self.used += 1
+
+  def pending(self):
+    """Returns the number of queued interactive and telemetry commands"""
+    return sum(len(queue) for queue in self.queues.values())
+
+  def clear(self):
+    for cls in self.queues:
+      self.queues[cls].clear()
+      self.keyed[cls].clear()
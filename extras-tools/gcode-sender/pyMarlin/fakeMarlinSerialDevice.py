@@ -10,19 +10,41 @@
 # FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
 #
 
+import collections
 import functools
+import heapq
+import math
 import random
 import string
 import re
+import time
+
+from pyMarlin.gcodeCompactor          import parseCmd, GCodeModalState
+from pyMarlin.printTimeEstimator      import trapezoidTime
+from pyMarlin.loggingSerialConnection import readSerialLog, SENT, RECEIVED
 
 class FakeMarlinSerialDevice:
   """This serial class simply pretends to be Marlin by acknowledging
      commands with "ok" and requesting commands to be resent if they
-     contain errors"""
+     contain errors. If advancedOk is set, it acknowledges commands as
+     Marlin does with ADVANCED_OK enabled, reporting free slots of a
+     command buffer of bufSize commands. If decode is set, it tracks
+     the modal state of the machine (position, feedrate and modes) in
+     state, which allows checking that differently encoded GCODE moves
+     the machine in the same way. If baudrate is set, bytes written are
+     drained from an unbounded transmit buffer at that rate in real time,
+     and out_waiting reports how many remain, as a serial port does. The
+     replies to a command can only be read once it has been transmitted."""
 
-  def __init__(self):
+  def __init__(self, advancedOk = False, bufSize = 4, decode = False, baudrate = None):
+    self.advancedOk     = advancedOk
+    self.bufSize        = bufSize
+    self.baudrate       = baudrate
+    self.outputFreeAt   = 0.0 # When the transmit buffer will be empty
+    self.state          = GCodeModalState() if decode else None
+    self.moves          = 0
     self.line           = 1
-    self.replies        = []
+    self.replies        = [] # (time due, reply)
     self.pendingOk      = 0
     self.dropCharacters = 0
 
@@ -30,15 +52,20 @@ class FakeMarlinSerialDevice:
     self.cumulativeWrites    = 0
     self.cumulativeQueueSize = 0
     self.cumulativeErrors    = 0
+    self.cumulativeBytes     = 0
 
   def _enqueue_reply(self, str):
     if str.startswith("ok"):
       self.pendingOk += 1
-    self.replies.append(str + '\n')
+    self.replies.append((self.outputFreeAt, str + '\n'))
 
   def _dequeue_reply(self):
     if len(self.replies):
-      reply = self.replies.pop(0)
+      due, reply = self.replies.pop(0)
+      wait = due - time.time()
+      if wait > 0:
+        # Wait for the command to be transmitted, as a blocking read would
+        time.sleep(wait)
       if reply.startswith("ok"):
         self.pendingOk -= 1
       return reply
@@ -46,19 +73,68 @@ class FakeMarlinSerialDevice:
       return ''
 
   def _enqueue_okay(self):
-    self._enqueue_reply("ok T:10")
+    if self.advancedOk:
+      # Commands are executed as soon as they are received, so the
+      # command buffer is always empty when the "ok" is sent.
+      self._enqueue_reply("ok N%d P15 B%d" % (self.line - 1, self.bufSize))
+    else:
+      self._enqueue_reply("ok T:10")
+
+  def _enqueue_capabilities(self):
+    self._enqueue_reply("FIRMWARE_NAME:Marlin (FakeMarlinSerialDevice)")
+    self._enqueue_reply("Cap:ADVANCED_OK:%d" % self.advancedOk)
+
+  def _decode(self, cmd):
+    """Updates the modal state of the machine following a valid command"""
+    if self.state:
+      code, params = parseCmd(cmd)
+      if code in GCodeModalState.MOVES:
+        self.moves += 1
+      self.state.update(code, params)
 
   def _computeChecksum(self, data):
     """Computes the GCODE checksum, this is the XOR of all characters in the payload, including the position"""
     return functools.reduce(lambda x,y: x^y, map(ord, data) if isinstance(data, str) else list(data))
 
+  def _checkLine(self, data):
+    """Checks a line with a line number and checksum. Returns the command if the
+       line is valid and properly sequenced, or None if it must be resent"""
+    # Handle M110 commands which tell Marlin to reset the line counter
+    m = re.match(b'N(\d+)M110\*(\d+)$', data)
+    if m:
+      self.line = int(m.group(1))
+
+    m = re.match(b'N(\d+)(\D[^*]*)\*(\d+)$', data)
+    if m and int(m.group(1)) == self.line and self._computeChecksum(b"N%d%s" % (self.line, m.group(2))) == int(m.group(3)):
+      # We have a valid, properly sequenced command with a valid checksum
+      self.line += 1
+      return m.group(2)
+
+  def _splitWrite(self, data):
+    """A coalesced write carries several commands. Returns True if data was
+       passed on to write() one line at a time."""
+    if isinstance(data, str):
+      data = data.encode()
+    lines = data.splitlines(True)
+    if len(lines) <= 1:
+      return False
+    for line in lines:
+      self.write(line)
+    return True
+
   def write(self, data):
+    if self._splitWrite(data):
+      return
     if isinstance(data, str):
       data = data.encode()
 
     if data.strip() == b"":
       return
 
+    self.cumulativeBytes += len(data)
+    if self.baudrate:
+      self.outputFreeAt = max(time.time(), self.outputFreeAt) + len(data) * 10.0 / self.baudrate
+
     if self.dropCharacters:
       data = data[self.dropCharacters:]
       self.dropCharacters = 0
@@ -67,18 +143,15 @@ class FakeMarlinSerialDevice:
     hasChecksum   = b"*" in data
 
     if not hasLineNumber and not hasChecksum:
+      if data.strip() == b"M115":
+        self._enqueue_capabilities()
+      self._decode(data.strip())
       self._enqueue_okay()
       return
 
-    # Handle M110 commands which tell Marlin to reset the line counter
-    m = re.match(b'N(\d+)M110\*(\d+)$', data)
-    if m:
-      self.line = int(m.group(1))
-
-    m = re.match(b'N(\d+)(\D[^*]*)\*(\d+)$', data)
-    if m and int(m.group(1)) == self.line and self._computeChecksum(b"N%d%s" % (self.line, m.group(2))) == int(m.group(3)):
-      # We have a valid, properly sequenced command with a valid checksum
-      self.line += 1
+    cmd = self._checkLine(data)
+    if cmd is not None:
+      self._decode(cmd)
     else:
       # Otherwise, request the command be resent
       self.cumulativeErrors += 1
@@ -101,6 +174,17 @@ class FakeMarlinSerialDevice:
     self.cumulativeReads      += 1
     return self._dequeue_reply().encode()
 
+  @property
+  def in_waiting(self):
+    now = time.time()
+    return sum(len(reply) for due, reply in self.replies if due <= now)
+
+  @property
+  def out_waiting(self):
+    if not self.baudrate:
+      return 0
+    return max(0, int((self.outputFreeAt - time.time()) * self.baudrate / 10.0))
+
   def flush(self):
     pass
 
@@ -111,3 +195,318 @@ class FakeMarlinSerialDevice:
     print("Total writes:                     %d"   % self.cumulativeWrites)
     print("Total errors:                     %d"   % self.cumulativeErrors)
     print()
+
+class SimulatedMarlinSerialDevice(FakeMarlinSerialDevice):
+  """This serial class pretends to be Marlin in simulated time, so that it
+     can tell whether the host keeps the planner fed. It models:
+
+       - The time taken to transmit each byte, in both directions, at baud.
+       - A command buffer of bufSize commands. Commands are moved into the
+         planner in order, and each one is acknowledged with "ok" once the
+         planner accepts it, as Marlin does.
+       - A planner of blockBufferSize blocks, of which, as in Marlin, one is
+         always kept free. Each move takes the time needed to travel its
+         distance at its feedrate. Other commands take no time. If
+         acceleration is given, each move instead accelerates from rest and
+         decelerates to rest, taking no less than minSegmentTime, which is
+         the slowest Marlin's planner would execute it.
+
+     The simulated clock also advances by the real time which the host spends
+     between calls, unless includeHostTime is False. Reading when no reply is
+     due advances the clock to the next reply, as a blocking read would, or
+     times out after timeout seconds if none is coming. The time during which
+     the planner ran dry between moves is accumulated in plannerUnderrun.
+     Corrupt lines are answered with a resend request, but no characters are
+     dropped and no spurious empty replies are generated."""
+
+  def __init__(self, baud = 250000, bufSize = 4, blockBufferSize = 16, advancedOk = False,
+               defaultFeedrate = 3000, timeout = 3, includeHostTime = True, acceleration = None, minSegmentTime = 0):
+    FakeMarlinSerialDevice.__init__(self, advancedOk, bufSize, decode = True, baudrate = baud)
+    self.acceleration     = acceleration
+    self.minSegmentTime   = minSegmentTime
+    self.byteTime         = 10.0 / baud
+    self.blockBufferSize  = blockBufferSize
+    self.defaultFeedrate  = defaultFeedrate
+    self.timeout          = timeout
+    self.includeHostTime  = includeHostTime
+
+    self.now              = 0.0
+    self.lastCall         = None
+    self.rxFreeAt         = 0.0  # When the host to Marlin link will be idle
+    self.txFreeAt         = 0.0  # When the Marlin to host link will be idle
+    self.parserFreeAt     = 0.0  # When the last command was accepted by the planner
+    self.queue            = collections.deque() # (arrival, line number, duration) of buffered commands
+    self.planner          = collections.deque() # End times of moves in the planner
+    self.lastMoveEnd      = None
+    self.plannerUnderrun  = 0.0
+    self.timedReplies     = []   # Heap of (time, sequence, reply)
+    self.sequence         = 0
+
+  def _startCall(self):
+    if self.includeHostTime and self.lastCall is not None:
+      self.now += time.perf_counter() - self.lastCall
+
+  def _endCall(self):
+    self.lastCall = time.perf_counter()
+
+  def _emit(self, when, reply):
+    """Transmits a reply to the host, starting no earlier than when"""
+    reply = reply.encode() + b"\n"
+    self.txFreeAt = max(when, self.txFreeAt) + len(reply) * self.byteTime
+    self.sequence += 1
+    heapq.heappush(self.timedReplies, (self.txFreeAt, self.sequence, reply))
+
+  def _emitOkay(self, when, line):
+    if self.advancedOk:
+      arrived  = [n for arrival, n, duration in self.queue if arrival <= when]
+      lastLine = max([n for n in arrived if n] or [line or self.line - 1])
+      self._emit(when, "ok N%d P%d B%d" % (lastLine, self.blockBufferSize - len(self.planner) - 1, self.bufSize - len(arrived)))
+    else:
+      self._emit(when, "ok")
+
+  def _executionTime(self, cmd):
+    """Updates the modal state and returns the time a command spends in the planner"""
+    code, params = parseCmd(cmd)
+    before = dict(self.state.position)
+    self.state.update(code, params)
+    if code not in GCodeModalState.MOVES:
+      return 0
+    self.moves += 1
+    after    = self.state.position
+    deltas   = [after[axis] - before[axis] for axis in "XYZ" if after[axis] is not None and before[axis] is not None]
+    distance = math.sqrt(sum(d * d for d in deltas))
+    if distance == 0 and after["E"] is not None and before["E"] is not None:
+      distance = abs(after["E"] - before["E"])
+    speed = (self.state.feedrate or self.defaultFeedrate) / 60.0
+    if self.acceleration and distance:
+      return max(trapezoidTime(distance, speed, self.acceleration), self.minSegmentTime)
+    return distance / speed
+
+  def _acceptTime(self):
+    """Returns when the command at the head of the buffer will be accepted by the planner"""
+    arrival, line, duration = self.queue[0]
+    accept = max(arrival, self.parserFreeAt)
+    if duration:
+      ends = [end for end in self.planner if end > accept]
+      if len(ends) >= self.blockBufferSize - 1:
+        accept = ends[len(ends) - self.blockBufferSize + 1]
+    return accept
+
+  def _advance(self, until):
+    """Moves buffered commands into the planner, up to the given time"""
+    while self.queue and self._acceptTime() <= until:
+      accept = self._acceptTime()
+      arrival, line, duration = self.queue.popleft()
+      self.parserFreeAt = accept
+      while self.planner and self.planner[0] <= accept:
+        self.planner.popleft()
+      if duration:
+        if self.planner:
+          start = self.planner[-1]
+        else:
+          start = accept
+          if self.lastMoveEnd is not None:
+            self.plannerUnderrun += accept - self.lastMoveEnd
+        self.lastMoveEnd = start + duration
+        self.planner.append(self.lastMoveEnd)
+      self._emitOkay(accept, line)
+
+  def write(self, data):
+    if self._splitWrite(data):
+      return
+    self._startCall()
+    if isinstance(data, str):
+      data = data.encode()
+    if data.strip() != b"":
+      self.cumulativeBytes  += len(data)
+      self.cumulativeWrites += 1
+      self.rxFreeAt = max(self.now, self.rxFreeAt) + len(data) * self.byteTime
+      if b"N" not in data and b"*" not in data:
+        cmd, line = data.strip(), None
+      else:
+        cmd, line = self._checkLine(data), self.line - 1
+      if cmd is None:
+        self.cumulativeErrors += 1
+        self._emit(self.rxFreeAt, "Resend: %d" % self.line)
+        self._emit(self.rxFreeAt, "ok")
+      else:
+        if cmd == b"M115":
+          self._emit(self.rxFreeAt, "FIRMWARE_NAME:Marlin (SimulatedMarlinSerialDevice)")
+          self._emit(self.rxFreeAt, "Cap:ADVANCED_OK:%d" % self.advancedOk)
+        self.queue.append((self.rxFreeAt, line, self._executionTime(cmd)))
+    self._endCall()
+
+  def readline(self):
+    self._startCall()
+    self.cumulativeReads += 1
+    self._advance(self.now)
+    while self.queue and not self.timedReplies:
+      self._advance(self._acceptTime())
+    if self.timedReplies and self.timedReplies[0][0] <= self.now + self.timeout:
+      when, sequence, reply = heapq.heappop(self.timedReplies)
+      self.now = max(self.now, when)
+    else:
+      self.now += self.timeout
+      reply = b""
+    self._endCall()
+    return reply
+
+  @property
+  def in_waiting(self):
+    self._startCall()
+    self._advance(self.now)
+    waiting = sum(len(reply) for when, sequence, reply in self.timedReplies if when <= self.now)
+    self._endCall()
+    return waiting
+
+  @property
+  def out_waiting(self):
+    if not self.includeHostTime:
+      # The clock will not advance while the host waits for the line to drain
+      return 0
+    self._startCall()
+    self._endCall()
+    return max(0, int((self.rxFreeAt - self.now) / self.byteTime))
+
+  def close(self):
+    print("Simulated time:                   %.2f s" % self.now)
+    print("Planner underrun:                 %.2f s" % self.plannerUnderrun)
+    print("Total moves:                      %d"     % self.moves)
+    print("Total writes:                     %d"     % self.cumulativeWrites)
+    print("Total errors:                     %d"     % self.cumulativeErrors)
+    print()
+
+class ReplayMarlinSerialDevice(FakeMarlinSerialDevice):
+  """This serial class plays back the replies of a real Marlin, as recorded
+     in a binary log written by LoggingSerialConnection, with their original
+     timing. This allows the host side to be measured against real-world
+     traffic, even after the protocol has changed, since:
+
+       - Each reply is delayed by the time it originally took to arrive
+         after the previous reply, or after the command which caused it,
+         whichever came later.
+       - Marlin cannot acknowledge a command it has not received yet, so
+         the n-th "ok" is not delivered until n commands have been written.
+
+     As in SimulatedMarlinSerialDevice, time is simulated: the clock jumps
+     ahead to the next reply when reading, and otherwise advances with the
+     real time spent by the host, unless includeHostTime is False. The lines
+     sent in the recorded session, stripped of their framing, are available
+     in recordedCommands as (cmd, reliable) tuples, in the order they were
+     first sent, so that they can be sent again."""
+
+  def __init__(self, filename, timeout = 3, includeHostTime = True):
+    FakeMarlinSerialDevice.__init__(self)
+    self.timeout          = timeout
+    self.includeHostTime  = includeHostTime
+    self.now              = 0.0
+    self.lastCall         = None
+    self.lastDelivery     = 0.0
+    self.writeTimes       = []
+    self.okays            = 0
+    self.recorded         = collections.deque() # (delay, isOkay, reply)
+    self.recordedCommands = []
+    self.recordedSeconds  = 0.0
+    self._load(filename)
+
+  def _load(self, filename):
+    seen       = set()
+    writeTimes = []
+    okays      = 0
+    start      = None
+    lastReply  = None
+    for timestamp, direction, data in readSerialLog(filename):
+      if start is None:
+        if direction != SENT:
+          continue # Time spent waiting before the session started
+        start = lastReply = timestamp
+      if direction == SENT:
+        # A coalesced write carries several commands
+        for line in data.splitlines():
+          if not line.strip():
+            continue
+          writeTimes.append(timestamp)
+          m = re.match(b'N(\d+)(\D[^*]*)\*\d+', line)
+          if not m:
+            self.recordedCommands.append((line.strip(), False))
+          elif m.group(2) != b"M110" and int(m.group(1)) not in seen:
+            seen.add(int(m.group(1)))
+            self.recordedCommands.append((m.group(2), True))
+      elif direction == RECEIVED and data:
+        isOkay = data.startswith(b"ok")
+        after  = lastReply
+        if isOkay and okays < len(writeTimes):
+          after = max(after, writeTimes[okays])
+        if isOkay:
+          okays += 1
+        self.recorded.append((max(0.0, timestamp - after), isOkay, data))
+        lastReply = timestamp
+      self.recordedSeconds = timestamp - start
+
+  def _startCall(self):
+    if self.includeHostTime and self.lastCall is not None:
+      self.now += time.perf_counter() - self.lastCall
+
+  def _endCall(self):
+    self.lastCall = time.perf_counter()
+
+  def _nextDue(self):
+    """Returns when the next reply is due, or None if it is waiting for a command"""
+    if not self.recorded:
+      return None
+    delay, isOkay, reply = self.recorded[0]
+    after = self.lastDelivery
+    if isOkay:
+      if self.okays >= len(self.writeTimes):
+        return None
+      after = max(after, self.writeTimes[self.okays])
+    return after + delay
+
+  def write(self, data):
+    if self._splitWrite(data):
+      return
+    self._startCall()
+    if isinstance(data, str):
+      data = data.encode()
+    if data.strip() != b"":
+      self.cumulativeBytes  += len(data)
+      self.cumulativeWrites += 1
+      if not self.writeTimes:
+        self.lastDelivery = self.now
+      self.writeTimes.append(self.now)
+    self._endCall()
+
+  def readline(self):
+    self._startCall()
+    self.cumulativeReads += 1
+    due = self._nextDue()
+    if due is not None and due <= self.now + self.timeout:
+      delay, isOkay, reply = self.recorded.popleft()
+      self.now = self.lastDelivery = max(self.now, due)
+      if isOkay:
+        self.okays += 1
+    else:
+      self.now += self.timeout
+      reply = b""
+    self._endCall()
+    return reply
+
+  @property
+  def in_waiting(self):
+    self._startCall()
+    due = self._nextDue()
+    waiting = len(self.recorded[0][2]) if due is not None and due <= self.now else 0
+    self._endCall()
+    return waiting
+
+  @property
+  def replayedSeconds(self):
+    """Time since the first command was written, to compare with recordedSeconds"""
+    return self.now - self.writeTimes[0] if self.writeTimes else 0.0
+
+  def close(self):
+    print("Recorded time:                    %.2f s" % self.recordedSeconds)
+    print("Replayed time:                    %.2f s" % self.replayedSeconds)
+    print("Replies left over:                %d"     % len(self.recorded))
+    print("Total writes:                     %d"     % self.cumulativeWrites)
+    print()
@@ -0,0 +1,127 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# Printing the same file many times strips, compacts and frames the
+# same lines on every run. The class FramedGCodeCache keeps the framed
+# output of writeFramedFile() on disk, so that repeat jobs can stream it
+# straight from a FramedFileSource.
+#
+# Entries are keyed by a SHA-256 hash of the file's contents together
+# with the options which affect framing, so an edited file, or the same
+# file sent with different options, gets its own entry. So that the
+# file need not be hashed again on every run, the hash is remembered in
+# an index along with the file's size and modification time.
+#
+# Whenever an entry is used its modification time is updated, and once
+# the cache grows beyond maxBytes the least recently used entries are
+# deleted.
+
+import hashlib
+import json
+import os
+
+from pyMarlin.gcodeFileSource import GCodeFileSource
+from pyMarlin.gcodeFramer     import writeFramedFile
+
+# Change this whenever the format of the framed files changes
+CACHE_VERSION = 1
+
+def defaultCacheDir():
+  base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+  return os.path.join(base, "pyMarlin", "framed")
+
+class FramedGCodeCache:
+  """This class caches framed GCODE files on disk in directory, which is
+     created if needed, deleting the least recently used entries whenever
+     the files in the cache take up more than maxBytes."""
+  def __init__(self, directory = None, maxBytes = 1024 * 1024 * 1024):
+    self.directory = directory or defaultCacheDir()
+    self.maxBytes  = maxBytes
+    self.indexFile = os.path.join(self.directory, "index.json")
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory)
+
+  def _loadIndex(self):
+    try:
+      with open(self.indexFile) as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      return {}
+
+  def _saveIndex(self, index):
+    with open(self.indexFile + ".tmp", "w") as f:
+      json.dump(index, f)
+    os.replace(self.indexFile + ".tmp", self.indexFile)
+
+  def contentHash(self, filename):
+    """Returns the SHA-256 hash of a file, reusing the one in the index if the
+       file's size and modification time have not changed since it was hashed"""
+    path  = os.path.realpath(filename)
+    stat  = os.stat(path)
+    index = self._loadIndex()
+    entry = index.get(path)
+    if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+      return entry[2]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+      for chunk in iter(lambda: f.read(1024 * 1024), b""):
+        digest.update(chunk)
+    index[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    self._saveIndex(index)
+    return digest.hexdigest()
+
+  def key(self, filename, compactor = None):
+    """Returns the cache key for a file framed with the given options"""
+    options = "v%d" % CACHE_VERSION
+    if compactor:
+      options += " compact " + " ".join("%s%d" % item for item in sorted(compactor.decimals.items()))
+    return hashlib.sha256((self.contentHash(filename) + options).encode()).hexdigest()
+
+  def path(self, filename, compactor = None):
+    return os.path.join(self.directory, self.key(filename, compactor) + ".framed")
+
+  def get(self, filename, compactor = None):
+    """Returns the path of the framed version of a file, framing it into the cache
+       if it is not there yet. The second value returned is True on a cache hit."""
+    path = self.path(filename, compactor)
+    hit  = os.path.exists(path)
+    if hit:
+      os.utime(path, None)
+    else:
+      writeFramedFile(GCodeFileSource(filename), path, compactor = compactor)
+      self.evict(keep = path)
+    return path, hit
+
+  def size(self):
+    """Returns the total size of the files in the cache"""
+    return sum(size for mtime, size, path in self._entries())
+
+  def _entries(self):
+    entries = []
+    for name in os.listdir(self.directory):
+      if name.endswith(".framed"):
+        path = os.path.join(self.directory, name)
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+  def evict(self, keep = None):
+    """Deletes the least recently used entries, other than keep, until the cache
+       fits within maxBytes"""
+    entries = sorted(self._entries())
+    total   = sum(size for mtime, size, path in entries)
+    for mtime, size, path in entries:
+      if total <= self.maxBytes:
+        break
+      if path != keep:
+        os.remove(path)
+        total -= size
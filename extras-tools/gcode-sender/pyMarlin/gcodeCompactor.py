@@ -0,0 +1,163 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# Most of the bytes sent to Marlin are spent on the digits of move
+# coordinates, many of which are either redundant or more precise than
+# the machine can resolve. The class GCodeCompactor rewrites moves into
+# the shortest equivalent text that Marlin accepts without any firmware
+# changes:
+#
+#   - Coordinates are rounded to the resolution of the axis, as given
+#     by its steps per mm, and written without trailing zeros, leading
+#     zeros or spaces ("G1 X10.500 Y0.250" becomes "G1X10.5Y.25").
+#   - Axes which do not change, and feedrates which are the same as the
+#     current one, are dropped.
+#   - Moves which do not move anything are dropped entirely.
+#
+# In relative mode, the rounding error is carried over to the next move,
+# so it does not accumulate. The class GCodeModalState tracks the modal
+# state (position, feedrate and absolute/relative modes) which is needed
+# to do this; FakeMarlinSerialDevice uses it to decode what it receives.
+
+import math
+import re
+
+_wordPattern = re.compile(br"([A-Z])\s*([-+]?[0-9]*\.?[0-9]*)")
+
+def parseCmd(cmd):
+  """Splits a command into its code (such as b"G1") and a dictionary of
+     parameters, keyed by letter. Parameters with no value map to None."""
+  words = _wordPattern.findall(cmd.upper())
+  if not words:
+    return None, {}
+  letter, number = words[0]
+  if b"." not in number:
+    number = number.lstrip(b"0") or b"0" # G01 is the same as G1
+  params = {}
+  for word, value in words[1:]:
+    params[word.decode()] = float(value) if value and value not in (b"-", b"+", b".") else None
+  return letter + number, params
+
+class GCodeModalState:
+  """This class tracks the modal state of a Marlin machine: the position of
+     each axis, the feedrate and whether positioning is absolute or relative.
+     A position of None means it is unknown, such as after homing."""
+  AXES        = "XYZE"
+  PARAMS      = frozenset("XYZEF")
+  MOVES       = (b"G0", b"G1")
+  # Commands which do not affect the position or feedrate
+  HARMLESS    = (b"G4", b"M104", b"M105", b"M106", b"M107", b"M109", b"M114", b"M115",
+                 b"M117", b"M140", b"M190", b"M400", b"M31", b"M119", b"M110")
+
+  def __init__(self):
+    self.position  = dict((axis, 0.0) for axis in self.AXES)
+    self.feedrate  = None
+    self.relative  = False
+    self.relativeE = False
+
+  def isRelative(self, axis):
+    return self.relativeE if axis == "E" else self.relative
+
+  def update(self, code, params):
+    """Updates the state following a command, as parsed by parseCmd()"""
+    if code in self.MOVES:
+      for axis in self.AXES:
+        value = params.get(axis)
+        if value is not None and self.position[axis] is not None:
+          self.position[axis] = self.position[axis] + value if self.isRelative(axis) else value
+        elif value is not None:
+          self.position[axis] = None if self.isRelative(axis) else value
+      if params.get("F") is not None:
+        self.feedrate = params["F"]
+    elif code == b"G90":
+      self.relative  = False
+      self.relativeE = False
+    elif code == b"G91":
+      self.relative  = True
+      self.relativeE = True
+    elif code == b"M82":
+      self.relativeE = False
+    elif code == b"M83":
+      self.relativeE = True
+    elif code == b"G92":
+      axes = [axis for axis in self.AXES if axis in params] or self.AXES
+      for axis in axes:
+        self.position[axis] = params.get(axis) or 0.0
+    elif code not in self.HARMLESS:
+      # Anything else might move the machine or change the feedrate
+      self.position = dict((axis, None) for axis in self.AXES)
+      self.feedrate = None
+
+class GCodeCompactor:
+  """This class rewrites GCODE commands into shorter equivalent ones. The
+     resolution of each axis is derived from its steps per mm, which default
+     to those of the Cocoa Press."""
+  def __init__(self, stepsPerMm = None):
+    stepsPerMm    = dict(stepsPerMm or {"X": 80, "Y": 80, "Z": 400, "E": 400})
+    self.decimals = dict((axis, max(0, int(math.ceil(math.log10(2 * steps))))) for axis, steps in stepsPerMm.items())
+    self.state    = GCodeModalState()
+    self.carry    = dict((axis, 0.0) for axis in GCodeModalState.AXES)
+
+  def _format(self, value, decimals):
+    """Formats a number in as few characters as possible"""
+    text = b"%.*f" % (decimals, value)
+    if b"." in text:
+      text = text.rstrip(b"0").rstrip(b".")
+    if text.startswith(b"0."):
+      text = text[1:]
+    elif text.startswith(b"-0."):
+      text = b"-" + text[2:]
+    return b"0" if text in (b"", b"-0", b"-") else text
+
+  def _compactMove(self, code, params):
+    words = [code]
+    for axis in GCodeModalState.AXES:
+      value = params.get(axis)
+      if value is None:
+        continue
+      decimals = self.decimals.get(axis, 3)
+      if self.state.isRelative(axis):
+        # Carry the rounding error over to the next move
+        exact   = value + self.carry[axis]
+        rounded = round(exact, decimals)
+        self.carry[axis] = exact - rounded
+        if rounded != 0:
+          words.append(axis.encode() + self._format(rounded, decimals))
+        params[axis] = rounded
+      else:
+        rounded = round(value, decimals)
+        if rounded != self.state.position[axis]:
+          words.append(axis.encode() + self._format(rounded, decimals))
+        params[axis] = rounded
+    feedrate = params.get("F")
+    if feedrate is not None:
+      feedrate = round(feedrate)
+      if feedrate != self.state.feedrate:
+        words.append(b"F" + self._format(feedrate, 0))
+      params["F"] = feedrate
+    self.state.update(code, params)
+    return b"".join(words) if len(words) > 1 else None
+
+  def compact(self, cmd):
+    """Returns a shorter command equivalent to cmd, which must already be stripped
+       of comments. Returns None if the command can be dropped entirely."""
+    code, params = parseCmd(cmd)
+    if code is None:
+      return cmd
+    if code in GCodeModalState.MOVES and None not in params.values() and GCodeModalState.PARAMS.issuperset(params):
+      return self._compactMove(code, params)
+    self.state.update(code, params)
+    if code == b"G92":
+      # Positions are now exact, so forget any rounding error
+      for axis in self.carry:
+        self.carry[axis] = 0.0
+    return cmd
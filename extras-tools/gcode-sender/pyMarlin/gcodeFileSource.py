@@ -0,0 +1,59 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+import mmap
+import os
+import re
+
+class GCodeFileSource:
+  """This class reads lines from a GCODE file lazily, as they are
+     needed, rather than loading the entire file into memory. This
+     allows printing to start immediately and keeps memory use constant
+     regardless of the size of the file. Progress is reported from the
+     byte offset into the file, so the number of lines need not be
+     known in advance. Optionally, the file can be memory-mapped."""
+  def __init__(self, filename, useMmap = False):
+    self.filename = filename
+    self.useMmap  = useMmap
+    self.size     = os.path.getsize(filename)
+    self.offset   = 0
+
+  def __iter__(self):
+    with open(self.filename, "rb") as f:
+      if self.useMmap and self.size > 0:
+        f = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        f.seek(self.offset)
+        for line in iter(f.readline, b""):
+          self.offset += len(line)
+          yield line
+      finally:
+        if self.useMmap and self.size > 0:
+          f.close()
+
+  def progress(self):
+    """Returns the percentage of the file which has been read"""
+    return self.offset * 100.0 / self.size if self.size else 100.0
+
+class FramedFileSource(GCodeFileSource):
+  """This class reads a file of frames written by writeFramedFile(), yielding
+     (position, frame) tuples which can be passed directly to
+     MarlinSerialProtocol.sendCmdFramed(). The position of the first frame
+     read is taken from its line number; the rest follow consecutively."""
+  def __iter__(self):
+    position = None
+    for line in GCodeFileSource.__iter__(self):
+      frame = line.rstrip(b"\n")
+      if position is None:
+        position = int(re.match(br"N(\d+)", frame).group(1))
+      yield position, frame
+      position += 1
@@ -0,0 +1,149 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# Reliable GCODE commands are framed as N{position}{cmd}*{checksum},
+# where the checksum is the XOR of every character preceding the
+# asterisk. Because XOR is associative, the checksum can be split into
+# the checksum of the "N{position}" prefix, which is looked up from a
+# table of precomputed digit checksums, and the checksum of the command
+# itself, which can be computed once and reused whenever the command is
+# re-framed at a different position.
+#
+# The class GCodeFramingPipeline performs the stripping and framing of
+# a GCODE stream in a background thread, so that the send loop only
+# needs to write bytes and handle flow control. Blank and comment-only
+# lines are dropped entirely, rather than being sent as M105.
+#
+# The same work can also be done ahead of time: writeFramedFile() writes
+# the frames to a file, one per line, which FramedFileSource streams back
+# without any further processing.
+
+import functools
+import operator
+import os
+import queue
+import re
+import threading
+
+# Checksums of the digits of every number below 10000, with and
+# without leading zeros.
+_digitsChecksum       = [functools.reduce(operator.xor, b"%d"   % i) for i in range(10000)]
+_paddedDigitsChecksum = [functools.reduce(operator.xor, b"%04d" % i) for i in range(10000)]
+
+def positionChecksum(position):
+  """Returns the checksum of the "N{position}" prefix of a framed command"""
+  checksum = 0x4E # The letter 'N'
+  while position >= 10000:
+    position, low = divmod(position, 10000)
+    checksum ^= _paddedDigitsChecksum[low]
+  return checksum ^ _digitsChecksum[position]
+
+_whitespace = re.compile(br"\s+")
+
+def normalizeCmd(line):
+  """Strips comments and whitespace from a command and collapses any runs of
+     whitespace within it into a single space. Blank lines become b"" """
+  if isinstance(line, str):
+    line = line.encode()
+  cmd = line.split(b';', 1)[0].strip()
+  if b"  " in cmd or b"\t" in cmd:
+    cmd = _whitespace.sub(b" ", cmd)
+  return cmd
+
+def frameCmd(position, cmd, cmdChecksum = None):
+  """Returns a command framed with a line number and checksum. If the checksum
+     of cmd is already known, it can be passed in to avoid computing it again."""
+  if cmdChecksum is None:
+    cmdChecksum = functools.reduce(operator.xor, cmd, 0)
+  return b"N%d%s*%d" % (position, cmd, positionChecksum(position) ^ cmdChecksum)
+
+def frameCmds(position, cmds):
+  """Frames a batch of commands with consecutive line numbers starting at position"""
+  return [frameCmd(pos, cmd) for pos, cmd in enumerate(cmds, position)]
+
+class GCodeFramingPipeline:
+  """This class strips and frames lines of GCODE in a background thread,
+     in batches of batchSize lines, staying at most depth batches ahead
+     of the consumer. Iterating over it yields (position, frame) tuples
+     which can be passed to MarlinSerialProtocol.sendCmdFramed(). Lines
+     which are blank once comments are stripped are skipped. If a
+     GCodeCompactor is given, commands are compacted before framing.
+     If the lines come from a source with an offset, such as a
+     GCodeFileSource, offset is the source's offset just past the line
+     of the last frame yielded."""
+  def __init__(self, lines, position = 1, batchSize = 256, depth = 16, compactor = None):
+    self.lines     = lines
+    self.compactor = compactor
+    self.position  = position
+    self.batchSize = batchSize
+    self.batches   = queue.Queue(depth)
+    self.offset    = getattr(lines, "offset", None)
+    self.error     = None
+    self.thread    = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _run(self):
+    try:
+      batch   = []
+      offsets = [] if self.offset is not None else None
+      for line in self.lines:
+        cmd = normalizeCmd(line)
+        if not cmd:
+          continue
+        if self.compactor:
+          cmd = self.compactor.compact(cmd)
+          if cmd is None:
+            continue
+        batch.append(cmd)
+        if offsets is not None:
+          offsets.append(self.lines.offset)
+        if len(batch) == self.batchSize:
+          self._enqueue(batch, offsets)
+          batch   = []
+          offsets = [] if offsets is not None else None
+      self._enqueue(batch, offsets)
+    except Exception as e:
+      self.error = e
+    finally:
+      self.batches.put(None)
+
+  def _enqueue(self, batch, offsets):
+    if batch:
+      self.batches.put((self.position, frameCmds(self.position, batch), offsets))
+      self.position += len(batch)
+
+  def __iter__(self):
+    while True:
+      batch = self.batches.get()
+      if batch is None:
+        break
+      position, frames, offsets = batch
+      for i, frame in enumerate(frames):
+        if offsets:
+          self.offset = offsets[i]
+        yield position + i, frame
+    if self.error:
+      raise self.error
+
+def writeFramedFile(lines, filename, position = 1, compactor = None):
+  """Strips, compacts and frames lines as GCodeFramingPipeline does, and writes
+     the frames to filename, one per line. The file is written under a temporary
+     name and then renamed, so it is never seen partially written. Returns the
+     number of frames written."""
+  count = 0
+  with open(filename + ".tmp", "wb") as f:
+    for position, frame in GCodeFramingPipeline(lines, position, compactor = compactor):
+      f.write(frame + b"\n")
+      count += 1
+  os.replace(filename + ".tmp", filename)
+  return count
@@ -10,31 +10,155 @@
 # FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
 #
 
+# LoggingSerialConnection records everything sent to and received from
+# Marlin. To keep logging cheap enough to leave on during long prints,
+# the send and receive paths only append a timestamped record to a queue;
+# a background thread formats the records and writes them out, flushing
+# the file every flushInterval seconds rather than after every line.
+# Records still queued when the interpreter exits are written out even if
+# close() was never called, as after an unhandled exception, since the end
+# of the log is usually the part needed. If writing fails, the error is
+# raised by the next call to write() or close().
+#
+# Two formats are supported. The text format writes one line per record:
+#
+#   <seconds> > N12G1X10*34       (sent to Marlin)
+#   <seconds> < ok                (received from Marlin)
+#   <seconds> < Timeout           (nothing received)
+#
+# The trailing newline of each record is dropped. Any other newlines, as
+# in a burst of commands written at once, are escaped as \n and \r, and
+# backslashes as \\, so that each record stays on a single line.
+#
+# The binary format starts with the magic LOG_MAGIC, followed by records
+# consisting of a little-endian double timestamp, a direction byte and a
+# 32-bit length, then the raw bytes, which are neither decoded nor
+# stripped. A timeout is a received record of length zero.
+#
+# If maxBytes is set, the log is rotated once it grows beyond that size:
+# the file is renamed with the suffix ".1", older logs move up to ".2",
+# and so on, keeping at most backupCount of them. readSerialLog() reads
+# back a log of either format, including any rotated files, in order.
+
 from __future__ import print_function
 
-import sys
+import atexit
+import collections
+import os
+import re
+import struct
+import threading
+import time
 
-class LoggingSerialConnection:
-  """Wrapper class which prints the input and output from a serial connection"""
-  def __init__(self, serial, filename):
-    self.serial     = serial
-    self.verbose    = True
-    self.file       = open(filename, 'w+')
+LOG_MAGIC   = b"pyMarlin log 1\n"
+_logRecord  = struct.Struct("<dcI")
+
+SENT        = b">"
+RECEIVED    = b"<"
 
-  def _log(self, *args, **kwargs):
+_escapes    = {b"\\": b"\\\\", b"\n": b"\\n", b"\r": b"\\r"}
+_unescapes  = dict((v[1:], k) for k, v in _escapes.items())
+_escaped    = re.compile(br"[\\\r\n]")
+_unescaped  = re.compile(br"\\(.)")
+
+def _escape(data):
+  return _escaped.sub(lambda m: _escapes[m.group(0)], data)
+
+def _unescape(data):
+  return _unescaped.sub(lambda m: _unescapes.get(m.group(1), m.group(0)), data)
+
+class LoggingSerialConnection:
+  """Wrapper class which logs the input and output from a serial connection.
+     Records are written out by a background thread, which flushes the file
+     every flushInterval seconds. See above for the formats and rotation."""
+  def __init__(self, serial, filename, binary = False, flushInterval = 1.0, maxBytes = 0, backupCount = 5):
+    self.serial        = serial
+    self.verbose       = True
+    self.filename      = filename
+    self.binary        = binary
+    self.flushInterval = flushInterval
+    self.maxBytes      = maxBytes
+    self.backupCount   = backupCount
+    self.records       = collections.deque()
+    self.wakeup        = threading.Event()
+    self.running       = True
+    self.error         = None # The exception which stopped the writer thread
+    self.file          = self._open()
+    self.thread        = threading.Thread(target=self._run, name="LoggingSerialConnection")
+    self.thread.daemon = True
+    self.thread.start()
+    atexit.register(self._stop)
+
+  def _open(self):
+    f = open(self.filename, 'wb')
+    if self.binary:
+      f.write(LOG_MAGIC)
+    return f
+
+  def _log(self, direction, data):
     if(self.verbose):
-      print(*args, file=self.file, **kwargs)
-      self.file.flush()
+      self.records.append((time.time(), direction, data))
+
+  def _format(self, timestamp, direction, data):
+    if self.binary:
+      return _logRecord.pack(timestamp, direction, len(data)) + data
+    if direction == RECEIVED and data == b"":
+      data = b"Timeout"
+    return b"%.6f %s %s\n" % (timestamp, direction, _escape(data.rstrip(b"\r\n")))
+
+  def _rotate(self):
+    self.file.close()
+    for i in range(self.backupCount - 1, 0, -1):
+      if os.path.exists("%s.%d" % (self.filename, i)):
+        os.replace("%s.%d" % (self.filename, i), "%s.%d" % (self.filename, i + 1))
+    if self.backupCount:
+      os.replace(self.filename, self.filename + ".1")
+    self.file = self._open()
+
+  def _writeRecords(self):
+    while self.records:
+      self.file.write(self._format(*self.records.popleft()))
+      if self.maxBytes and self.file.tell() >= self.maxBytes:
+        self._rotate()
+    self.file.flush()
+
+  def _run(self):
+    try:
+      while self.running:
+        self.wakeup.wait(self.flushInterval)
+        self._writeRecords()
+    except Exception as e:
+      self.error = e
+
+  def _raiseWriterError(self):
+    if self.error:
+      raise self.error
+
+  def _stop(self):
+    """Stops the writer thread and writes out the records it left behind"""
+    self.running = False
+    self.wakeup.set()
+    self.thread.join()
+    try:
+      self._raiseWriterError()
+      self._writeRecords()
+    finally:
+      self.file.close()
 
   def write(self, data):
-    self._log("> " + data.decode(), end='')
+    self._raiseWriterError()
+    self._log(SENT, data)
     self.serial.write(data)
 
   def flush(self):
     self.serial.flush()
 
   def close(self):
-    self.serial.close()
+    atexit.unregister(self._stop)
+    try:
+      self._stop()
+    finally:
+      self.serial.close()
 
   def reset_input_buffer(self):
     self.serial.reset_input_buffer()
@@ -44,10 +168,7 @@ class LoggingSerialConnection:
 
   def readline(self):
     data = self.serial.readline()
-    if(data == b""):
-      self._log("< Timeout")
-    else:
-      self._log("< " + data.decode(), end='')
+    self._log(RECEIVED, data)
     return data
 
   @property
@@ -73,3 +194,46 @@ class LoggingSerialConnection:
   @write_timeout.setter
   def write_timeout(self, write_timeout):
     self.serial.write_timeout = write_timeout
+
+def _readLogFile(filename):
+  with open(filename, 'rb') as f:
+    magic = f.read(len(LOG_MAGIC))
+    if magic == LOG_MAGIC:
+      while True:
+        header = f.read(_logRecord.size)
+        if len(header) < _logRecord.size:
+          break
+        timestamp, direction, length = _logRecord.unpack(header)
+        data = f.read(length)
+        if len(data) < length:
+          break # The log was truncated while being written
+        yield timestamp, direction, data
+    else:
+      f.seek(0)
+      for line in f:
+        try:
+          timestamp, direction, data = line.rstrip(b"\n").split(b" ", 2)
+          timestamp = float(timestamp)
+        except ValueError:
+          continue # Malformed, or truncated while being written
+        if direction == RECEIVED and data == b"Timeout":
+          data = b""
+        elif data:
+          data = _unescape(data) + b"\n"
+        yield timestamp, direction, data
+
+def readSerialLog(filename, includeRotated = True):
+  """Reads back a log written by LoggingSerialConnection, yielding (timestamp,
+     direction, data) tuples, where direction is SENT or RECEIVED. In a text
+     log, a newline is added back to each record and malformed lines are
+     skipped. If includeRotated is set, any rotated files are read first,
+     oldest first."""
+  filenames = [filename]
+  if includeRotated:
+    i = 1
+    while os.path.exists("%s.%d" % (filename, i)):
+      filenames.insert(0, "%s.%d" % (filename, i))
+      i += 1
+  for name in filenames:
+    for record in _readLogFile(name):
+      yield record
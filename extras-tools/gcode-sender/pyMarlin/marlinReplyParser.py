@@ -0,0 +1,137 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# Classifies lines received from Marlin into typed replies, using a
+# single precompiled regular expression, so that each line is scanned
+# only once. MarlinSerialProtocol dispatches on the type of the reply.
+
+import re
+
+class MarlinReply:
+  """Base class for all replies. The raw line is kept in line. If Marlin
+     is requesting a resend, resendPosition is the line to resend from."""
+  __slots__ = ('line',)
+  resendPosition = None
+
+  def __init__(self, line):
+    self.line = line
+
+  def __repr__(self):
+    return "%s(%r)" % (type(self).__name__, self.line)
+
+class Timeout(MarlinReply):
+  """Nothing was received before the serial port timed out"""
+  __slots__ = ()
+
+class Ok(MarlinReply):
+  """Marlin acknowledged a command"""
+  __slots__ = ()
+
+class AdvancedOk(Ok):
+  """Marlin acknowledged a command and, because ADVANCED_OK is enabled,
+     reported the last line number seen and the number of free planner
+     and command buffer slots"""
+  __slots__ = ('lastLine', 'plannerAvail', 'bufferAvail')
+
+  def __init__(self, line, lastLine, plannerAvail, bufferAvail):
+    self.line         = line
+    self.lastLine     = lastLine
+    self.plannerAvail = plannerAvail
+    self.bufferAvail  = bufferAvail
+
+class Resend(MarlinReply):
+  """Marlin requests that commands be resent, starting at resendPosition"""
+  __slots__ = ('resendPosition',)
+
+  def __init__(self, line, resendPosition):
+    self.line           = line
+    self.resendPosition = resendPosition
+
+class Busy(MarlinReply):
+  """Marlin is still processing a long running command"""
+  __slots__ = ()
+
+class Error(MarlinReply):
+  """Marlin reported an error. If it was a command with a checksum but no line
+     number, resendPosition is the line following the last good one."""
+  __slots__ = ('resendPosition',)
+
+  def __init__(self, line, resendPosition = None):
+    self.line           = line
+    self.resendPosition = resendPosition
+
+class Echo(MarlinReply):
+  """An informational message from Marlin"""
+  __slots__ = ()
+
+class Temp(MarlinReply):
+  """A temperature report, such as from M105 or M155"""
+  __slots__ = ()
+
+class Position(MarlinReply):
+  """A position report, such as from M114 or M154"""
+  __slots__ = ()
+
+class Capability(MarlinReply):
+  """A capability reported by M115, such as Cap:ADVANCED_OK:1"""
+  __slots__ = ('name', 'value')
+
+  def __init__(self, line, name, value):
+    self.line  = line
+    self.name  = name
+    self.value = value
+
+class Other(MarlinReply):
+  """Any other output from Marlin"""
+  __slots__ = ()
+
+# Line numbers must end the line, so that a corrupted reply such as
+# "Resend: 18S3" is not taken for a request to resend from line 18
+_replyPattern = re.compile(br"""
+    (?P<ok>ok)(?:\s+N(?P<n>\d+)\s+P(?P<p>\d+)\s+B(?P<b>\d+)\s*$)?
+  | (?i:resend):?\s*N?:?\s*(?P<resend>\d+)\s*$
+  | rs\s+N?(?P<rs>\d+)\s*$
+  | (?:echo:)?(?P<busy>busy:)
+  | (?P<error>Error:)(?:No\ Line\ Number\ with\ checksum,\ Last\ Line:\ (?P<lastLine>\d+)\s*$)?
+  | (?P<echo>echo:)
+  | Cap:(?P<cap>\w+):(?P<capValue>\d+)
+  | (?P<position>X:-?[\d.])
+  | \s*(?P<temp>T:)
+""", re.X)
+
+def parseReply(line):
+  """Returns the typed reply for a line received from Marlin"""
+  if line == b"":
+    return Timeout(line)
+  m = _replyPattern.match(line)
+  if not m:
+    return Other(line)
+  if m.group('ok'):
+    if m.group('n'):
+      return AdvancedOk(line, int(m.group('n')), int(m.group('p')), int(m.group('b')))
+    return Ok(line)
+  if m.group('resend'):
+    return Resend(line, int(m.group('resend')))
+  if m.group('rs'):
+    return Resend(line, int(m.group('rs')))
+  if m.group('busy'):
+    return Busy(line)
+  if m.group('error'):
+    lastLine = m.group('lastLine')
+    return Error(line, int(lastLine) + 1 if lastLine else None)
+  if m.group('echo'):
+    return Echo(line)
+  if m.group('cap'):
+    return Capability(line, m.group('cap').decode(), int(m.group('capValue')))
+  if m.group('position'):
+    return Position(line)
+  return Temp(line)
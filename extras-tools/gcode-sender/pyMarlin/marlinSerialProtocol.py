@@ -40,43 +40,87 @@
 #       serial.readline()
 #
 
-import functools
-import re
-import time
+import collections
+import math
+
+from pyMarlin.gcodeFramer       import frameCmd
+from pyMarlin.pacingStrategy    import AdaptivePacing
+from pyMarlin.stallWatchdog     import AdaptiveWatchdog
+from pyMarlin.commandScheduler  import CommandScheduler
+from pyMarlin.marlinReplyParser import parseReply, Ok, AdvancedOk, Busy, Error, Timeout, Capability
+
+class GCodeHistoryError(Exception):
+  """Raised when a command is needed that is no longer held in the history"""
+  pass
 
 class GCodeHistory:
-  """This class implements a history of GCode commands. Right now, we
-     keep the entire history, but this probably could be reduced to a
-     smaller range if memory use becomes an issue. This class keeps a
+  """This class implements a history of GCode commands. Only the most
+     recent commands are kept, in a fixed-size ring buffer, so that memory
+     use does not grow with the length of the print. Marlin indexes its
+     command buffer with a byte, so it can never have more than 255 commands
+     outstanding; the default capacity retains twice that many so that any
+     resend request Marlin can make can be satisfied. This class keeps a
      pointer to the position of the first unsent command, which typically
      is the one just recently added, but after a resend request from
-     Marlin that position can rewound further back."""
-  def __init__(self):
+     Marlin that position can rewound further back. Only commands which
+     Marlin has acknowledged, and so will never ask for again, are evicted."""
+  MAX_RESEND_WINDOW = 256
+
+  def __init__(self, capacity = 2 * MAX_RESEND_WINDOW):
+    self.capacity = capacity
     self.clear()
 
-  def clear(self):
-    self.list = [None] # Pad so the first element is at index 1
-    self.pos  = 1
+  def clear(self, position = 1):
+    """Empties the history; the next command appended will be at position"""
+    self.ring  = [None] * self.capacity
+    self.start = position # Position of the oldest retained command
+    self.end   = position # Position at which the next append will happen
+    self.pos   = position
+    self.acked = position - 1 # Position of the last command acknowledged by Marlin
 
   def append(self, cmd):
-    self.list.append(cmd)
+    if self.end - self.start == self.capacity:
+      # Evict the oldest command, unless Marlin might still ask for it
+      if self.acked < self.start:
+        raise GCodeHistoryError("History is full of unacknowledged commands; call clearToSend() or readline() to process Marlin's replies")
+      self.ring[self.start % self.capacity] = None
+      self.start += 1
+    self.ring[self.end % self.capacity] = cmd
+    self.end += 1
 
   def rewindTo(self, position):
-    self.pos = max(1,min(position, len(self.list)))
+    position = max(1,min(position, self.end))
+    if position < self.start:
+      raise GCodeHistoryError("Cannot rewind to line %d, oldest retained line is %d" % (position, self.start))
+    self.pos   = position
+    self.acked = position - 1 # Marlin received everything before position
+
+  def acknowledge(self, position):
+    """Records that Marlin has acknowledged the commands up to position"""
+    self.acked = max(self.acked, min(position, self.pos - 1))
 
   def getAppendPosition(self):
     """Returns the position at which the next append will happen"""
-    return len(self.list)
+    return self.end
+
+  def oldestPosition(self):
+    """Returns the position of the oldest command retained"""
+    return self.start
+
+  def peekNextCommand(self):
+    """Returns the next unsent command, without advancing past it."""
+    if(not self.atEnd()):
+      return self.ring[self.pos % self.capacity]
 
   def getNextCommand(self):
     """Returns the next unsent command."""
     if(not self.atEnd()):
-      res = self.pos, self.list[self.pos]
+      res = self.pos, self.ring[self.pos % self.capacity]
       self.pos += 1;
       return res
 
   def atEnd(self):
-    return self.pos == len(self.list)
+    return self.pos == self.end
 
   def position(self):
     return self.pos
@@ -87,22 +131,66 @@ class GCodeHistory:
 class MarlinSerialProtocol:
   """This class implements the Marlin serial protocol, such
   as adding a checksum to each line, replying to resend
-  requests and keeping the Marlin buffer full"""
-  def __init__(self, serial, onResendCallback=None, onDebugMsgCallback=None):
+  requests and keeping the Marlin buffer full. The pacing of
+  commands sent in a burst is delegated to pacingStrategy, which
+  defaults to an AdaptivePacing. Deciding when a lost "ok" has
+  stalled the print is delegated to watchdog, which defaults to an
+  AdaptiveWatchdog. While commands are pending, reads time out no
+  later than the watchdog deadline.
+
+  By default, flow control counts commands. If rxBufferSize is
+  given, the bytes of all commands in flight are also kept within
+  Marlin's serial receive buffer of that size, so that long lines
+  cannot overrun it while short lines still use all command slots.
+
+  If stats is given, it is informed of every command sent, "ok",
+  resend and re-sync, so that it can record the timing of the link
+  (see ProtocolStats).
+
+  Unreliable commands are interleaved with the print by scheduler,
+  which defaults to a CommandScheduler.
+
+  If coalesceWrites is set, all the commands which fit in Marlin's
+  buffer are gathered into a single write, followed by a single flush,
+  rather than writing and flushing every command. Commands within such
+  a burst are not paced.
+
+  If telemetry is given, every reply is passed to it, so that it can
+  publish the temperatures, positions and messages reported by Marlin
+  (see MarlinTelemetry)."""
+  def __init__(self, serial, onResendCallback=None, onDebugMsgCallback=None, pacingStrategy=None, rxBufferSize=None, watchdog=None, stats=None, scheduler=None, coalesceWrites=False, telemetry=None):
     self.serial                 = serial
     self.marlinBufSize          = 5
     self.marlinReserve          = 1
+    self.marlinPlannerSize      = None
+    self.marlinCapabilities     = {}
     self.marlinAvailBuffer      = self.marlinBufSize
     self.marlinPendingCommands  = 0
+    self.marlinQueuedCommands   = 0 # Commands in Marlin's buffer, as last reported by ADVANCED_OK
+    self.marlinRxBufferSize     = rxBufferSize
+    self.bytesInFlight          = 0
+    self.cmdBytesInFlight       = collections.deque()
     self.history                = GCodeHistory()
-    self.asap                   = []
-    self.slowCommands           = re.compile(b"M109|M190|G28|G29|G425")
-    self.slowTimeout            = 300
-    self.fastTimeout            = 15
+    self.scheduler              = scheduler or CommandScheduler()
     self.usingAdvancedOk        = False
-    self.watchdogTimeout        = time.time()
+    self.watchdog               = watchdog or AdaptiveWatchdog()
+    self.readTimeout            = getattr(serial, "timeout", None)
+    self.minReadTimeout         = 0.1
     self.onResendCallback       = onResendCallback
     self.onDebugMsgCallback     = onDebugMsgCallback
+    self.pacingStrategy         = pacingStrategy or AdaptivePacing()
+    self.stats                  = stats
+    self.telemetry              = telemetry
+    self.coalesceWrites         = coalesceWrites
+    self.writeBuffer            = None # Commands gathered for a coalesced write
+    self.replyHandlers          = {
+      Ok:         self._gotOkay,
+      AdvancedOk: self._gotOkay,
+      Busy:       self._gotBusy,
+      Error:      self._gotError,
+      Timeout:    self._gotTimeout,
+      Capability: self._gotCapability
+    }
     self.restart()
 
   def _stripCommentsAndWhitespace(self, str):
@@ -112,60 +200,99 @@ class MarlinSerialProtocol:
     """Marlin will not accept empty lines, so replace blanks with M115 (Get Extruder Temperature)"""
     return b"M105" if str == b"" else str
 
-  def _computeChecksum(self, data):
-    """Computes the GCODE checksum, this is the XOR of all characters in the payload, including the position"""
-    return functools.reduce(lambda x,y: x^y, map(ord, data) if isinstance(data, str) else list(data))
-
   def _addPositionAndChecksum(self, position, cmd):
     """An GCODE with line number and checksum consists of N{position}{cmd}*{checksum}"""
-    data = b"N%d%s"    % (position, cmd)
-    return b"N%d%s*%d" % (position, cmd, self._computeChecksum(data))
+    return frameCmd(position, cmd)
 
   def _sendImmediate(self, cmd):
       self._adjustStallWatchdogTimer(cmd)
-      self.serial.write(cmd + b'\n')
-      self.serial.flush()
+      if self.writeBuffer is not None:
+        self.writeBuffer.append(cmd)
+      else:
+        self.serial.write(cmd + b'\n')
+        self.serial.flush()
       self.marlinPendingCommands += 1
       self.marlinAvailBuffer     -= 1
+      self.bytesInFlight         += len(cmd) + 1
+      self.cmdBytesInFlight.append(len(cmd) + 1)
+      if self.stats:
+        self.stats.onSent(self.marlinPendingCommands + self.marlinQueuedCommands)
+
+  def _acknowledgeBytes(self, pendingCommands):
+    """Stops counting the bytes of all but the most recent pendingCommands commands"""
+    while len(self.cmdBytesInFlight) > max(0, pendingCommands):
+      self.bytesInFlight -= self.cmdBytesInFlight.popleft()
+
+  def _clearBytesInFlight(self):
+    self.bytesInFlight = 0
+    self.cmdBytesInFlight.clear()
+
+  def _canSend(self, cmd):
+    """Returns true if there is room in Marlin for cmd, both in the command buffer and,
+       if byte counting is enabled, in the serial receive buffer. A command is always
+       allowed when nothing else is in flight, no matter how long it is."""
+    if self.marlinBufferCapacity() <= 0:
+      return False
+    if self.marlinRxBufferSize and self.cmdBytesInFlight:
+      return self.bytesInFlight + len(cmd) + 1 <= self.marlinRxBufferSize
+    return True
+
+  def _nextCommand(self):
+    """Returns the class and command which the scheduler will send next, or
+       None, None if nothing is queued"""
+    cls = self.scheduler.nextClass(not self.history.atEnd())
+    if cls is None:
+      return None, None
+    if cls == CommandScheduler.PRINT:
+      return cls, self.history.peekNextCommand()
+    return cls, self.scheduler.peek(cls)
+
+  def _canSendNext(self):
+    """Returns true if the next queued command can be sent"""
+    cls, cmd = self._nextCommand()
+    return cls is not None and self._canSend(cmd)
+
+  def _sendNext(self):
+    """Sends the next queued command if there is room for it in Marlin and returns
+       its class, or None if nothing was sent. Print commands are read from the
+       history. Generally only the most recently history command is sent; but
+       after a resend request, we may be further back in the history than that"""
+    cls, cmd = self._nextCommand()
+    if cls is None or not self._canSend(cmd):
+      return None
+    if cls == CommandScheduler.PRINT:
+      self.history.getNextCommand()
+      self._sendImmediate(cmd)
+      self.pacingStrategy.onSent()
+    else:
+      self._sendImmediate(self.scheduler.pop(cls))
+    self.scheduler.charge(cls)
+    return cls
+
+  def _startCoalescing(self):
+    if self.coalesceWrites:
+      self.writeBuffer = []
+
+  def _writeCoalesced(self):
+    """Writes out the commands gathered since _startCoalescing()"""
+    if self.writeBuffer:
+      self.serial.write(b'\n'.join(self.writeBuffer) + b'\n')
+      self.serial.flush()
+    self.writeBuffer = None
 
   def _sendToMarlin(self):
-    """Sends as many commands as are available and to fill the Marlin buffer.
-       Commands are first read from the asap queue, then read from the
-       history. Generally only the most recently history command is sent;
-       but after a resend request, we may be further back in the history
-       than that"""
-    while(len(self.asap) and self.marlinBufferCapacity() > 0):
-      cmd = self.asap.pop(0);
-      self._sendImmediate(cmd)
-    while(not self.history.atEnd() and self.marlinBufferCapacity() > 0):
-      pos, cmd = self.history.getNextCommand();
-      self._sendImmediate(cmd)
-      if self.marlinBufferCapacity() > 0:
-        # Slow down refill of Marlin buffer, as sending multiple commands
-        # in a large burst can cause additional serial errors
-        time.sleep(0.01)
-
-  def _isResendRequest(self, line):
-    """If the line is a resend command from Marlin, returns the line number. This
-       code was taken from Cura 1, I do not know why it is so convoluted."""
-    if b"resend" in line.lower() or b"rs" in line:
-      try:
-        return int(line.replace(b"N:",b" ").replace(b"N",b" ").replace(b":",b" ").split()[-1])
-      except:
-        if b"rs" in line:
-          try:
-            return int(line.split()[1])
-          except:
-            return None
-
-  def _isNoLineNumberErr(self, line):
-    """If Marlin encounters a checksum without a line number, it will request
-       a resend. This often happens at the start of a print, when a command is
-       sent prior to Marlin being ready to listen."""
-    if line.startswith(b"Error:No Line Number with checksum"):
-      m = re.search(b"Last Line: (\d+)", line);
-      if(m):
-        return int(m.group(1)) + 1
+    """Sends as many commands as are available and to fill the Marlin buffer,
+       in the order decided by the scheduler"""
+    self._startCoalescing()
+    while True:
+      cls = self._sendNext()
+      if cls is None:
+        break
+      if cls == CommandScheduler.PRINT and self.marlinBufferCapacity() > 0 and not self.coalesceWrites:
+        # Sending multiple commands in a large burst can cause
+        # additional serial errors, so let the strategy pace them
+        self.pacingStrategy.pace(self.serial)
+    self._writeCoalesced()
 
   def _resetMarlinLineCounter(self):
     """Sends a command requesting that Marlin reset its line counter to match
@@ -179,23 +306,54 @@ class MarlinSerialProtocol:
        command (no line number, with an asterisk). Once it requests a resend,
        we will back into a known good state (hopefully!)"""
     if self.marlinPendingCommands > 0:
-      if time.time() > self.watchdogTimeout:
+      if self.watchdog.clock() > self.watchdog.deadline():
         self.marlinAvailBuffer     = self.marlinReserve + 1
         self.marlinPendingCommands = 0
+        self.marlinQueuedCommands  = 0
+        self._clearBytesInFlight()
+        self.watchdog.onReset()
+        if self.stats:
+          self.stats.onWatchdog()
         self._sendImmediate(b"\nM105*\n")
         self.sendNotification("Marlin timeout. Forcing re-sync.")
       elif line == b"":
-        self.sendNotification("Marlin timeout in %d seconds" % (self.watchdogTimeout - time.time()))
+        self.sendNotification("Marlin timeout in %d seconds" % (self.watchdog.deadline() - self.watchdog.clock()))
 
   def _adjustStallWatchdogTimer(self, cmd):
-    """Adjusts the stallWatchdogTimer based on the command which is being sent"""
-    estimated_duration = self.slowTimeout if self.slowCommands.search(cmd) else self.fastTimeout
-    self.watchdogTimeout = max(self.watchdogTimeout, time.time() + estimated_duration)
+    """Informs the watchdog of the command which is being sent"""
+    self.watchdog.onSent(cmd)
+
+  def _limitReadTimeout(self):
+    """Shortens the serial timeout while commands are pending, so that a read does
+       not block past the watchdog deadline. To avoid reconfiguring the port on
+       every read, the timeout is rounded up to a tenth of a second."""
+    timeout = self.readTimeout
+    if self.marlinPendingCommands > 0:
+      remaining = math.ceil((self.watchdog.deadline() - self.watchdog.clock()) * 10) / 10.0
+      timeout   = min(timeout, max(self.minReadTimeout, remaining))
+    if self.serial.timeout != timeout:
+      self.serial.timeout = timeout
 
   def _resendFrom(self, position):
-    """If Marlin requests a resend, we need to backtrack."""
-    self.history.rewindTo(position)
+    """If Marlin requests a resend, we need to backtrack. A request for a line
+       which is no longer in the history, as a corrupted request can be, is
+       answered from the oldest line retained, after resetting Marlin's line
+       counter to match."""
+    try:
+      self.history.rewindTo(position)
+      resync = False
+    except GCodeHistoryError as e:
+      self.sendNotification("%s. Forcing re-sync." % e)
+      position = self.history.oldestPosition()
+      self.history.rewindTo(position)
+      resync = True
+    self.pacingStrategy.onResend()
+    self.watchdog.onReset()
+    if self.stats:
+      self.stats.onResend()
     self.marlinPendingCommands = 0
+    self.marlinQueuedCommands  = 0
+    self._clearBytesInFlight()
     if not self.usingAdvancedOk:
       # When not using ADVANCED_OK, we have no way of knowing
       # for sure how much buffer space is available, but since
@@ -207,6 +365,8 @@ class MarlinSerialProtocol:
       # acknowleged, we will be informed of how many buffer slots
       # are actually free.
       self.marlinAvailBuffer = self.marlinReserve + 1
+    if resync:
+      self._resetMarlinLineCounter()
     if self.onResendCallback:
       self.onResendCallback(position)
 
@@ -226,19 +386,33 @@ class MarlinSerialProtocol:
     cmd = self._addPositionAndChecksum(self.history.getAppendPosition(), cmd)
     self.history.append(cmd)
 
-  def sendCmdUnreliable(self, line):
-    """Sends a command (can contain comments or blanks) prior to any other
-       history commands. Commands will be processed during calls to
-       readLine() or clearToSend(). These commands are sent without a
-       checksum, so Marlin will not request resends if the command is
-       corrupted. Unreliable transmission is appropriate for manual
-       interactive commands from an UI that is not part of a print.
+  def sendCmdFramed(self, position, frame):
+    """Adds a command which has already been framed with a line number and checksum,
+       such as those produced by a GCodeFramingPipeline, to the queue for reliable
+       transmission. The position must be the next one in the history."""
+    if position != self.history.getAppendPosition():
+      raise ValueError("Expected a frame for line %d, got line %d" % (self.history.getAppendPosition(), position))
+    self.history.append(frame)
+
+  def sendCmdUnreliable(self, line, priority=CommandScheduler.INTERACTIVE, key=None, force=False):
+    """Sends a command (can contain comments or blanks) interleaved with the
+       history commands according to its priority, which is a scheduler class.
+       Commands will be processed during calls to readLine() or clearToSend().
+       These commands are sent without a checksum, so Marlin will not request
+       resends if the command is corrupted. Unreliable transmission is
+       appropriate for manual interactive commands from an UI that is not part
+       of a print. A queued command with the same key, such as "jog" for
+       absolute jog targets, is replaced rather than sent. Returns False if the
+       command was dropped because too many commands are queued, unless force
+       is set, which queues it regardless.
     """
     if isinstance(line, str):
       line = line.encode()
     cmd = self._stripCommentsAndWhitespace(line)
-    if cmd:
-      self.asap.append(cmd)
+    if cmd and not self.scheduler.push(cmd, priority, key, force):
+      self.sendNotification("Dropped %s: too many %s commands queued" % (cmd.decode(errors = "replace"), priority))
+      return False
+    return True
 
   def sendCmdEmergency(self, line):
       """Sends an command (can contain comments or blanks) without regards for Marlin buffer.
@@ -253,16 +427,23 @@ class MarlinSerialProtocol:
     if self.onDebugMsgCallback:
       self.onDebugMsgCallback(msg)
 
-  def _gotOkay(self, line):
-    m = re.search(b"ok N(\d+) P(\d+) B(\d+)\n", line)
-    if m:
+  def _gotOkay(self, reply):
+    if isinstance(reply, AdvancedOk):
       # If ADVANCED_OK is enabled in Marlin, we can use that
       # info to correct our estimate of many free slots are
       # available in the Marlin command buffer.
-      lastLineSeen  = int(m.group(1))
-      buffAvailable = int(m.group(3))
-      self.marlinPendingCommands = max(0, self.history.lastLineSent() - lastLineSeen)
-      self.marlinAvailBuffer     = min(self.marlinBufSize, buffAvailable) - self.marlinPendingCommands
+      self._discoverBufferSizes(reply)
+      self.marlinPendingCommands = max(0, self.history.lastLineSent() - reply.lastLine)
+      self.marlinAvailBuffer     = min(self.marlinBufSize, reply.bufferAvail) - self.marlinPendingCommands
+      self._acknowledgeBytes(self.marlinPendingCommands)
+      # Pending commands are only those Marlin has yet to receive; those
+      # waiting in its command buffer are the slots which are not free.
+      queued = max(0, self.marlinBufSize - reply.bufferAvail)
+      self.marlinQueuedCommands = queued
+      # The command acknowledged is the one received before those queued. If
+      # some of these were unreliable, it is an earlier one, which errs on the
+      # safe side.
+      self.watchdog.onOkay(reply.lastLine - queued)
       if not self.usingAdvancedOk:
         self.usingAdvancedOk = True
         self.sendNotification("Marlin supports ADVANCED_OK")
@@ -271,32 +452,77 @@ class MarlinSerialProtocol:
       # the Marlin buffer.
       self.marlinAvailBuffer     += 1
       self.marlinPendingCommands -= 1
+      self._acknowledgeBytes(len(self.cmdBytesInFlight) - 1)
+      queued = self.marlinPendingCommands
+      self.marlinQueuedCommands = 0
+      self.watchdog.onOkay()
+    self.history.acknowledge(self.lastLineAcknowledged())
+    self.queueDepthTotal   += queued
+    self.queueDepthSamples += 1
+    if self.stats:
+      self.stats.onOkay(self.marlinPendingCommands + self.marlinQueuedCommands, queued)
+
+  def _discoverBufferSizes(self, reply):
+    """ADVANCED_OK reports how many command buffer (B) and planner (P) slots are free,
+       so the largest values ever seen tell us how large those buffers are. Grow the
+       flow control window to make use of the entire command buffer."""
+    if reply.bufferAvail > self.marlinBufSize:
+      self._setMarlinBufSize(reply.bufferAvail, "ADVANCED_OK")
+    if self.marlinPlannerSize is None or reply.plannerAvail + 1 > self.marlinPlannerSize:
+      self.marlinPlannerSize = reply.plannerAvail + 1
+
+  def _setMarlinBufSize(self, size, source):
+    self.marlinAvailBuffer += size - self.marlinBufSize
+    self.marlinBufSize      = size
+    self.sendNotification("Marlin command buffer has at least %d slots (from %s)" % (size, source))
+
+  def _gotCapability(self, reply):
+    """Records capabilities reported by M115. Stock Marlin does not report its buffer
+       sizes, but if a firmware does, use them to size the flow control window and,
+       unless one was configured, the serial receive buffer."""
+    self.marlinCapabilities[reply.name] = reply.value
+    if reply.name == "BUFSIZE" and reply.value > self.marlinBufSize:
+      self._setMarlinBufSize(reply.value, "M115")
+    if reply.name == "RX_BUFFER_SIZE" and not self.marlinRxBufferSize:
+      self.marlinRxBufferSize = reply.value
+    if reply.name == "BLOCK_BUFFER_SIZE":
+      self.marlinPlannerSize = reply.value
+
+  def _gotBusy(self, reply):
+    self.watchdog.onBusy()
+
+  def _gotError(self, reply):
+    # Sometimes Marlin replies with an "Error:", but not an "ok".
+    # So if we got an error, followed by a timeout, stop waiting
+    # for an "ok" as it probably ain't coming
+    self.gotError = True
+
+  def _gotTimeout(self, reply):
+    if self.gotError:
+      self.gotError = False
+      self._gotOkay(reply)
 
   def _readline(self, blocking):
-    """Reads input from Marlin"""
+    """Reads input from Marlin and returns it as a typed reply"""
     if blocking or self.serial.in_waiting:
+      if self.readTimeout:
+        self._limitReadTimeout()
       line = self.serial.readline()
     else:
       line = b""
-
-    if b"busy: processing" in line:
-      self._adjustStallWatchdogTimer("busy")
-
-    if line.startswith(b"ok"):
-      self._gotOkay(line)
-
-    # Sometimes Marlin replies with an "Error:", but not an "ok".
-    # So if we got an error, followed by a timeout, stop waiting
-    # for an "ok" as it probably ain't coming
-    if line.startswith(b"ok"):
+    return self._parseReply(line)
+
+  def _parseReply(self, line):
+    """Classifies a line received from Marlin and updates the flow control state"""
+    reply   = parseReply(line)
+    handler = self.replyHandlers.get(type(reply))
+    if handler:
+      handler(reply)
+    if isinstance(reply, Ok):
       self.gotError = False
-    elif line.startswith(b"Error:"):
-      self.gotError = True;
-    elif line == b"" and self.gotError:
-      self.gotError = False
-      self._gotOkay(line)
-
-    return line
+    if self.telemetry:
+      self.telemetry.onReply(reply)
+    return reply
 
   def readline(self, blocking = True):
     """This reads data from Marlin. If no data is available '' will be returned.
@@ -305,50 +531,92 @@ class MarlinSerialProtocol:
 
     self._sendToMarlin()
 
-    line = self._readline(blocking)
+    reply = self._readline(blocking)
+
+    return self._handleReply(reply)
+
+  def _handleReply(self, reply):
+    """Handles stalls and resend requests following a reply from Marlin. Returns
+       the line received, or '' if it was a resend request."""
+    line = reply.line
 
     # Watch for and attempt to recover from complete stalls.
     self._stallWatchdog(line)
 
     # Handle resend requests from Marlin. This happens when Marlin
     # detects a command with a checksum or line number error.
-    resendPos = self._isResendRequest(line) or self._isNoLineNumberErr(line)
+    resendPos = reply.resendPosition
     if resendPos:
       # If we got a resend requests, purge lines until input buffer is empty
       # or timeout, but watch for any subsequent resend requests (we must
       # only act on the last).
       while line != b"":
-        line = self._readline(False)
-        resendPos = self._isResendRequest(line) or self._isNoLineNumberErr(line) or resendPos
-      # Process the last received resend request:
-      if resendPos > self.history.position():
-        # If Marlin is asking us to step forward in time, reset its counter.
-        self._resetMarlinLineCounter()
-      else:
-        # Otherwise rewind to where Marlin wants us to resend from.
-        self._resendFrom(resendPos)
+        reply = self._readline(False)
+        line  = reply.line
+        resendPos = reply.resendPosition or resendPos
+      self._handleResend(resendPos)
       # Report a timeout to the calling code.
       line = b""
 
     return line
 
+  def _handleResend(self, resendPos):
+    """Processes the last received resend request"""
+    if resendPos > self.history.position():
+      # If Marlin is asking us to step forward in time, reset its counter.
+      self._resetMarlinLineCounter()
+    else:
+      # Otherwise rewind to where Marlin wants us to resend from.
+      self._resendFrom(resendPos)
+
   def clearToSend(self):
     """Returns true if there is any space available for new commands, once previously
        queued commands are sent"""
     self._sendToMarlin()
-    return self.marlinBufferCapacity() > 0
+    clear = self.marlinBufferCapacity() > 0 and self.history.atEnd()
+    if self.stats:
+      self.stats.onClearToSend(clear)
+    return clear
+
+  def queryCapabilities(self):
+    """Sends a M115 to ask Marlin to report its capabilities. These are parsed as they
+       are received, during calls to readline()"""
+    self.sendCmdUnreliable(b"M115", force = True)
+
+  def setAutoReport(self, interval):
+    """Asks Marlin to report temperatures every interval seconds, or to stop if
+       interval is 0. This requires AUTO_REPORT_TEMPERATURES in Marlin, which is
+       reported by M115 as Cap:AUTOREPORT_TEMP:1."""
+    self.sendCmdUnreliable(b"M155 S%d" % interval, force = True)
+
+  def averageQueueDepth(self):
+    """Returns the average number of commands queued in Marlin when an "ok" was received.
+       Without ADVANCED_OK, this counts all commands not yet acknowledged."""
+    return float(self.queueDepthTotal) / self.queueDepthSamples if self.queueDepthSamples else 0
 
   def marlinBufferCapacity(self):
     """Returns how many buffer positions are open in Marlin, excluding reserved locations."""
     return self.marlinAvailBuffer - self.marlinReserve
 
-  def restart(self):
-    """Clears all buffers and issues a M110 to Marlin. Call this at the start of every print."""
-    self.history.clear()
-    self.stallCountdown        = self.fastTimeout
+  def lastLineAcknowledged(self):
+    """Returns the position of the last command which Marlin has acknowledged.
+       Unreliable commands in flight are counted too, so this errs on the early side."""
+    return self.history.lastLineSent() - max(0, self.marlinPendingCommands)
+
+  def restart(self, position = 1):
+    """Clears all buffers and issues a M110 to Marlin. Call this at the start of every print.
+       To resume a print, position is that of the next command to be sent."""
+    self.history.clear(position)
+    self.watchdog.onReset()
+    if self.stats:
+      self.stats.onReset()
     self.gotError              = False
     self.marlinPendingCommands = 0
+    self.marlinQueuedCommands  = 0
     self.marlinAvailBuffer     = self.marlinBufSize
+    self._clearBytesInFlight()
+    self.queueDepthTotal       = 0
+    self.queueDepthSamples     = 0
     self._flushReadBuffer()
     self._resetMarlinLineCounter()
 
@@ -0,0 +1,142 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# Marlin reports temperatures, positions and informational messages as
+# ordinary lines on the serial port, either in reply to M105 and M114 or,
+# if AUTO_REPORT_TEMPERATURES is enabled, every few seconds once M155 has
+# been sent. When a MarlinTelemetry is passed to MarlinSerialProtocol,
+# every reply read is handed to it, and these lines are turned into
+# events which are published to subscribers:
+#
+#   TemperatureReport  T:210.00 /210.00 B:60.00 /60.00 @:127 B@:0
+#   PositionReport     X:10.00 Y:0.00 Z:0.00 E:0.00 Count X:800 Y:0 Z:0
+#   EchoMessage        echo:Active Extruder: 0
+#
+# Since the replies are already being read for flow control, a host can
+# follow the printer's state without adding commands to the queue.
+
+import re
+import time
+
+from pyMarlin.marlinReplyParser import Ok, Temp, Position, Echo
+
+_temperaturePattern = re.compile(br"(\w*@|[A-Z]\d*):\s*(-?[\d.]+)(?:\s*/\s*(-?[\d.]+))?")
+_positionPattern    = re.compile(br"([XYZE]):\s*(-?[\d.]+)")
+
+def parseTemperatures(line):
+  """Returns a dictionary of the temperatures in a report, keyed by sensor
+     (such as "T", "T0", "B" or "C"), as (actual, target) tuples, where target
+     is None if not reported, and a dictionary of heater powers (such as "@"
+     or "B@")"""
+  temperatures = {}
+  power        = {}
+  for name, actual, target in _temperaturePattern.findall(line):
+    name = name.decode()
+    if name in ("E", "W"):
+      continue # The active extruder and time left to wait, in M109 reports
+    try:
+      if name.endswith("@"):
+        power[name] = int(float(actual))
+      else:
+        temperatures[name] = (float(actual), float(target) if target else None)
+    except ValueError:
+      pass # Corrupted in transmission
+  return temperatures, power
+
+def parsePosition(line):
+  """Returns a dictionary of the axis positions in a report, ignoring the
+     stepper counts which follow "Count" """
+  position = {}
+  for axis, value in _positionPattern.findall(line.split(b"Count", 1)[0]):
+    try:
+      position[axis.decode()] = float(value)
+    except ValueError:
+      pass
+  return position
+
+class TemperatureReport:
+  """Temperatures as (actual, target) tuples and heater powers, keyed by sensor"""
+  __slots__ = ('time', 'temperatures', 'power')
+
+  def __init__(self, time, temperatures, power):
+    self.time         = time
+    self.temperatures = temperatures
+    self.power        = power
+
+  def __repr__(self):
+    return "TemperatureReport(%r, %r)" % (self.temperatures, self.power)
+
+class PositionReport:
+  """Axis positions in mm, keyed by axis"""
+  __slots__ = ('time', 'position')
+
+  def __init__(self, time, position):
+    self.time     = time
+    self.position = position
+
+  def __repr__(self):
+    return "PositionReport(%r)" % (self.position,)
+
+class EchoMessage:
+  """The text of an informational message, without the echo: prefix"""
+  __slots__ = ('time', 'text')
+
+  def __init__(self, time, text):
+    self.time = time
+    self.text = text
+
+  def __repr__(self):
+    return "EchoMessage(%r)" % (self.text,)
+
+class MarlinTelemetry:
+  """Publishes the temperatures, positions and messages reported by Marlin to
+     subscribers. Callbacks are subscribed to an event class and are called
+     with each event of that class, from whichever thread reads the replies.
+     The most recent event of each class is kept in latest."""
+  def __init__(self):
+    self.subscribers = {TemperatureReport: [], PositionReport: [], EchoMessage: []}
+    self.latest      = {}
+
+  def subscribe(self, eventType, callback):
+    self.subscribers[eventType].append(callback)
+
+  def unsubscribe(self, eventType, callback):
+    self.subscribers[eventType].remove(callback)
+
+  def _publish(self, event):
+    self.latest[type(event)] = event
+    for callback in self.subscribers[type(event)]:
+      callback(event)
+
+  def onReply(self, reply):
+    """Turns a reply into an event, if it reports something of interest"""
+    if isinstance(reply, Temp) or (isinstance(reply, Ok) and b"T:" in reply.line):
+      # M105 replies with "ok T:..." on a single line
+      temperatures, power = parseTemperatures(reply.line)
+      if temperatures:
+        self._publish(TemperatureReport(time.time(), temperatures, power))
+    elif isinstance(reply, Position):
+      position = parsePosition(reply.line)
+      if position:
+        self._publish(PositionReport(time.time(), position))
+    elif isinstance(reply, Echo):
+      self._publish(EchoMessage(time.time(), reply.line[5:].strip().decode(errors = "replace")))
+
+  def temperature(self, sensor = "T"):
+    """Returns the latest (actual, target) temperature of a sensor, or None"""
+    report = self.latest.get(TemperatureReport)
+    return report.temperatures.get(sensor) if report else None
+
+  def position(self):
+    """Returns the latest reported position, or None"""
+    report = self.latest.get(PositionReport)
+    return report.position if report else None
@@ -10,42 +10,122 @@
 # FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
 #
 
+# Faults on real serial and USB links are rarely independent single
+# character errors: noise comes in bursts, bytes go missing, lines are
+# cut short or repeated, and replies arrive late. NoiseModel describes
+# which of these faults are injected into one direction of a connection,
+# and how often. Each NoisySerialConnection draws from its own random
+# number generator, so a given seed always injects the same faults.
+
+import collections
 import random
 import string
 
+class NoiseModel:
+  """This class describes the faults injected into one direction of a
+     NoisySerialConnection. Each rate is the probability that a line is
+     affected by that fault:
+
+       corruptRate    A single character is replaced by a random letter
+       dropRate       A run of up to maxDropped bytes goes missing
+       duplicateRate  The line is delivered twice
+       truncateRate   The end of the line, including the newline, is lost
+       delayRate      The line is delivered one read late (reads only)
+
+     Bursts follow the Gilbert-Elliott model: a two state Markov chain which,
+     after each line, enters the bad state with probability enterBurst and
+     leaves it with probability leaveBurst. While in the bad state, lines
+     are additionally corrupted with probability burstRate."""
+  def __init__(self, corruptRate = 0, dropRate = 0, duplicateRate = 0, truncateRate = 0, delayRate = 0, maxDropped = 8):
+    self.corruptRate   = corruptRate
+    self.dropRate      = dropRate
+    self.duplicateRate = duplicateRate
+    self.truncateRate  = truncateRate
+    self.delayRate     = delayRate
+    self.maxDropped    = maxDropped
+    self.enterBurst    = 0
+    self.leaveBurst    = 1
+    self.burstRate     = 0
+    self.inBurst       = False
+
+  def setBurst(self, enterBurst, leaveBurst, burstRate = 0.5):
+    """Enables bursts; the mean burst length is 1/leaveBurst lines"""
+    self.enterBurst = enterBurst
+    self.leaveBurst = leaveBurst
+    self.burstRate  = burstRate
+
 class NoisySerialConnection:
-  """Wrapper class which injects character noise into data of
-     a serial connection for testing Marlin's error correction"""
-  def __init__(self, serial):
-    self.serial         = serial
-    self.readErrorRate  = 0
-    self.writeErrorRate = 0
+  """Wrapper class which injects faults into data of a serial connection
+     for testing Marlin's error correction. The faults are described by
+     writeModel and readModel, and drawn from a generator seeded by seed.
+     The number of faults of each kind injected is counted in faults."""
+  def __init__(self, serial, seed = None):
+    self.serial     = serial
+    self.random     = random.Random(seed)
+    self.writeModel = NoiseModel()
+    self.readModel  = NoiseModel()
+    self.pending    = collections.deque() # Lines held back for later reads
+    self.faults     = collections.Counter()
 
   def _corruptData(self, data):
     """Introduces a single character error on a string"""
-    badChar = random.choice(string.ascii_letters)
+    badChar = self.random.choice(string.ascii_letters)
     badChar = badChar if isinstance(data, str) else badChar.encode()
     if len(data) == 0:
       return data
     if len(data) == 1:
       return badChar
-    charToCorrupt = random.randint(0, len(data) - 1)
+    charToCorrupt = self.random.randint(0, len(data) - 1)
     return data[:charToCorrupt] + badChar + data[charToCorrupt+1:]
 
-  def write(self, data):
-    if(random.random() < self.writeErrorRate):
+  def _applyNoise(self, model, data):
+    """Returns the list of lines to deliver in place of a line"""
+    rand = self.random.random
+    if model.inBurst:
+      model.inBurst = rand() >= model.leaveBurst
+    else:
+      model.inBurst = rand() < model.enterBurst
+    if model.inBurst and rand() < model.burstRate:
+      self.faults["burst"] += 1
       data = self._corruptData(data)
-    self.serial.write(data)
+    if rand() < model.corruptRate:
+      self.faults["corrupt"] += 1
+      data = self._corruptData(data)
+    if data and rand() < model.dropRate:
+      self.faults["drop"] += 1
+      start = self.random.randint(0, len(data) - 1)
+      data  = data[:start] + data[start + self.random.randint(1, model.maxDropped):]
+    if data and rand() < model.truncateRate:
+      self.faults["truncate"] += 1
+      data = data[:self.random.randint(0, len(data) - 1)]
+    if rand() < model.duplicateRate:
+      self.faults["duplicate"] += 1
+      return [data, data]
+    return [data]
+
+  def write(self, data):
+    # A coalesced write carries several lines, each of which gets its own noise
+    lines = data.splitlines(True) or [data]
+    noisy = [noisy for line in lines for noisy in self._applyNoise(self.writeModel, line) if noisy]
+    if noisy:
+      self.serial.write(noisy[0][:0].join(noisy))
 
   def readline(self):
+    if self.pending:
+      return self.pending.popleft()
     data = self.serial.readline()
-    if(random.random() < self.readErrorRate):
-      data = self._corruptData(data)
-    return data
+    if data == b"":
+      return data
+    self.pending.extend(self._applyNoise(self.readModel, data))
+    if self.random.random() < self.readModel.delayRate:
+      # Make the caller time out, the line will be returned by the next read
+      self.faults["delay"] += 1
+      return b""
+    return self.pending.popleft()
 
   @property
   def in_waiting(self):
-    return self.serial.in_waiting
+    return self.serial.in_waiting + sum(len(line) for line in self.pending)
 
   @property
   def out_waiting(self):
@@ -55,6 +135,7 @@ class NoisySerialConnection:
     self.serial.flush()
 
   def reset_input_buffer(self):
+    self.pending.clear()
     self.serial.reset_input_buffer()
 
   def reset_output_buffer(self):
@@ -81,8 +162,8 @@ class NoisySerialConnection:
 
   def setWriteErrorRate(self, badWrites, totalWrites):
     """Inserts a single character error into every badWrites out of totalWrites"""
-    self.writeErrorRate = float(badWrites)/float(totalWrites)
+    self.writeModel.corruptRate = float(badWrites)/float(totalWrites)
 
   def setReadErrorRate(self, badReads, totalReads):
     """Inserts a single character error into every badReads out of totalReads"""
-    self.readErrorRate = float(badReads)/float(totalReads)
\ No newline at end of file
+    self.readModel.corruptRate = float(badReads)/float(totalReads)
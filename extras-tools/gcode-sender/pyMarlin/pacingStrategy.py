@@ -0,0 +1,87 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# When MarlinSerialProtocol refills the Marlin buffer with several
+# commands at once, sending them in a single large burst can cause
+# additional serial errors on a marginal link. A pacing strategy decides
+# how long to pause between the commands of a burst. Strategies are
+# informed of every command sent and every resend request from Marlin
+# and may adapt accordingly.
+
+import time
+
+class FixedPacing:
+  """Pauses for a fixed delay between commands of a burst, regardless of
+     link quality. This was the original behavior of MarlinSerialProtocol."""
+  def __init__(self, delay = 0.01):
+    self.delay = delay
+
+  def onSent(self):
+    pass
+
+  def onResend(self):
+    pass
+
+  def pace(self, serial):
+    time.sleep(self.delay)
+
+class AdaptivePacing:
+  """Sends full bursts while the link is clean and backs off only when
+     errors appear. The resend rate is tracked as an exponentially
+     weighted average over roughly the last window commands. Below
+     minErrorRate no delay is used; above that, the delay grows linearly
+     up to maxDelay, which is reached at maxErrorRate. Independently of
+     errors, it waits for the serial port's transmit buffer to drain below
+     maxOutWaiting bytes, so that data does not pile up in the operating
+     system. If the port stalls, it stops waiting after drainFactor times
+     the time the bytes should take at the port's baud rate, plus
+     minDrainTime seconds, or after maxDrainTime seconds if the baud rate
+     is unknown, leaving the stall to the watchdog."""
+  def __init__(self, maxDelay = 0.01, minErrorRate = 0.01, maxErrorRate = 0.1, window = 100, maxOutWaiting = 256,
+               drainFactor = 4, minDrainTime = 0.05, maxDrainTime = 1.0):
+    self.maxDelay      = maxDelay
+    self.minErrorRate  = minErrorRate
+    self.maxErrorRate  = maxErrorRate
+    self.alpha         = 1.0 / window
+    self.maxOutWaiting = maxOutWaiting
+    self.drainFactor   = drainFactor
+    self.minDrainTime  = minDrainTime
+    self.maxDrainTime  = maxDrainTime
+    self.errorRate     = 0
+
+  def onSent(self):
+    self.errorRate *= 1 - self.alpha
+
+  def onResend(self):
+    self.errorRate += self.alpha
+
+  def delay(self):
+    """Returns the current delay between commands of a burst"""
+    excess = (self.errorRate - self.minErrorRate) / (self.maxErrorRate - self.minErrorRate)
+    return self.maxDelay * min(1, max(0, excess))
+
+  def drainTime(self, serial, pending):
+    """Returns how long to wait for pending bytes to be transmitted"""
+    baudrate = getattr(serial, "baudrate", None)
+    if not baudrate:
+      return self.maxDrainTime
+    return self.minDrainTime + self.drainFactor * pending * 10.0 / baudrate # 10 bits per byte
+
+  def pace(self, serial):
+    delay = self.delay()
+    if delay:
+      time.sleep(delay)
+    pending = serial.out_waiting
+    if pending > self.maxOutWaiting:
+      deadline = time.time() + self.drainTime(serial, pending)
+      while serial.out_waiting > self.maxOutWaiting and time.time() < deadline:
+        time.sleep(0.001)
@@ -0,0 +1,205 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# If the host or the USB link dies during a long print, the print can
+# be resumed rather than restarted, provided the host knows how far
+# Marlin got. The class CheckpointWriter follows a print as it is sent:
+# it is told the line number and byte offset of each command queued and
+# the last line acknowledged by Marlin, and tracks the modal state (the
+# positioning modes, feedrate, position and temperature setpoints) as of
+# that line. A background thread writes the latest checkpoint to a small
+# JSON file every interval seconds, under a temporary name which is then
+# renamed, so the file is never seen partially written.
+#
+# PrintCheckpoint.load() reads the checkpoint back. Sending the commands
+# returned by resumeCommands() restores the temperatures and modes and
+# brings the nozzle back to where it was, lifted clear of the print on
+# the way, after which the print continues from the saved byte offset,
+# without reading any of the file before it.
+#
+# Marlin acknowledges a command once it is in the planner, so if the host
+# dies, Marlin finishes every acknowledged move by itself. After a loss of
+# power, however, the moves in the planner are lost and the position is
+# unknown; the machine must be homed by hand before resuming.
+
+import collections
+import hashlib
+import json
+import os
+import threading
+import time
+
+from pyMarlin.gcodeCompactor import parseCmd, GCodeModalState
+
+class PrintCheckpoint:
+  """The state of a print as of the last line acknowledged by Marlin. The
+     offset is that of the next byte to be read from the file. So that a
+     checkpoint is not applied to a file which has since been edited, the
+     file's size and a hash of its contents are kept. The hash is computed
+     once per job, not on every checkpoint written."""
+  HEATERS = {b"M104": "T", b"M109": "T", b"M140": "B", b"M190": "B"}
+  FIELDS  = ("filename", "size", "fingerprint", "position", "offset", "axes", "feedrate", "relative", "relativeE", "temperatures")
+
+  def __init__(self, filename):
+    self.filename     = os.path.realpath(filename)
+    self.size         = os.path.getsize(self.filename)
+    self.fingerprint  = self._hashFile()
+    self.position     = 0 # Line number of the last command acknowledged
+    self.offset       = 0
+    self.state        = GCodeModalState()
+    self.temperatures = {}
+
+  def update(self, cmd):
+    """Updates the state following a command"""
+    code, params = parseCmd(cmd)
+    self.state.update(code, params)
+    if code in self.HEATERS and params.get("S") is not None:
+      heater = self.HEATERS[code]
+      if heater == "T" and params.get("T") is not None:
+        heater = "T%d" % params["T"]
+      self.temperatures[heater] = params["S"]
+
+  def toDict(self):
+    return {
+      "filename":     self.filename,
+      "size":         self.size,
+      "fingerprint":  self.fingerprint,
+      "position":     self.position,
+      "offset":       self.offset,
+      "axes":         dict(self.state.position),
+      "feedrate":     self.state.feedrate,
+      "relative":     self.state.relative,
+      "relativeE":    self.state.relativeE,
+      "temperatures": dict(self.temperatures),
+      "time":         time.time()
+    }
+
+  def _hashFile(self, chunkSize = 1024 * 1024):
+    """Returns a hash of the file's contents"""
+    digest = hashlib.sha256()
+    with open(self.filename, "rb") as f:
+      for chunk in iter(lambda: f.read(chunkSize), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+  @classmethod
+  def load(cls, checkpointFile):
+    """Reads a checkpoint written by CheckpointWriter. Raises ValueError if it is
+       not a valid checkpoint or the file which was being printed has changed since."""
+    with open(checkpointFile) as f:
+      saved = json.load(f)
+    missing = [key for key in cls.FIELDS if key not in saved] if isinstance(saved, dict) else cls.FIELDS
+    if missing:
+      raise ValueError("not a checkpoint, missing %s" % ", ".join(missing))
+    checkpoint = cls(saved["filename"])
+    if checkpoint.size != saved["size"] or checkpoint.fingerprint != saved["fingerprint"]:
+      raise ValueError("%s has changed since the checkpoint was written" % checkpoint.filename)
+    checkpoint.position        = saved["position"]
+    checkpoint.offset          = saved["offset"]
+    checkpoint.state.position  = saved["axes"]
+    checkpoint.state.feedrate  = saved["feedrate"]
+    checkpoint.state.relative  = saved["relative"]
+    checkpoint.state.relativeE = saved["relativeE"]
+    checkpoint.temperatures    = saved["temperatures"]
+    return checkpoint
+
+  def restoreState(self, state):
+    """Copies the modal state into another GCodeModalState, such as that of a
+       GCodeCompactor, so that it picks up where the print left off"""
+    state.position  = dict(self.state.position)
+    state.feedrate  = self.state.feedrate
+    state.relative  = self.state.relative
+    state.relativeE = self.state.relativeE
+
+  def resumeCommands(self, lift = 5.0, travelFeedrate = 3000):
+    """Returns the commands which restore the temperatures, position and modes
+       as of the checkpoint, waiting for the heaters to reach their setpoints.
+       Marlin may have gone on to run commands which were never acknowledged,
+       so the nozzle is first lifted by lift mm from wherever it is, then moved
+       over the saved XY position and only then lowered to the saved Z."""
+    cmds = [b"G91", b"G1 Z%g F%g" % (lift, travelFeedrate), b"G90"]
+    for heater, temperature in sorted(self.temperatures.items()):
+      if heater == "B":
+        cmds.append(b"M190 S%g" % temperature)
+      else:
+        cmds.append(b"M109 S%g%s" % (temperature, b" T" + heater[1:].encode() if heater[1:] else b""))
+    position = self.state.position
+    xy = b"".join(b" %s%g" % (axis.encode(), position[axis]) for axis in "XY" if position[axis] is not None)
+    if xy:
+      cmds.append(b"G1%s F%g" % (xy, travelFeedrate))
+    if position["Z"] is not None:
+      cmds.append(b"G1 Z%g" % position["Z"])
+    cmds.append(b"G91" if self.state.relative else b"G90")
+    cmds.append(b"M83" if self.state.relativeE else b"M82")
+    if self.state.position["E"] is not None and not self.state.relativeE:
+      cmds.append(b"G92 E%g" % self.state.position["E"])
+    if self.state.feedrate:
+      cmds.append(b"G1 F%g" % self.state.feedrate)
+    return cmds
+
+class CheckpointWriter:
+  """Tracks a print sent from filename and writes its checkpoint to
+     checkpointFile every interval seconds, from a background thread.
+     A checkpoint loaded for resuming can be passed in to continue from."""
+  def __init__(self, filename, checkpointFile, interval = 1.0, resumeFrom = None):
+    self.checkpointFile = checkpointFile
+    self.interval       = interval
+    self.checkpoint     = resumeFrom or PrintCheckpoint(filename)
+    self.queued         = collections.deque() # (position, cmd, offset) not yet acknowledged
+    self.lock           = threading.Lock()
+    self.changed        = False
+    self.wakeup         = threading.Event()
+    self.running        = True
+    self.thread         = threading.Thread(target=self._run, name="CheckpointWriter")
+    self.thread.daemon  = True
+    self.thread.start()
+
+  def onQueued(self, position, cmd, offset):
+    """Records a command, which may be framed, and the offset just past it"""
+    if cmd.startswith(b"N"):
+      # Strip the line number and checksum
+      cmd = cmd.split(b"*", 1)[0].lstrip(b"N0123456789 ")
+    self.queued.append((position, cmd, offset))
+
+  def onAcknowledged(self, position):
+    """Advances the checkpoint to the last line acknowledged by Marlin"""
+    if not self.queued or self.queued[0][0] > position:
+      return
+    with self.lock:
+      while self.queued and self.queued[0][0] <= position:
+        pos, cmd, offset = self.queued.popleft()
+        self.checkpoint.update(cmd)
+        self.checkpoint.position = pos
+        self.checkpoint.offset   = offset
+      self.changed = True
+
+  def _write(self):
+    with self.lock:
+      if not self.changed:
+        return
+      saved = self.checkpoint.toDict()
+      self.changed = False
+    with open(self.checkpointFile + ".tmp", "w") as f:
+      json.dump(saved, f)
+    os.replace(self.checkpointFile + ".tmp", self.checkpointFile)
+
+  def _run(self):
+    while self.running:
+      self.wakeup.wait(self.interval)
+      self._write()
+
+  def close(self):
+    """Writes the final checkpoint and stops the background thread"""
+    self.running = False
+    self.wakeup.set()
+    self.thread.join()
+    self._write()
@@ -0,0 +1,516 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# Scheduling prints requires knowing how long each one will take. The
+# class PrintTimeEstimator reads a GCODE file line by line and estimates
+# the time Marlin will take to print it, in total and for each layer, by
+# modelling Marlin's planner:
+#
+#   - Each move becomes a block with a nominal speed, the feedrate limited
+#     by the maximum feedrate of each axis, and an acceleration, that for
+#     printing, travel or retract moves limited by the maximum acceleration
+#     of each axis.
+#
+#   - The speed at each junction between blocks is limited by junction
+#     deviation, or by the jerk of each axis if CLASSIC_JERK is enabled:
+#     the difference between the axis' speed at the start of the block and
+#     at the end of the previous one, slowed to the junction speed.
+#
+#   - Reverse and forward passes limit the speed at each junction so that
+#     every block can be reached and left within its acceleration. Marlin
+#     plans over the blocks in its buffer only and must always be able to
+#     stop at the end of it, so the entry speed of a block is also limited
+#     to what allows stopping within the following blockBufferSize - 1
+#     blocks.
+#
+#   - Each block then follows a trapezoidal speed profile: it accelerates
+#     from its entry speed, cruises at its nominal speed and decelerates to
+#     the entry speed of the next block.
+#
+# Moves are collected in batches and, if NumPy is available, the length,
+# speed, acceleration and junction speed of each block and the time of
+# each trapezoid are computed with array operations; otherwise in plain
+# Python. The planner passes run over the blocks of each batch, the last
+# few of which are held back until the blocks which follow them are known.
+#
+# Waiting for the planner to empty (G4, M400, heating and homing) brings
+# the machine to a stop. Time spent heating, homing or waiting for the
+# user cannot be known; such commands are counted in untimed instead.
+#
+# The limits default to those of the Cocoa Press. fromBuildConfig() reads
+# them from a printer's build-config.py, which overrides the settings in
+# Marlin's default Configuration.h and Configuration_adv.h. Commands which
+# change them (M201, M203, M204, M205) are honored as the file is read.
+
+import collections
+import importlib.util
+import math
+import os
+import re
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+from pyMarlin.gcodeCompactor import parseCmd
+
+AXES = "XYZE"
+
+def _parseDefine(value):
+  """Converts the value of a #define to a number or list, or returns it as is"""
+  value = value.strip()
+  if not value:
+    return True
+  if value.startswith("{") and value.endswith("}"):
+    return [_parseDefine(v) for v in value[1:-1].split(",")]
+  try:
+    return float(value.rstrip("f"))
+  except ValueError:
+    return value
+
+def loadBuildConfig(buildConfig, printer = None, toolhead = None):
+  """Returns the settings made by a build-config.py for printer and toolhead
+     (defaulting to the first listed), on top of those in the Configuration.h
+     and Configuration_adv.h which it modifies, as a dictionary keyed by name.
+     Settings which are commented out are omitted."""
+  spec   = importlib.util.spec_from_file_location("build_config", buildConfig)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  config = {}
+  # The defaults used by build-config.py when no input files are given
+  defaults = os.path.join(os.path.dirname(os.path.abspath(buildConfig)), "..", "..", "default")
+  define   = re.compile(r"^\s*#define\s+(\w+)(.*?)(//.*)?$")
+  for header in ("Configuration.h", "Configuration_adv.h"):
+    filename = os.path.join(defaults, header)
+    if not os.path.exists(filename):
+      continue
+    with open(filename) as f:
+      for line in f:
+        m = define.match(line)
+        if m and m.group(1) not in config:
+          config[m.group(1)] = _parseDefine(m.group(2))
+  config.update(module.make_config(printer or module.PRINTER_CHOICES[0], toolhead or module.TOOLHEAD_CHOICES[0]))
+  return config
+
+def trapezoidTime(length, speed, acceleration, entrySpeed = 0.0, exitSpeed = 0.0):
+  """Returns the time taken by a move of length mm which accelerates from
+     entrySpeed towards speed and decelerates to exitSpeed (all in mm/s)"""
+  cruise = length - (2 * speed * speed - entrySpeed * entrySpeed - exitSpeed * exitSpeed) / (2 * acceleration)
+  if cruise > 0:
+    return cruise / speed + (2 * speed - entrySpeed - exitSpeed) / acceleration
+  # Never reaches speed
+  peak = math.sqrt((entrySpeed * entrySpeed + exitSpeed * exitSpeed) / 2 + acceleration * length)
+  return (2 * peak - entrySpeed - exitSpeed) / acceleration
+
+class PrintTimeEstimator:
+  """Estimates the time taken to print GCODE by modelling Marlin's planner.
+     Lines are passed to addLine() as they are read, then finish() completes
+     the estimate. The maximum feedrates (mm/s) and accelerations (mm/s^2) of
+     each axis, the accelerations for printing, retract and travel moves and
+     the junction deviation (mm) default to those of the Cocoa Press. If jerk
+     is given as a dictionary of speeds (mm/s) keyed by axis, classic jerk is
+     used instead of junction deviation. Moves are planned in batches of
+     batchSize, using NumPy if useNumpy is True and it is available."""
+  SYNCHRONIZE = (b"G4", b"M400", b"M109", b"M190", b"G28", b"G29", b"M0", b"M1", b"M600")
+  UNTIMED     = (b"M109", b"M190", b"G28", b"G29", b"M0", b"M1", b"M600", b"G2", b"G3")
+
+  def __init__(self, maxFeedrates = None, maxAccelerations = None,
+               acceleration = 3000, retractAcceleration = 3000, travelAcceleration = 3000,
+               junctionDeviation = 0.013, jerk = None, minimumPlannerSpeed = 0.05,
+               minimumFeedrate = 0.0, minimumTravelFeedrate = 0.0, defaultFeedrate = 1500,
+               blockBufferSize = 16, batchSize = 4096, useNumpy = True):
+    self.maxFeedrates          = dict(maxFeedrates or {"X": 50, "Y": 50, "Z": 5, "E": 20})
+    self.maxAccelerations      = dict(maxAccelerations or {"X": 3000, "Y": 3000, "Z": 100, "E": 10000})
+    self.acceleration          = acceleration
+    self.retractAcceleration   = retractAcceleration
+    self.travelAcceleration    = travelAcceleration
+    self.junctionDeviation     = junctionDeviation
+    self.jerk                  = dict(jerk) if jerk else None
+    self.minimumPlannerSpeed   = minimumPlannerSpeed
+    self.minimumFeedrate       = minimumFeedrate
+    self.minimumTravelFeedrate = minimumTravelFeedrate
+    self.window                = max(1, blockBufferSize - 1)
+    self.batchSize             = batchSize
+    self.numpy                 = numpy if useNumpy else None
+    # Modal state
+    self.position              = dict((axis, 0.0) for axis in AXES)
+    self.relative              = False
+    self.relativeE             = False
+    self.feedrate              = defaultFeedrate / 60.0
+    self.feedrateMultiplier    = 1.0
+    # Moves not yet turned into blocks, as (dx, dy, dz, de, feedrate, layer)
+    self.moves                 = []
+    self.prevUnit              = None # Unit vector, axis speeds and nominal speed of the last block
+    self.prevAxisSpeeds        = None
+    self.prevNominalSqr        = 0.0
+    # Blocks not yet timed, as lists of length, acceleration, squared nominal speed and max entry speed, and layer
+    self.lengths, self.accels, self.nominalSqrs, self.maxEntrySqrs, self.blockLayers = [], [], [], [], []
+    self.entrySqr              = 0.0 # Entry speed of the first block not yet timed, which can no longer change
+    # Results
+    self.layers                = [[None, 0.0]] # [z, seconds] for each layer, the first being everything before the first layer
+    self.blocks                = 0
+    self.distance              = 0.0
+    self.untimed               = collections.Counter()
+
+  @classmethod
+  def fromBuildConfig(cls, buildConfig, printer = None, toolhead = None, **kwargs):
+    """Returns an estimator using the limits set by a build-config.py"""
+    config = loadBuildConfig(buildConfig, printer, toolhead)
+    def axes(name):
+      return dict(zip(AXES, config[name])) if isinstance(config.get(name), list) else None
+    settings = {
+      "maxFeedrates":          axes("DEFAULT_MAX_FEEDRATE"),
+      "maxAccelerations":      axes("DEFAULT_MAX_ACCELERATION"),
+      "acceleration":          config.get("DEFAULT_ACCELERATION"),
+      "retractAcceleration":   config.get("DEFAULT_RETRACT_ACCELERATION"),
+      "travelAcceleration":    config.get("DEFAULT_TRAVEL_ACCELERATION"),
+      "junctionDeviation":     config.get("JUNCTION_DEVIATION_MM"),
+      "minimumPlannerSpeed":   config.get("MINIMUM_PLANNER_SPEED"),
+      "minimumFeedrate":       config.get("DEFAULT_MINIMUMFEEDRATE"),
+      "minimumTravelFeedrate": config.get("DEFAULT_MINTRAVELFEEDRATE")
+    }
+    if config.get("CLASSIC_JERK"):
+      settings["jerk"] = dict((axis, config.get("DEFAULT_%sJERK" % axis, 0)) for axis in AXES)
+    settings = dict((k, v) for k, v in settings.items() if v is not None)
+    settings.update(kwargs)
+    return cls(**settings)
+
+  def estimateFile(self, filename):
+    """Reads a whole file and returns the estimated total time in seconds"""
+    with open(filename, "rb") as f:
+      for line in f:
+        self.addLine(line)
+    self.finish()
+    return self.totalTime()
+
+  def addLine(self, line):
+    line = line.split(b";", 1)[0].strip()
+    if not line:
+      return
+    if line.startswith(b"N"):
+      # Strip the line number and checksum
+      line = line.split(b"*", 1)[0].lstrip(b"N0123456789 ")
+    code, params = parseCmd(line)
+    if code in (b"G0", b"G1"):
+      self._addMove(params)
+    elif code == b"G90":
+      self.relative  = False
+      self.relativeE = False
+    elif code == b"G91":
+      self.relative  = True
+      self.relativeE = True
+    elif code == b"M82":
+      self.relativeE = False
+    elif code == b"M83":
+      self.relativeE = True
+    elif code == b"G92":
+      for axis in [axis for axis in AXES if axis in params] or AXES:
+        self.position[axis] = params.get(axis) or 0.0
+    elif code == b"M220" and params.get("S") is not None:
+      self.feedrateMultiplier = params["S"] / 100.0
+    elif code in (b"M201", b"M203", b"M204", b"M205"):
+      self._setLimits(code, params)
+    elif code in self.SYNCHRONIZE:
+      self.synchronize()
+      if code == b"G4":
+        self.layers[-1][1] += (params.get("P") or 0) / 1000.0 + (params.get("S") or 0)
+      elif code in (b"G28", b"G29"):
+        # Assume the machine is homed at zero
+        for axis in [axis for axis in "XYZ" if axis in params] or "XYZ":
+          self.position[axis] = 0.0
+    if code in self.UNTIMED:
+      self.untimed[code.decode()] += 1
+
+  def _addMove(self, params):
+    if params.get("F"):
+      self.feedrate = params["F"] / 60.0
+    deltas = []
+    for axis in AXES:
+      value = params.get(axis)
+      if value is None:
+        deltas.append(0.0)
+        continue
+      relative = self.relativeE if axis == "E" else self.relative
+      target = self.position[axis] + value if relative else value
+      deltas.append(target - self.position[axis])
+      self.position[axis] = target
+    if not any(deltas):
+      return
+    dx, dy, dz, de = deltas
+    if de > 0 and (dx or dy) and (self.layers[-1][0] is None or self.position["Z"] > self.layers[-1][0] + 1e-6):
+      # The first extrusion at a greater height starts a new layer
+      self.layers.append([self.position["Z"], 0.0])
+    self.moves.append((dx, dy, dz, de, self.feedrate * self.feedrateMultiplier, len(self.layers) - 1))
+    if len(self.moves) >= self.batchSize:
+      self._makeBlocks()
+      self._plan(False)
+
+  def _setLimits(self, code, params):
+    # Moves already read were planned with the previous limits
+    self._makeBlocks()
+    if code == b"M201":
+      for axis in AXES:
+        if params.get(axis):
+          self.maxAccelerations[axis] = params[axis]
+    elif code == b"M203":
+      for axis in AXES:
+        if params.get(axis):
+          self.maxFeedrates[axis] = params[axis]
+    elif code == b"M204":
+      if params.get("S"):
+        self.acceleration = self.travelAcceleration = params["S"]
+      if params.get("P"):
+        self.acceleration = params["P"]
+      if params.get("R"):
+        self.retractAcceleration = params["R"]
+      if params.get("T"):
+        self.travelAcceleration = params["T"]
+    elif code == b"M205":
+      if params.get("J"):
+        self.junctionDeviation = params["J"]
+      if params.get("S") is not None:
+        self.minimumFeedrate = params["S"]
+      if params.get("T") is not None:
+        self.minimumTravelFeedrate = params["T"]
+      if self.jerk:
+        for axis in AXES:
+          if params.get(axis) is not None:
+            self.jerk[axis] = params[axis]
+
+  def synchronize(self):
+    """Plans and times all moves read so far, leaving the machine at rest"""
+    self._makeBlocks()
+    self._plan(True)
+    self.prevUnit       = None
+    self.prevNominalSqr = 0.0
+
+  def finish(self):
+    self.synchronize()
+
+  # Blocks
+
+  def _makeBlocks(self):
+    """Turns the moves read so far into blocks"""
+    if not self.moves:
+      return
+    if self.numpy:
+      blocks = self._makeBlocksNumpy(self.moves)
+    else:
+      blocks = self._makeBlocksPython(self.moves)
+    lengths, accels, nominalSqrs, maxEntrySqrs, layers = blocks
+    self.lengths      += lengths
+    self.accels       += accels
+    self.nominalSqrs  += nominalSqrs
+    self.maxEntrySqrs += maxEntrySqrs
+    self.blockLayers  += layers
+    self.blocks       += len(lengths)
+    self.distance     += sum(lengths)
+    self.moves         = []
+
+  def _makeBlocksPython(self, moves):
+    lengths, accels, nominalSqrs, maxEntrySqrs, layers = [], [], [], [], []
+    maxFeedrates     = [self.maxFeedrates[axis] for axis in AXES]
+    maxAccelerations = [self.maxAccelerations[axis] for axis in AXES]
+    minPlannerSqr    = self.minimumPlannerSpeed ** 2
+    for dx, dy, dz, de, feedrate, layer in moves:
+      xyz = math.sqrt(dx * dx + dy * dy + dz * dz)
+      if xyz:
+        length, accel, minFeedrate = xyz, self.acceleration if de else self.travelAcceleration, \
+                                     self.minimumFeedrate if de else self.minimumTravelFeedrate
+      else:
+        length, accel, minFeedrate = abs(de), self.retractAcceleration, self.minimumFeedrate
+      # Marlin normalizes the junction vector over all axes if the extruder moves
+      norm  = math.sqrt(xyz * xyz + de * de) if de else length
+      unit  = (dx / norm, dy / norm, dz / norm, de / norm)
+      speed = max(feedrate, minFeedrate)
+      for delta, maxFeedrate, maxAcceleration in zip((dx, dy, dz, de), maxFeedrates, maxAccelerations):
+        if delta:
+          # Each axis moves by abs(delta) / length mm per mm of the path
+          speed = min(speed, maxFeedrate * length / abs(delta))
+          accel = min(accel, maxAcceleration * length / abs(delta))
+      nominalSqr = speed * speed
+      axisSpeeds = (dx * speed / length, dy * speed / length, dz * speed / length, de * speed / length)
+      if self.prevUnit is None or self.prevNominalSqr < 1e-6:
+        maxEntrySqr = 0.0
+      elif self.jerk:
+        # As in Marlin, each axis' speed at the start of this block may differ
+        # by up to its jerk from that at the end of the previous one, slowed
+        # to the junction speed; the junction speed is scaled down until so
+        prevNominal = math.sqrt(self.prevNominalSqr)
+        junction    = min(speed, prevNominal)
+        factor      = 1.0
+        for axis, v, p in zip(AXES, axisSpeeds, self.prevAxisSpeeds):
+          jerk = abs(v - p * junction / prevNominal)
+          if jerk > self.jerk[axis]:
+            factor = min(factor, self.jerk[axis] / jerk)
+        maxEntrySqr = (junction * factor) ** 2
+      else:
+        cosTheta = -sum(u * p for u, p in zip(unit, self.prevUnit))
+        if cosTheta > 0.999999:
+          maxEntrySqr = minPlannerSqr
+        else:
+          cosTheta  = max(cosTheta, -0.999999)
+          junction  = [u - p for u, p in zip(unit, self.prevUnit)]
+          magnitude = math.sqrt(sum(j * j for j in junction))
+          junctionAccel = accel
+          for j, maxAcceleration in zip(junction, maxAccelerations):
+            if j:
+              junctionAccel = min(junctionAccel, maxAcceleration * magnitude / abs(j))
+          sinThetaD2  = math.sqrt(0.5 * (1.0 - cosTheta))
+          maxEntrySqr = junctionAccel * self.junctionDeviation * sinThetaD2 / (1.0 - sinThetaD2)
+        maxEntrySqr = min(maxEntrySqr, nominalSqr, self.prevNominalSqr)
+      self.prevUnit       = unit
+      self.prevAxisSpeeds = axisSpeeds
+      self.prevNominalSqr = nominalSqr
+      lengths.append(length)
+      accels.append(accel)
+      nominalSqrs.append(nominalSqr)
+      maxEntrySqrs.append(maxEntrySqr)
+      layers.append(layer)
+    return lengths, accels, nominalSqrs, maxEntrySqrs, layers
+
+  def _makeBlocksNumpy(self, moves):
+    np    = self.numpy
+    moves = np.array(moves, dtype = float)
+    d, de = moves[:, 0:4], moves[:, 3]
+    xyz   = np.sqrt((d[:, 0:3] ** 2).sum(axis = 1))
+    extruding = de != 0
+    isRetract = xyz == 0
+    length = np.where(isRetract, np.abs(de), xyz)
+    accel  = np.where(isRetract, self.retractAcceleration, np.where(extruding, self.acceleration, self.travelAcceleration))
+    speed  = np.maximum(moves[:, 4], np.where(extruding, self.minimumFeedrate, self.minimumTravelFeedrate))
+    # Marlin normalizes the junction vector over all axes if the extruder moves
+    norm   = np.where(extruding, np.sqrt(xyz ** 2 + de ** 2), length)
+    unit   = d / norm[:, None]
+    # Each axis moves by abs(delta) / length mm per mm of the path
+    axisFraction = np.abs(d) / length[:, None]
+    with np.errstate(divide = "ignore"):
+      maxFeedrates     = np.array([self.maxFeedrates[axis] for axis in AXES], dtype = float)
+      maxAccelerations = np.array([self.maxAccelerations[axis] for axis in AXES], dtype = float)
+      speed = np.minimum(speed, (maxFeedrates / axisFraction).min(axis = 1))
+      accel = np.minimum(accel, (maxAccelerations / axisFraction).min(axis = 1))
+    nominalSqr = speed ** 2
+    axisSpeeds = d / length[:, None] * speed[:, None]
+    # The unit vector, axis speeds and nominal speed of the block before each one
+    prevUnit = np.empty_like(unit)
+    prevUnit[1:] = unit[:-1]
+    prevUnit[0]  = self.prevUnit if self.prevUnit is not None else 0
+    prevAxisSpeeds = np.empty_like(axisSpeeds)
+    prevAxisSpeeds[1:] = axisSpeeds[:-1]
+    prevAxisSpeeds[0]  = self.prevAxisSpeeds if self.prevUnit is not None else 0
+    prevNominalSqr = np.empty_like(nominalSqr)
+    prevNominalSqr[1:] = nominalSqr[:-1]
+    prevNominalSqr[0]  = self.prevNominalSqr if self.prevUnit is not None else 0
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+      if self.jerk:
+        # As in Marlin, each axis' speed at the start of a block may differ by
+        # up to its jerk from that at the end of the previous one, slowed to
+        # the junction speed; the junction speed is scaled down until so
+        limit       = np.array([self.jerk[axis] for axis in AXES], dtype = float)
+        prevNominal = np.sqrt(prevNominalSqr)
+        junction    = np.minimum(speed, prevNominal)
+        jerk        = np.abs(axisSpeeds - prevAxisSpeeds * (junction / prevNominal)[:, None])
+        factor      = np.where(jerk > limit, limit / jerk, 1.0).min(axis = 1)
+        maxEntrySqr = (junction * factor) ** 2
+      else:
+        cosTheta = -(unit * prevUnit).sum(axis = 1)
+        junction = unit - prevUnit
+        junction = junction / np.sqrt((junction ** 2).sum(axis = 1))[:, None]
+        # Straight junctions have no junction vector, hence fmin, which ignores NaN
+        junctionAccel = np.fmin(accel, (maxAccelerations / np.abs(junction)).min(axis = 1))
+        sinThetaD2  = np.sqrt(0.5 * (1.0 - np.maximum(cosTheta, -0.999999)))
+        maxEntrySqr = junctionAccel * self.junctionDeviation * sinThetaD2 / (1.0 - sinThetaD2)
+        maxEntrySqr = np.where(cosTheta > 0.999999, self.minimumPlannerSpeed ** 2, maxEntrySqr)
+    maxEntrySqr = np.minimum(np.minimum(maxEntrySqr, nominalSqr), prevNominalSqr)
+    maxEntrySqr = np.where(prevNominalSqr < 1e-6, 0.0, maxEntrySqr)
+    self.prevUnit       = tuple(unit[-1].tolist())
+    self.prevAxisSpeeds = tuple(axisSpeeds[-1].tolist())
+    self.prevNominalSqr = float(nominalSqr[-1])
+    return length.tolist(), accel.tolist(), nominalSqr.tolist(), maxEntrySqr.tolist(), moves[:, 5].astype(int).tolist()
+
+  # Planning
+
+  def _plan(self, final):
+    """Sets the entry speed of each block and adds up the time they take. Unless
+       final, the last blocks are held back, as their speeds depend on the
+       blocks which follow them; otherwise they end at rest."""
+    n = len(self.lengths)
+    if n == 0 or (not final and n <= self.window):
+      return
+    lengths, accels, maxEntrySqrs = self.lengths, self.accels, self.maxEntrySqrs
+    done = n if final else n - self.window
+    minPlannerSqr = self.minimumPlannerSpeed ** 2
+    # The squared speed change available within each block, and the sum of those before it
+    reach  = [2 * a * l for a, l in zip(accels, lengths)]
+    before = [0.0]
+    for r in reach:
+      before.append(before[-1] + r)
+    # Reverse pass, which also limits each block to stopping within the planner's window
+    entry = [0.0] * (n + 1)
+    entry[n] = minPlannerSqr
+    for i in range(n - 1, -1, -1):
+      stop = before[min(i + self.window, n)] - before[i] + minPlannerSqr
+      entry[i] = min(maxEntrySqrs[i], entry[i + 1] + reach[i], stop)
+    # Forward pass, starting from the speed with which the previous block ended
+    entry[0] = self.entrySqr
+    for i in range(done):
+      entry[i + 1] = min(entry[i + 1], entry[i] + reach[i])
+    if self.numpy:
+      times = self._trapezoidTimesNumpy(entry, done)
+    else:
+      times = self._trapezoidTimesPython(entry, done)
+    for layer, t in zip(self.blockLayers, times):
+      self.layers[layer][1] += t
+    self.entrySqr = entry[done] if not final else 0.0
+    del self.lengths[:done], self.accels[:done], self.nominalSqrs[:done], self.maxEntrySqrs[:done], self.blockLayers[:done]
+
+  def _trapezoidTimesPython(self, entry, done):
+    times = []
+    for i in range(done):
+      length, accel, nominalSqr = self.lengths[i], self.accels[i], self.nominalSqrs[i]
+      entrySqr, exitSqr = entry[i], entry[i + 1]
+      cruise = length - (2 * nominalSqr - entrySqr - exitSqr) / (2 * accel)
+      if cruise > 0:
+        peak = math.sqrt(nominalSqr)
+        t = cruise / peak
+      else:
+        # Never reaches the nominal speed
+        peak = math.sqrt((entrySqr + exitSqr) / 2 + accel * length)
+        t = 0.0
+      times.append(t + (2 * peak - math.sqrt(entrySqr) - math.sqrt(exitSqr)) / accel)
+    return times
+
+  def _trapezoidTimesNumpy(self, entry, done):
+    np = self.numpy
+    length     = np.array(self.lengths[:done])
+    accel      = np.array(self.accels[:done])
+    nominalSqr = np.array(self.nominalSqrs[:done])
+    entrySqr   = np.array(entry[:done])
+    exitSqr    = np.array(entry[1:done + 1])
+    cruise     = length - (2 * nominalSqr - entrySqr - exitSqr) / (2 * accel)
+    # Blocks which never reach the nominal speed peak in between
+    peak = np.sqrt(np.where(cruise > 0, nominalSqr, (entrySqr + exitSqr) / 2 + accel * length))
+    t    = np.where(cruise > 0, np.maximum(cruise, 0) / peak, 0.0)
+    return (t + (2 * peak - np.sqrt(entrySqr) - np.sqrt(exitSqr)) / accel).tolist()
+
+  # Results
+
+  def totalTime(self):
+    """Returns the estimated time in seconds of the lines read so far, other
+       than those held back for planning"""
+    return sum(t for z, t in self.layers)
+
+  def layerTimes(self):
+    """Returns a list of (z, seconds) for each layer. The first entry, with a z
+       of None, holds the time spent before the first layer is started."""
+    return [(z, t) for z, t in self.layers]
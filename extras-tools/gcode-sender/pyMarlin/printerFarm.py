@@ -0,0 +1,132 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# The class PrinterFarm drives many printers from a single process.
+# Each printer gets its own MarlinSerialProtocol, and therefore its own
+# history and stall watchdog, running in its own thread. Since threads
+# spend nearly all their time blocked on serial reads, which release the
+# interpreter lock, a single process can keep dozens of printers fed.
+#
+# Printers running the same job share a single PreframedJob. The GCODE
+# is stripped and framed once, into a file kept by a FramedGCodeCache,
+# and each printer streams the frames from that file with its own
+# FramedFileSource, so memory use depends neither on the size of the
+# jobs nor on the number of printers. Every printer starts its print at
+# line 1, so the frames are identical for all of them.
+
+import os
+import threading
+
+from pyMarlin.gcodeFileSource      import FramedFileSource
+from pyMarlin.framedGCodeCache     import FramedGCodeCache
+from pyMarlin.marlinSerialProtocol import MarlinSerialProtocol
+
+class PreframedJob:
+  """This class holds a GCODE job which has been stripped and framed once,
+     into a file written by writeFramedFile(), so that it can be shared
+     between printers. Iterating over it streams the frames from that file,
+     yielding (position, frame) tuples, starting at line 1."""
+  def __init__(self, framedFile, name = None):
+    self.framedFile = framedFile
+    self.name       = name
+    self.lines      = 0
+    with open(framedFile, "rb") as f:
+      for chunk in iter(lambda: f.read(1024 * 1024), b""):
+        self.lines += chunk.count(b"\n")
+
+  @classmethod
+  def fromFile(cls, filename, cache = None):
+    """Frames a GCODE file into cache, a FramedGCodeCache, which defaults to the user's cache"""
+    path, hit = (cache or FramedGCodeCache()).get(filename)
+    return cls(path, os.path.basename(filename))
+
+  def __len__(self):
+    return self.lines
+
+  def __iter__(self):
+    return iter(FramedFileSource(self.framedFile))
+
+class FarmPrinter:
+  """A printer in a PrinterFarm, with its own protocol instance and thread"""
+  def __init__(self, name, serial, job, onResendCallback=None, onDebugMsgCallback=None):
+    self.name      = name
+    self.job       = job
+    self.linesSent = 0
+    self.error     = None
+    self.proto     = MarlinSerialProtocol(serial, onResendCallback, onDebugMsgCallback)
+    self.thread    = threading.Thread(target=self._run, name=name)
+    self.thread.daemon = True
+
+  def _run(self):
+    try:
+      for position, frame in self.job:
+        self.proto.sendCmdFramed(position, frame)
+        while(not self.proto.clearToSend()):
+          self.proto.readline()
+        self.linesSent = position
+    except Exception as e:
+      self.error = e
+    finally:
+      self.proto.close()
+
+  def progress(self):
+    return self.linesSent * 100.0 / len(self.job) if len(self.job) else 100.0
+
+class PrinterFarm:
+  """This class streams jobs to many printers concurrently. Jobs loaded with
+     loadJob() are framed into cache, a FramedGCodeCache which defaults to the
+     user's cache, so printers printing the same file share one framed copy
+     of it. The cache must be large enough to hold every job at once."""
+  def __init__(self, onResendCallback=None, onDebugMsgCallback=None, cache=None):
+    self.printers           = []
+    self.jobs               = {}
+    self.cache              = cache
+    self.onResendCallback   = onResendCallback
+    self.onDebugMsgCallback = onDebugMsgCallback
+
+  def _callback(self, callback, name):
+    """Returns a callback which prefixes its argument with the printer name"""
+    if callback:
+      return lambda arg: callback(name, arg)
+
+  def loadJob(self, filename):
+    key = os.path.realpath(filename)
+    if key not in self.jobs:
+      self.jobs[key] = PreframedJob.fromFile(filename, self.cache)
+    return self.jobs[key]
+
+  def addPrinter(self, name, serial, job):
+    """Adds a printer which will print job, which is either a PreframedJob
+       or a file name. Callbacks are called with the printer name as the
+       first argument."""
+    if not isinstance(job, PreframedJob):
+      job = self.loadJob(job)
+    printer = FarmPrinter(name, serial, job,
+      self._callback(self.onResendCallback,   name),
+      self._callback(self.onDebugMsgCallback, name))
+    self.printers.append(printer)
+    return printer
+
+  def start(self):
+    for printer in self.printers:
+      printer.thread.start()
+
+  def isRunning(self):
+    return any(printer.thread.is_alive() for printer in self.printers)
+
+  def join(self, timeout=None):
+    for printer in self.printers:
+      printer.thread.join(timeout)
+
+  def progress(self):
+    """Returns a dictionary of the progress of each printer, by name"""
+    return dict((printer.name, printer.progress()) for printer in self.printers)
@@ -0,0 +1,211 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# A repeatable throughput benchmark for MarlinSerialProtocol. A GCODE
+# corpus is sent through a FakeMarlinSerialDevice, optionally wrapped in
+# a NoisySerialConnection, over a matrix of error rates, buffer sizes and
+# corpora. Each run is reported as a dictionary, so that results can be
+# saved as JSON and regressions in the protocol layer compared as numbers.
+#
+# If a baud rate is given, a SimulatedMarlinSerialDevice is used instead,
+# which also reports the simulated print time and planner underrun.
+#
+# runReplay() instead sends the commands of a session recorded with
+# LoggingSerialConnection to a ReplayMarlinSerialDevice, which answers
+# with the replies of the real printer, with their original timing.
+#
+# runWatchdogBenchmark() checks a stall watchdog for false re-syncs: no
+# "ok" is ever lost, so every re-sync it forces is a false one. Moves
+# are simulated with acceleration, and the watchdog runs against the
+# simulated clock.
+
+import copy
+import math
+import random
+import time
+
+from pyMarlin.fakeMarlinSerialDevice import FakeMarlinSerialDevice, SimulatedMarlinSerialDevice, ReplayMarlinSerialDevice
+from pyMarlin.noisySerialConnection  import NoisySerialConnection, NoiseModel
+from pyMarlin.marlinSerialProtocol   import MarlinSerialProtocol
+from pyMarlin.protocolStats          import ProtocolStats
+
+def syntheticMoves(count):
+  """Generates straight moves with typical slicer precision"""
+  return [b"G1 X%.3f Y%.3f E%.5f" % (i % 200 * 0.731, i % 150 * 0.417, i * 0.0123) for i in range(count)]
+
+def syntheticArcs(count, segmentsPerCircle = 72, radius = 10.0):
+  """Generates a dense spiral of short extruding segments, as found in chocolate infill.
+     Like many slicers, full precision is written and the feedrate repeated on every move."""
+  gcode = [b"G28", b"G90", b"M83", b"G92 E0", b"G1 Z0.2 F300"]
+  for i in range(count):
+    angle = 2 * math.pi * i / segmentsPerCircle
+    r     = radius + 0.01 * i / segmentsPerCircle
+    gcode.append(b"G1 X%.6f Y%.6f E%.6f F1800" % (100 + r * math.cos(angle), 100 + r * math.sin(angle), 0.0123456))
+  return gcode
+
+def syntheticNonActing(count):
+  """Generates commands which do not move the printer, like gcodeSender.py TEST"""
+  nonActing = [b"G90", b"G91", b"G92 X0 Y0 Z0", b"G92 X123 Y456", b"M31", b"M114", b"M115", b"M119"]
+  return [nonActing[i % len(nonActing)] for i in range(count)]
+
+CORPORA = {
+  "moves":     syntheticMoves,
+  "arcs":      syntheticArcs,
+  "nonacting": syntheticNonActing
+}
+
+def loadCorpus(name, lines):
+  """Returns a named synthetic corpus of the given length, or the lines of a file"""
+  if name in CORPORA:
+    return CORPORA[name](lines)
+  with open(name, "rb") as f:
+    return f.readlines()
+
+def runBenchmark(gcode, errors = 0, bufSize = 4, advancedOk = True, seed = 1, baud = None, noise = None, linkBaud = None, **protocolArgs):
+  """Sends gcode through a FakeMarlinSerialDevice, or a SimulatedMarlinSerialDevice
+     at the given baud, corrupting 1 out of errors lines written, and returns a
+     dictionary of measurements. If linkBaud is given, the FakeMarlinSerialDevice
+     drains the bytes written at that rate, reporting those pending in out_waiting.
+     If a NoiseModel is given, its faults are also injected into the lines written.
+     Planner starvation is the time during which no commands were in flight while
+     there were still more to send."""
+  random.seed(seed)
+  if baud:
+    device = SimulatedMarlinSerialDevice(baud, bufSize, advancedOk = advancedOk)
+  else:
+    device = FakeMarlinSerialDevice(advancedOk, bufSize, baudrate = linkBaud)
+  sio     = device
+  if errors or noise:
+    sio = NoisySerialConnection(sio, seed)
+    if noise:
+      sio.writeModel = copy.copy(noise)
+    if errors:
+      sio.setWriteErrorRate(1, errors)
+  resends = [0]
+  def onResend(position):
+    resends[0] += 1
+  proto = MarlinSerialProtocol(sio, onResend, **protocolArgs)
+
+  starved    = 0
+  starvedAt  = None
+  startWall  = time.perf_counter()
+  startCpu   = time.process_time()
+  for line in gcode:
+    proto.sendCmdReliable(line)
+    while(not proto.clearToSend()):
+      proto.readline()
+      now = time.perf_counter()
+      if proto.marlinPendingCommands <= 0:
+        starvedAt = starvedAt or now
+      elif starvedAt:
+        starved  += now - starvedAt
+        starvedAt = None
+  if baud:
+    # Let the simulated printer finish
+    while device.queue:
+      proto.readline()
+  elapsedWall = time.perf_counter() - startWall
+  elapsedCpu  = time.process_time()  - startCpu
+
+  result = {
+    "lines":            len(gcode),
+    "errors":           errors,
+    "bufSize":          bufSize,
+    "advancedOk":       advancedOk,
+    "seconds":          elapsedWall,
+    "linesPerSecond":   len(gcode) / elapsedWall,
+    "cpuUsPerLine":     elapsedCpu * 1e6 / len(gcode),
+    "resends":          resends[0],
+    "resendRate":       float(resends[0]) / len(gcode),
+    "writes":           device.cumulativeWrites,
+    "bytesWritten":     device.cumulativeBytes,
+    "averageQueueDepth": proto.averageQueueDepth(),
+    "starvedSeconds":   starved,
+    "faults":           dict(sio.faults) if sio is not device else {}
+  }
+  if baud:
+    result["baud"]                   = baud
+    result["simulatedSeconds"]       = device.now
+    result["plannerUnderrunSeconds"] = device.plannerUnderrun
+  return result
+
+def runMatrix(corpora, lines, errorRates, bufSizes, seed = 1, onResult = None, baud = None, noise = None):
+  """Runs the benchmark over every combination of corpus, error rate and buffer
+     size, and returns the list of results. onResult is called after each run."""
+  results = []
+  for corpus in corpora:
+    gcode = loadCorpus(corpus, lines)
+    for errors in errorRates:
+      for bufSize in bufSizes:
+        result = runBenchmark(gcode, errors, bufSize, seed = seed, baud = baud, noise = noise)
+        result["corpus"] = corpus
+        results.append(result)
+        if onResult:
+          onResult(result)
+  return results
+
+def runWatchdogBenchmark(gcode, watchdog, acceleration, minSegmentTime = 0.02, bufSize = 4, baud = 250000, advancedOk = False):
+  """Sends gcode to a SimulatedMarlinSerialDevice whose moves accelerate at the
+     given rate, and returns a dictionary of measurements, including how many
+     times watchdog forced a re-sync. The watchdog's clock is replaced with
+     that of the device."""
+  device = SimulatedMarlinSerialDevice(baud, bufSize, advancedOk = advancedOk, includeHostTime = False,
+                                       acceleration = acceleration, minSegmentTime = minSegmentTime)
+  watchdog.clock = lambda: device.now
+  stats  = ProtocolStats()
+  proto  = MarlinSerialProtocol(device, watchdog = watchdog, stats = stats)
+  for line in gcode:
+    proto.sendCmdReliable(line)
+    while(not proto.clearToSend()):
+      proto.readline()
+  while device.queue:
+    proto.readline()
+  return {
+    "lines":            len(gcode),
+    "acceleration":     acceleration,
+    "bufSize":          bufSize,
+    "simulatedSeconds": device.now,
+    "watchdogResyncs":  stats.watchdogResyncs,
+    "resends":          stats.resends
+  }
+
+def runReplay(logFilename, **protocolArgs):
+  """Sends the commands of a recorded session to a ReplayMarlinSerialDevice and
+     returns a dictionary of measurements. The replayed time is in simulated
+     time, excluding the time spent by the host, so results are repeatable."""
+  device  = ReplayMarlinSerialDevice(logFilename, includeHostTime = False)
+  gcode   = device.recordedCommands
+  resends = [0]
+  def onResend(position):
+    resends[0] += 1
+  proto = MarlinSerialProtocol(device, onResend, **protocolArgs)
+
+  startCpu = time.process_time()
+  for line, reliable in gcode:
+    if reliable:
+      proto.sendCmdReliable(line)
+    else:
+      proto.sendCmdUnreliable(line, force = True) # Replay every recorded command
+    while(not proto.clearToSend()):
+      proto.readline()
+  elapsedCpu = time.process_time() - startCpu
+
+  return {
+    "lines":             len(gcode),
+    "recordedSeconds":   device.recordedSeconds,
+    "replayedSeconds":   device.replayedSeconds,
+    "linesPerSecond":    len(gcode) / device.replayedSeconds if device.replayedSeconds else 0,
+    "cpuUsPerLine":      elapsedCpu * 1e6 / max(1, len(gcode)),
+    "resends":           resends[0],
+    "writes":            device.cumulativeWrites,
+    "averageQueueDepth": proto.averageQueueDepth()
+  }
@@ -0,0 +1,186 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# Tuning a printer's link requires knowing where the time goes. When a
+# ProtocolStats is passed to MarlinSerialProtocol, the protocol reports
+# every command sent, every "ok", resend request and watchdog re-sync to
+# it, along with the result of each call to clearToSend(). From these it
+# keeps:
+#
+#   - A histogram of the latency from sending a command to its "ok"
+#   - A histogram of how long the caller was blocked in clearToSend()
+#   - A time series of the number of commands in flight
+#   - Counts of commands, oks, resends, watchdog re-syncs and of how
+#     often an "ok" left Marlin's command buffer empty, meaning that it
+#     ran dry
+#
+# Commands are acknowledged in order, so the send times of commands in
+# flight are kept in a queue, in the same way as the protocol counts
+# their bytes. With ADVANCED_OK, commands in flight are both those in
+# transit and those waiting in Marlin's command buffer, and only the
+# latter tell whether the buffer ran dry. Latency is not recorded for commands which were in flight
+# when a resend or re-sync discarded them.
+#
+# The statistics can be exported as JSON with toJSON(), or in the
+# Prometheus text exposition format with toPrometheus().
+
+import collections
+import json
+import time
+
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60, 300)
+
+class LatencyHistogram:
+  """Histogram of durations in seconds, counted into buckets with the given upper bounds"""
+  def __init__(self, buckets = LATENCY_BUCKETS):
+    self.buckets = tuple(buckets)
+    self.counts  = [0] * (len(self.buckets) + 1) # The last bucket counts values beyond all bounds
+    self.count   = 0
+    self.sum     = 0.0
+    self.max     = 0.0
+
+  def observe(self, value):
+    i = 0
+    while i < len(self.buckets) and value > self.buckets[i]:
+      i += 1
+    self.counts[i] += 1
+    self.count     += 1
+    self.sum       += value
+    self.max        = max(self.max, value)
+
+  def mean(self):
+    return self.sum / self.count if self.count else 0
+
+  def percentile(self, p):
+    """Returns the upper bound of the bucket containing the p-th percentile,
+       or the largest value seen if that lies beyond all bounds"""
+    rank  = p / 100.0 * self.count
+    total = 0
+    for bound, count in zip(self.buckets, self.counts):
+      total += count
+      if total >= rank and total:
+        return min(bound, self.max)
+    return self.max
+
+  def toDict(self):
+    return {
+      "buckets": dict(("%g" % bound, count) for bound, count in zip(self.buckets, self.counts)),
+      "overflow": self.counts[-1],
+      "count":    self.count,
+      "sum":      self.sum,
+      "max":      self.max,
+      "p50":      self.percentile(50),
+      "p99":      self.percentile(99)
+    }
+
+class ProtocolStats:
+  """Records the timing of the commands sent by a MarlinSerialProtocol. At most
+     maxSamples (time, commands in flight) samples of queue depth are kept, the
+     oldest being discarded first."""
+  def __init__(self, maxSamples = 10000, latencyBuckets = LATENCY_BUCKETS):
+    self.startTime       = time.time()
+    self.latency         = LatencyHistogram(latencyBuckets)
+    self.blocked         = LatencyHistogram(latencyBuckets)
+    self.queueDepth      = collections.deque(maxlen = maxSamples)
+    self.sendTimes       = collections.deque()
+    self.blockedSince    = None
+    self.sent            = 0
+    self.oks             = 0
+    self.resends         = 0
+    self.watchdogResyncs = 0
+    self.drained         = 0
+
+  def _sampleQueueDepth(self, now, pendingCommands):
+    self.queueDepth.append((now - self.startTime, pendingCommands))
+
+  def onSent(self, pendingCommands):
+    now = time.time()
+    self.sent += 1
+    self.sendTimes.append(now)
+    self._sampleQueueDepth(now, pendingCommands)
+
+  def onOkay(self, pendingCommands, queuedCommands = None):
+    """Called after an "ok" leaves pendingCommands commands in flight, of which
+       queuedCommands are in Marlin's command buffer (by default, all of them)"""
+    now = time.time()
+    self.oks += 1
+    while len(self.sendTimes) > max(0, pendingCommands):
+      self.latency.observe(now - self.sendTimes.popleft())
+    if (pendingCommands if queuedCommands is None else queuedCommands) <= 0:
+      self.drained += 1
+    self._sampleQueueDepth(now, pendingCommands)
+
+  def onResend(self):
+    self.resends += 1
+    self.sendTimes.clear()
+
+  def onWatchdog(self):
+    self.watchdogResyncs += 1
+    self.sendTimes.clear()
+
+  def onReset(self):
+    self.sendTimes.clear()
+    self.blockedSince = None
+
+  def onClearToSend(self, clear):
+    """Measures how long clearToSend() keeps returning False"""
+    if not clear:
+      if self.blockedSince is None:
+        self.blockedSince = time.time()
+    elif self.blockedSince is not None:
+      self.blocked.observe(time.time() - self.blockedSince)
+      self.blockedSince = None
+
+  def toDict(self):
+    return {
+      "elapsed":          time.time() - self.startTime,
+      "sent":             self.sent,
+      "oks":              self.oks,
+      "resends":          self.resends,
+      "watchdogResyncs":  self.watchdogResyncs,
+      "drained":          self.drained,
+      "latency":          self.latency.toDict(),
+      "blocked":          self.blocked.toDict(),
+      "queueDepth":       list(self.queueDepth)
+    }
+
+  def toJSON(self, indent = None):
+    return json.dumps(self.toDict(), indent = indent)
+
+  def toPrometheus(self, prefix = "pymarlin", labels = None):
+    """Returns the statistics in the Prometheus text exposition format. Labels,
+       such as {"printer": "/dev/ttyACM0"}, are added to every sample."""
+    labels = ",".join('%s="%s"' % item for item in sorted((labels or {}).items()))
+    def sample(name, value, extra = ""):
+      allLabels = ",".join(l for l in (labels, extra) if l)
+      return "%s_%s%s %s" % (prefix, name, "{%s}" % allLabels if allLabels else "", value)
+    def metric(name, kind, help, value):
+      return ["# HELP %s_%s %s" % (prefix, name, help), "# TYPE %s_%s %s" % (prefix, name, kind), sample(name, value)]
+    def histogram(name, help, hist):
+      lines = ["# HELP %s_%s %s" % (prefix, name, help), "# TYPE %s_%s histogram" % (prefix, name)]
+      total = 0
+      for bound, count in zip(hist.buckets, hist.counts):
+        total += count
+        lines.append(sample(name + "_bucket", total, 'le="%g"' % bound))
+      lines.append(sample(name + "_bucket", hist.count, 'le="+Inf"'))
+      lines.append(sample(name + "_sum", hist.sum))
+      lines.append(sample(name + "_count", hist.count))
+      return lines
+    lines  = metric("commands_sent_total",    "counter", "Commands sent to Marlin.", self.sent)
+    lines += metric("oks_total",              "counter", "Acknowledgements received from Marlin.", self.oks)
+    lines += metric("resends_total",          "counter", "Resend requests received from Marlin.", self.resends)
+    lines += metric("watchdog_resyncs_total", "counter", "Re-syncs forced by the stall watchdog.", self.watchdogResyncs)
+    lines += metric("buffer_drained_total",   "counter", "Times an ok left Marlin's command buffer empty.", self.drained)
+    lines += metric("queue_depth",            "gauge",   "Commands in flight.", self.queueDepth[-1][1] if self.queueDepth else 0)
+    lines += histogram("ok_latency_seconds",  "Time from sending a command to its ok.", self.latency)
+    lines += histogram("blocked_seconds",     "Time spent waiting in clearToSend.", self.blocked)
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,85 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# FakeMarlinSerialDevice can only be used from within the same process
+# as the sender. The class PtyMarlinSimulator exposes one on a Linux
+# pseudo-terminal instead, so that any host software which can open a
+# serial port, such as gcodeSender.py, can be tested against it through
+# the kernel's tty layer.
+#
+# Each simulator owns a pty and a thread which feeds the lines written
+# by the host into the device and writes back its replies as they become
+# available. The slave side is put in raw mode, so that bytes pass
+# through unchanged, and is held open by the simulator, so that hosts
+# can disconnect and reconnect without the pty being torn down.
+#
+# Since a SimulatedMarlinSerialDevice only releases replies once they
+# are due, the thread polls the device every pollInterval seconds; its
+# clock then follows real time, so the pty behaves like a printer
+# connected at the simulated baud rate.
+
+import os
+import select
+import threading
+import tty
+
+class PtyMarlinSimulator:
+  """This class exposes a fake Marlin device on a pseudo-terminal, whose
+     path is given by path. The device can be any object which implements
+     write(), readline() and in_waiting, such as FakeMarlinSerialDevice."""
+  def __init__(self, device, pollInterval = 0.01):
+    self.device       = device
+    self.pollInterval = pollInterval
+    self.master, self.slave = os.openpty()
+    tty.setraw(self.slave)
+    self.path         = os.ttyname(self.slave)
+    self.received     = b""
+    self.running      = False
+    self.error        = None
+    self.thread       = threading.Thread(target=self._run, name=self.path)
+    self.thread.daemon = True
+
+  def start(self):
+    self.running = True
+    self.thread.start()
+
+  def _receive(self):
+    """Passes complete lines written by the host to the device"""
+    self.received += os.read(self.master, 4096)
+    lines = self.received.split(b"\n")
+    self.received = lines.pop()
+    for line in lines:
+      self.device.write(line + b"\n")
+
+  def _reply(self):
+    """Writes any replies which are available to the host"""
+    while self.device.in_waiting:
+      os.write(self.master, self.device.readline())
+
+  def _run(self):
+    try:
+      while self.running:
+        readable, writable, exceptional = select.select([self.master], [], [], self.pollInterval)
+        if readable:
+          self._receive()
+        self._reply()
+    except Exception as e:
+      self.error = e
+
+  def stop(self):
+    """Stops the simulator and closes the pty"""
+    self.running = False
+    if self.thread.is_alive():
+      # The thread may be stuck writing to a host which is no longer reading
+      self.thread.join(1)
+    os.close(self.master)
+    os.close(self.slave)
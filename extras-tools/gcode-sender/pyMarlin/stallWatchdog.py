@@ -0,0 +1,193 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# When an "ok" from Marlin is lost, MarlinSerialProtocol would wait
+# forever for buffer space which it believes to be in use. The stall
+# watchdog decides how long to wait for progress before forcing a
+# re-sync. Watchdogs are informed of every command sent, every "ok"
+# and "busy:" received and every re-sync, and report the deadline by
+# which the next "ok" must have arrived. With ADVANCED_OK, the protocol
+# also tells them the line number of the command each "ok" acknowledged. Deadlines are in the time of
+# clock, which defaults to time.time, so that a watchdog can be run
+# against the simulated time of SimulatedMarlinSerialDevice.
+
+import collections
+import re
+import time
+
+from pyMarlin.gcodeCompactor     import parseCmd, GCodeModalState
+from pyMarlin.printTimeEstimator import trapezoidTime
+
+class FixedWatchdog:
+  """Allows slowTimeout seconds after commands which are known to take a long
+     time, such as heating and homing, and fastTimeout seconds after any other
+     command. This was the original behavior of MarlinSerialProtocol."""
+  def __init__(self, slowTimeout = 300, fastTimeout = 15, clock = time.time):
+    self.slowCommands = re.compile(b"M109|M190|G28|G29|G425")
+    self.slowTimeout  = slowTimeout
+    self.fastTimeout  = fastTimeout
+    self.clock        = clock
+    self.timeout      = clock()
+
+  def onSent(self, cmd):
+    estimated_duration = self.slowTimeout if self.slowCommands.search(cmd) else self.fastTimeout
+    self.timeout = max(self.timeout, self.clock() + estimated_duration)
+
+  def onOkay(self, line = None):
+    pass
+
+  def onBusy(self):
+    self.onSent(b"busy")
+
+  def onReset(self):
+    pass
+
+  def deadline(self):
+    return self.timeout
+
+class AdaptiveWatchdog:
+  """Estimates when each command should complete, so that a lost "ok" is
+     detected within margin seconds rather than after a fixed timeout.
+
+     Marlin acknowledges a move as soon as it enters the planner, so the "ok"
+     for any command can never be due later than the time when all moves sent
+     so far have been executed. This is tracked by projecting the time of each
+     move from its length and feedrate, limited by the maximum feedrate and
+     acceleration of each axis (in mm/s and mm/s^2, defaulting to those of the
+     Cocoa Press). Each move is assumed to start and end at rest, which is
+     the slowest Marlin's planner can execute it, and to take no less than
+     minSegmentTime, to which Marlin stretches moves when its planner runs
+     low (SLOWDOWN). The result is scaled by moveTimeFactor. Since Marlin can
+     hold no more than window moves in its planner and command buffer, the
+     next "ok" is also due no later than the time of the last one plus the
+     time of the last window moves, which keeps estimation errors from
+     accumulating. On top of that, margin seconds are allowed, plus
+     segmentMargin for each command in flight.
+
+     Heating, homing and other slow commands are allowed slowTimeout seconds,
+     and commands whose duration is unknown fastTimeout seconds, until they
+     are acknowledged. Such commands are matched to their "ok" by line number
+     when ADVANCED_OK tells which line was acknowledged, so that a lost or
+     duplicated "ok" cannot release them early, and otherwise by counting
+     "ok"s. Marlin sends "busy:" keepalives during long commands
+     if HOST_KEEPALIVE_FEATURE is enabled; each one extends the deadline by
+     busyTimeout seconds."""
+  QUICK = GCodeModalState.HARMLESS + (b"G90", b"G91", b"G92", b"M82", b"M83", b"M400")
+  SLOW  = (b"M109", b"M190", b"G28", b"G29", b"G425", b"M0", b"M1", b"M600", b"M303")
+
+  def __init__(self, margin = 0.5, moveTimeFactor = 1.5, busyTimeout = 5, slowTimeout = 300, fastTimeout = 15,
+               maxFeedrates = None, defaultFeedrate = 1500, window = 32, maxAccelerations = None, acceleration = 3000,
+               minSegmentTime = 0.02, segmentMargin = 0.01, clock = time.time):
+    self.margin           = margin
+    self.segmentMargin    = segmentMargin
+    self.moveTimeFactor   = moveTimeFactor
+    self.busyTimeout      = busyTimeout
+    self.slowTimeout      = slowTimeout
+    self.fastTimeout      = fastTimeout
+    self.maxFeedrates     = dict(maxFeedrates or {"X": 50, "Y": 50, "Z": 5, "E": 20})
+    self.maxAccelerations = dict(maxAccelerations or {"X": 3000, "Y": 3000, "Z": 100, "E": 10000})
+    self.acceleration     = acceleration
+    self.minSegmentTime   = minSegmentTime
+    self.defaultFeedrate  = defaultFeedrate
+    self.clock            = clock
+    self.state            = GCodeModalState()
+    self.plannedUntil     = 0
+    self.lastProgress     = 0
+    self.recent           = collections.deque(maxlen = window)
+    self.recentTime       = 0
+    self.busyUntil        = 0
+    self.sent             = 0
+    self.acknowledged     = 0
+    self.waiting          = [] # (command number, line number or None, until) of slow commands not yet acknowledged
+
+  def _moveTime(self, before, params):
+    """Returns how long a move should take, or None if it cannot be known"""
+    after  = self.state.position
+    deltas = {}
+    for axis in GCodeModalState.AXES:
+      if params.get(axis) is not None:
+        if before[axis] is None or after[axis] is None:
+          return None
+        deltas[axis] = abs(after[axis] - before[axis])
+    distance = sum(deltas.get(axis, 0) ** 2 for axis in "XYZ") ** 0.5 or deltas.get("E", 0)
+    if not distance:
+      return 0
+    speed = (self.state.feedrate or self.defaultFeedrate) / 60.0
+    accel = self.acceleration
+    for axis, delta in deltas.items():
+      if delta:
+        # The axis moves by delta / distance mm per mm of the move
+        speed = min(speed, self.maxFeedrates.get(axis, 1) * distance / delta)
+        accel = min(accel, self.maxAccelerations.get(axis, 1) * distance / delta)
+    return max(trapezoidTime(distance, speed, accel), self.minSegmentTime)
+
+  def _duration(self, code, params):
+    """Returns how long a command will occupy the planner, or None if it will
+       hold up Marlin for an unknown amount of time"""
+    before = dict(self.state.position)
+    self.state.update(code, params)
+    if code in GCodeModalState.MOVES:
+      duration = self._moveTime(before, params)
+      return None if duration is None else duration * self.moveTimeFactor
+    if code == b"G4":
+      return (params.get("P") or 0) / 1000.0 + (params.get("S") or 0)
+    if code in self.SLOW:
+      return None # Heating commands are harmless to the modal state, but not quick
+    if code in self.QUICK or code is None:
+      return 0
+    return None
+
+  def onSent(self, cmd):
+    now = self.clock()
+    self.sent += 1
+    self.lastProgress = now
+    line = None
+    if cmd.startswith(b"N"):
+      # Strip the line number and checksum
+      frame = cmd.split(b"*", 1)[0]
+      cmd   = frame.lstrip(b"N0123456789 ")
+      line  = int(frame[1:len(frame) - len(cmd)])
+    code, params = parseCmd(cmd)
+    duration = self._duration(code, params)
+    if duration is None:
+      self.waiting.append((self.sent, line, now + (self.slowTimeout if code in self.SLOW else self.fastTimeout)))
+    else:
+      self.plannedUntil = max(self.plannedUntil, now) + duration
+      if len(self.recent) == self.recent.maxlen:
+        self.recentTime -= self.recent[0]
+      self.recent.append(duration)
+      self.recentTime += duration
+
+  def onOkay(self, line = None):
+    """Called for each "ok". If line is given, it is the line number of the
+       command which was acknowledged, or of an earlier one"""
+    self.lastProgress  = self.clock()
+    self.acknowledged += 1
+    if line is None:
+      while self.waiting and self.waiting[0][0] <= self.acknowledged:
+        self.waiting.pop(0)
+    else:
+      self.waiting = [(n, l, u) for n, l, u in self.waiting if (n > self.acknowledged if l is None else l > line)]
+
+  def onBusy(self):
+    self.busyUntil = self.clock() + self.busyTimeout
+
+  def onReset(self):
+    self.acknowledged = self.sent
+    self.waiting      = []
+
+  def deadline(self):
+    margin = self.margin + self.segmentMargin * max(0, self.sent - self.acknowledged)
+    until  = max(min(self.plannedUntil, self.lastProgress + self.recentTime) + margin, self.busyUntil)
+    if self.waiting:
+      until = max(until, max(u for n, l, u in self.waiting))
+    return until
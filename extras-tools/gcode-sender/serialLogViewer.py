@@ -0,0 +1,45 @@
+#!/usr/bin/python
+#
+# A tool to print a log written by LoggingSerialConnection, such as with
+# "gcodeSender.py -l", in either the text or the binary format, including
+# any rotated log files.
+#
+
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+from __future__ import print_function
+from pyMarlin   import *
+
+import argparse
+import sys
+
+parser = argparse.ArgumentParser(description='''prints a serial log written by LoggingSerialConnection.''')
+parser.add_argument('-a', '--absolute',  help='Print absolute timestamps, rather than seconds since the start of the log.', action='store_true')
+parser.add_argument('-s', '--sent',      help='Only print lines sent to Marlin.', action='store_true')
+parser.add_argument('-r', '--received',  help='Only print lines received from Marlin.', action='store_true')
+parser.add_argument('-n', '--norotated', help='Do not read rotated log files.', action='store_false', dest='rotated')
+parser.add_argument('filename',          help='log file')
+args = parser.parse_args()
+
+start = None
+for timestamp, direction, data in readSerialLog(args.filename, args.rotated):
+  if start is None:
+    start = 0 if args.absolute else timestamp
+  if (args.sent and direction != b">") or (args.received and direction != b"<"):
+    continue
+  if not data:
+    print("%12.6f %s Timeout" % (timestamp - start, direction.decode()))
+    continue
+  # A coalesced write carries several commands, which are printed one per line
+  for line in data.decode(errors='replace').splitlines() or [""]:
+    print("%12.6f %s %s" % (timestamp - start, direction.decode(), line))
@@ -0,0 +1,63 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# Run from extras-tools/gcode-sender with "python -m pytest tests"
+
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from pyMarlin.loggingSerialConnection import LoggingSerialConnection, readSerialLog, SENT
+
+# Logs commands, then dies of an unhandled exception without calling close()
+CRASH = """
+import sys
+from pyMarlin import *
+sio = LoggingSerialConnection(FakeMarlinSerialDevice(), sys.argv[1], binary = sys.argv[2] == "binary", flushInterval = 60)
+for i in range(1000):
+  sio.write(b"G0 X%d\\n" % i)
+  sio.readline()
+raise RuntimeError("crash")
+"""
+
+class LoggingSerialConnectionTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+    self.log = os.path.join(self.dir.name, "serial.log")
+
+  def tearDown(self):
+    self.dir.cleanup()
+
+  def test_log_complete_at_exit(self):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for format in ("text", "binary"):
+      result = subprocess.run([sys.executable, "-c", CRASH, self.log, format], cwd = root, stderr = subprocess.PIPE)
+      self.assertNotEqual(result.returncode, 0)
+      self.assertIn(b"RuntimeError: crash", result.stderr)
+      records = list(readSerialLog(self.log))
+      self.assertEqual(len(records), 2000)
+      self.assertEqual(records[-2][1:], (SENT, b"G0 X999\n"))
+
+  def test_writer_error_raised(self):
+    sio = LoggingSerialConnection(io.BytesIO(), self.log)
+    sio.write(b"M105\n")
+    sio.file.close() # Make the writer thread fail
+    sio.wakeup.set()
+    sio.thread.join(5)
+    self.assertRaises(ValueError, sio.write, b"M105\n")
+    self.assertRaises(ValueError, sio.close)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,51 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# Run from extras-tools/gcode-sender with "python -m pytest tests"
+
+import unittest
+
+from pyMarlin.marlinReplyParser import parseReply, Ok, AdvancedOk, Resend, Error, Other, Timeout
+
+class ReplyParserTest(unittest.TestCase):
+  def assertReply(self, line, cls, resendPosition = None):
+    reply = parseReply(line)
+    self.assertIs(type(reply), cls, line)
+    self.assertEqual(reply.resendPosition, resendPosition, line)
+    return reply
+
+  def test_replies(self):
+    self.assertReply(b"", Timeout)
+    self.assertReply(b"ok\n", Ok)
+    self.assertReply(b"Resend: 18\n", Resend, 18)
+    self.assertReply(b"Resend:N18\r\n", Resend, 18)
+    self.assertReply(b"rs N18\n", Resend, 18)
+    self.assertReply(b"Error:No Line Number with checksum, Last Line: 17\n", Error, 18)
+    reply = self.assertReply(b"ok N18 P15 B3\n", AdvancedOk)
+    self.assertEqual((reply.lastLine, reply.plannerAvail, reply.bufferAvail), (18, 15, 3))
+
+  def test_corrupted_resend(self):
+    self.assertReply(b"Resend: 18S3\n", Other)
+    self.assertReply(b"Resend: 1x8\n", Other)
+    self.assertReply(b"rs N18:\n", Other)
+    self.assertReply(b"Resend:\n", Other)
+
+  def test_corrupted_error(self):
+    self.assertReply(b"Error:No Line Number with checksum, Last Line: 17q\n", Error, None)
+
+  def test_corrupted_advanced_ok(self):
+    # The fields must cover the whole line, else it is only an ok
+    self.assertReply(b"ok N18 P15 B3x\n", Ok)
+    self.assertReply(b"ok N18 P1\n", Ok)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,84 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# Run from extras-tools/gcode-sender with "python -m pytest tests"
+
+import unittest
+
+from pyMarlin.marlinSerialProtocol   import MarlinSerialProtocol, GCodeHistory
+from pyMarlin.fakeMarlinSerialDevice import SimulatedMarlinSerialDevice
+
+class ScriptedSerial:
+  """A serial port which records what is written and replies with the lines
+     queued in replies"""
+  def __init__(self):
+    self.replies     = []
+    self.written     = []
+    self.timeout     = None
+    self.out_waiting = 0
+
+  @property
+  def in_waiting(self):
+    return len(self.replies)
+
+  def readline(self):
+    return self.replies.pop(0) if self.replies else b""
+
+  def write(self, data):
+    self.written.append(data)
+
+  def flush(self):
+    pass
+
+  def close(self):
+    pass
+
+class MarlinSerialProtocolTest(unittest.TestCase):
+  def test_resend_of_evicted_line(self):
+    serial   = ScriptedSerial()
+    messages = []
+    proto    = MarlinSerialProtocol(serial, onDebugMsgCallback = messages.append)
+    proto.history = GCodeHistory(8)
+    proto.restart()
+    for i in range(20):
+      proto.sendCmdReliable("G0 X%d" % i)
+      while not proto.clearToSend():
+        serial.replies.append(b"ok\n")
+        proto.readline()
+    oldest = proto.history.oldestPosition()
+    self.assertGreater(oldest, 1)
+    # A corrupted request for a line long since evicted must not abort the print
+    del serial.written[:]
+    serial.replies.append(b"Resend: 1\n")
+    proto.readline()
+    self.assertTrue(any("Forcing re-sync" in msg for msg in messages))
+    self.assertEqual(serial.written[0], proto._addPositionAndChecksum(oldest - 1, b"M110") + b"\n")
+    proto.clearToSend()
+    self.assertTrue(serial.written[1].startswith(b"N%dG0" % oldest))
+
+  def sendMoves(self, advancedOk, bufSize = 4, moves = 300):
+    """Sends moves long enough to keep Marlin's command buffer full"""
+    device = SimulatedMarlinSerialDevice(bufSize = bufSize, advancedOk = advancedOk, includeHostTime = False)
+    proto  = MarlinSerialProtocol(device)
+    for i in range(moves):
+      proto.sendCmdReliable("G1 X%d F3000" % (i % 2 * 10))
+      while not proto.clearToSend():
+        proto.readline()
+    return proto
+
+  def test_queue_depth(self):
+    # Marlin keeps one slot in reserve, so a full buffer holds three commands
+    self.assertGreater(self.sendMoves(advancedOk = False).averageQueueDepth(), 2.5)
+    self.assertGreater(self.sendMoves(advancedOk = True).averageQueueDepth(),  2.5)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,45 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# Run from extras-tools/gcode-sender with "python -m pytest tests"
+
+import time
+import unittest
+
+from pyMarlin.pacingStrategy         import AdaptivePacing
+from pyMarlin.fakeMarlinSerialDevice import FakeMarlinSerialDevice
+
+class StalledSerial:
+  """A serial port whose transmit buffer never drains"""
+  out_waiting = 4096
+
+class AdaptivePacingTest(unittest.TestCase):
+  def test_waits_for_output_to_drain(self):
+    device = FakeMarlinSerialDevice(baudrate = 115200)
+    for i in range(100):
+      device.write(b"G1 X%d Y%d\n" % (i, i))
+    pacing = AdaptivePacing()
+    self.assertGreater(device.out_waiting, pacing.maxOutWaiting)
+    start = time.time()
+    pacing.pace(device)
+    self.assertLessEqual(device.out_waiting, pacing.maxOutWaiting)
+    self.assertLess(time.time() - start, pacing.drainTime(device, 1200))
+
+  def test_stops_waiting_on_a_stalled_port(self):
+    pacing = AdaptivePacing(maxDrainTime = 0.2)
+    start  = time.time()
+    pacing.pace(StalledSerial())
+    self.assertGreaterEqual(time.time() - start, 0.2)
+    self.assertLess(time.time() - start, 1)
+
+if __name__ == "__main__":
+  unittest.main()
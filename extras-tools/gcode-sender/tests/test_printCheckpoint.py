@@ -0,0 +1,59 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# Run from extras-tools/gcode-sender with "python -m pytest tests"
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyMarlin.printCheckpoint import PrintCheckpoint, CheckpointWriter
+
+GCODE = b"M104 S210\nG90\nG1 Z0.3 F600\nG1 X10 Y20 E1 F1800\nG1 X30 Y20 E2\n"
+
+class PrintCheckpointTest(unittest.TestCase):
+  def setUp(self):
+    self.dir      = tempfile.mkdtemp()
+    self.filename = os.path.join(self.dir, "print.gcode")
+    with open(self.filename, "wb") as f:
+      f.write(GCODE)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def _checkpoint(self):
+    checkpointFile = os.path.join(self.dir, "print.json")
+    writer = CheckpointWriter(self.filename, checkpointFile, interval = 60)
+    offset = 0
+    for position, cmd in enumerate(GCODE.splitlines(True), 1):
+      offset += len(cmd)
+      writer.onQueued(position, cmd.strip(), offset)
+    writer.onAcknowledged(4)
+    writer.close()
+    return PrintCheckpoint.load(checkpointFile)
+
+  def test_resume_lifts_before_moving(self):
+    cmds = self._checkpoint().resumeCommands(lift = 5, travelFeedrate = 3000)
+    self.assertEqual(cmds[:5], [b"G91", b"G1 Z5 F3000", b"G90", b"M109 S210", b"G1 X10 Y20 F3000"])
+    self.assertEqual(cmds[5], b"G1 Z0.3")
+
+  def test_fingerprint_detects_changes(self):
+    checkpoint = self._checkpoint()
+    self.assertEqual(checkpoint.offset, len(b"".join(GCODE.splitlines(True)[:4])))
+    with open(self.filename, "r+b") as f:
+      f.seek(len(GCODE) - 2)
+      f.write(b"3")
+    self.assertRaises(ValueError, PrintCheckpoint.load, os.path.join(self.dir, "print.json"))
+
+if __name__ == '__main__':
+  unittest.main()
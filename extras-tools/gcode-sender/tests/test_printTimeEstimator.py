@@ -0,0 +1,52 @@
+#
+# (c) 2017 Aleph Objects, Inc.
+#
+# The code in this page is free software: you can
+# redistribute it and/or modify it under the terms of the GNU
+# General Public License (GNU GPL) as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option)
+# any later version.  The code is distributed WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU GPL for more details.
+#
+
+# Run from extras-tools/gcode-sender with "python -m pytest tests"
+
+import unittest
+
+from pyMarlin.printTimeEstimator import PrintTimeEstimator, trapezoidTime, numpy
+
+JERK = {"X": 10, "Y": 10, "Z": 0.3, "E": 5}
+
+class ClassicJerkTest(unittest.TestCase):
+  def _estimate(self, lines, useNumpy):
+    estimator = PrintTimeEstimator(jerk = JERK, minimumPlannerSpeed = 0, useNumpy = useNumpy)
+    for line in lines:
+      estimator.addLine(line)
+    estimator._makeBlocks()
+    return estimator
+
+  def _check(self, useNumpy):
+    # 20 mm/s along X, then 50 mm/s along X: the junction is limited to
+    # 20 mm/s by the first block, at which X would jump by 30 mm/s, so the
+    # junction is scaled down to 20 * 10 / 30 mm/s.
+    estimator = self._estimate([b"G1 X10 F1200", b"G1 X20 F3000"], useNumpy)
+    self.assertAlmostEqual(estimator.maxEntrySqrs[1], (20 * 10 / 30.0) ** 2)
+    estimator.finish()
+    expected = trapezoidTime(10, 20, 3000, 0, 20 / 3.0) + trapezoidTime(10, 50, 3000, 20 / 3.0, 0)
+    self.assertAlmostEqual(estimator.totalTime(), expected)
+    # A right angle from 50 mm/s along X to 20 mm/s along Y: X drops from
+    # 20 mm/s at the junction speed to 0 and Y rises from 0 to 20 mm/s, so
+    # the junction is scaled to 20 * 10 / 20 mm/s.
+    estimator = self._estimate([b"G1 X10 F3000", b"G1 Y10 F1200"], useNumpy)
+    self.assertAlmostEqual(estimator.maxEntrySqrs[1], 10 ** 2)
+
+  def test_classic_jerk(self):
+    self._check(False)
+
+  @unittest.skipUnless(numpy, "NumPy is not installed")
+  def test_classic_jerk_numpy(self):
+    self._check(True)
+
+if __name__ == '__main__':
+  unittest.main()